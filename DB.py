@@ -1,9 +1,15 @@
 import sqlite3
 import os
+import queue
 import sys
-from typing import Any, Callable, Union,TypeVar,ParamSpec
+import threading
+from types import TracebackType
+from typing import Any, Callable, Iterable, Iterator, Self, Sequence, Union,TypeVar,ParamSpec
+from contextlib import contextmanager
 from functools import wraps
 import inspect
+import itertools
+from metrics import MetricsRegistry, metricsRegistry
 
 
 class TableNotFoundError(Exception):
@@ -12,22 +18,73 @@ class ColumnNotFoundError(Exception):
     pass
 class ArgumentError(Exception):
     pass
+class SchemaVersionError(Exception):
+    pass
 
 P = ParamSpec("P")
 R = TypeVar("R")
+# rows handed to one executemany, so a generator of rows is never held in memory at once
+INSERT_CHUNK_SIZE = 1000
+# read-only connections a DatabasePool opens at most, and how long a statement waits for a lock
+POOL_READER_CONNECTIONS = 4
+BUSY_TIMEOUT_SECONDS = 5.0
+
+
+def _argumentGetter(signature:inspect.Signature, name:str) -> Callable[[tuple[Any, ...], dict[str, Any]], Any]:
+    """Reads one argument of a call without binding the whole signature, None when it is missing."""
+    if name not in signature.parameters:
+        return lambda args, kwargs: None
+    position = list(signature.parameters).index(name)
+    default = signature.parameters[name].default
+    default = None if default is inspect.Parameter.empty else default
+    def getArgument(args:tuple[Any, ...], kwargs:dict[str, Any]) -> Any:
+        if name in kwargs:
+            return kwargs[name]
+        return args[position] if position < len(args) else default
+    return getArgument
+
 
 class Database:
-    def __init__(self,dataBasePath:str,TableName:str="",columnsAndDataTypes:dict[str,str]={}) -> None:
+    """
+    sqlite3 connection with checked helpers for the tables of one database file.
+    Table and column names are checked against tableAndColumnsDict, a catalog of the
+    schema read on first use, so checks are dictionary lookups. createTable and
+    insertColumn reload it; a name the catalog doesn't know reloads it when
+    PRAGMA schema_version shows another connection changed the schema.
+    Each thread gets its own cursor; a connection is only shared between threads
+    when it is passed in, as DatabasePool does, and then writes must take turns.
+    Used in a with block, the connection is committed and closed at the end.
+    """
+    def __init__(self,dataBasePath:str,TableName:str="",columnsAndDataTypes:dict[str,str]={},
+                 connection:sqlite3.Connection|None=None) -> None:
         os.makedirs(os.path.dirname(dataBasePath), exist_ok=True) 
+        self.dataBasePath=dataBasePath
         self.tableAndColumnsDict:dict[str, list[str]]={}
-        self.connection=sqlite3.connect(f"{dataBasePath}"
-                                        ,detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        self.cursor=self.connection.cursor()
+        # schema_version the catalog was read at, None until it is read
+        self._schemaVersion:int|None=None
+        self._savepointDepth=0
+        self._transactionDepth=0
+        self._threadCursors=threading.local()
+        self.connection=connection or sqlite3.connect(f"{dataBasePath}"
+                                                      ,detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
         if TableName=="" or len(columnsAndDataTypes.keys())==0:
             self.connection.commit()
         else:
             self.createTable(TableName, columnsAndDataTypes)
-            self.tableAndColumnsDict[TableName]=list(columnsAndDataTypes.keys())
+
+    @property
+    def cursor(self)->sqlite3.Cursor:
+        cursor:sqlite3.Cursor|None=getattr(self._threadCursors,"cursor",None)
+        if cursor is None:
+            cursor=self._threadCursors.cursor=self.connection.cursor()
+        return cursor
+
+    def __enter__(self)->Self:
+        return self
+
+    def __exit__(self,exceptionType:type[BaseException]|None,exception:BaseException|None,
+                 traceback:TracebackType|None)->None:
+        self.disconnect(exceptionType is None)
 
     @property
     def tableNames(self)->list[str]:
@@ -37,29 +94,60 @@ class Database:
         return tableNamesList
     
 
-    def isTableExists(self,tableName:str)->bool:
-        tablesList = self.tableNames
-        if tableName not in tablesList:
+    def _readSchemaVersion(self)->int:
+        self.cursor.execute("PRAGMA schema_version")
+        return int(self.cursor.fetchone()[0])
+
+    def refreshSchema(self)->None:
+        """Reads the tables and their columns into the catalog."""
+        self._schemaVersion=self._readSchemaVersion()
+        self.tableAndColumnsDict={}
+        for tableName in self.tableNames:
+            self.cursor.execute(f"PRAGMA table_info('{tableName}')")
+            self.tableAndColumnsDict[tableName]=list(str(columnInfo[1]) for columnInfo in self.cursor.fetchall()
+                                                     if len(columnInfo)>1)
+
+    def _schemaMiss(self)->bool:
+        """Reloads the catalog if the schema changed since it was read, returns whether it did."""
+        if self._schemaVersion is not None and self._readSchemaVersion()==self._schemaVersion:
             return False
+        self.refreshSchema()
         return True
+
+    def _tableColumns(self,tableName:str)->list[str]|None:
+        if self._schemaVersion is None:
+            self.refreshSchema()
+        columns=self.tableAndColumnsDict.get(tableName)
+        if columns is None and self._schemaMiss():
+            columns=self.tableAndColumnsDict.get(tableName)
+        return columns
+
+    def isTableExists(self,tableName:str)->bool:
+        return self._tableColumns(tableName) is not None
     
     def isColumnExists(self,tableName:str,columnName:str)->bool:
         if self.isTableExists(tableName) ==False:
             raise TableNotFoundError(f"Table Name {tableName} not found in database.")
-        columnsList = self.getColumns(tableName)
-        if columnName not in columnsList:
-            return False
-        return True
+        return not self._missingColumns(tableName,[columnName])
+
+    def _missingColumns(self,tableName:str,columnNames:list[str])->list[str]:
+        columnsInTable = self.getColumns(tableName)
+        missingColumns = [column for column in columnNames if column not in columnsInTable]
+        # a column added by another connection is only in the catalog once it is reloaded
+        if missingColumns and self._schemaMiss():
+            columnsInTable = self.getColumns(tableName)
+            missingColumns = [column for column in columnNames if column not in columnsInTable]
+        return missingColumns
              
     @staticmethod
     def _checkTableExists(method:Callable[P,R]) -> Callable[P,R] :
         signature = inspect.signature(method)
+        getTableName = _argumentGetter(signature,"tableName")
+        getDataBase = _argumentGetter(signature,"self")
         @wraps(method)
         def wrapper(*args:P.args, **kwargs:P.kwargs)->R:
-            bound = signature.bind(*args,**kwargs)
-            bound.apply_defaults()
-            tableName:str|Any = bound.arguments.get("tableName")
-            dataBase:"Database"|Any= bound.arguments.get("self")
+            tableName:str|Any = getTableName(args,kwargs)
+            dataBase:"Database"|Any= getDataBase(args,kwargs)
             if tableName is None:
                 raise ArgumentError(f"function {method.__name__} doesn't have parameter tableName")
             if dataBase is None:
@@ -70,7 +158,7 @@ class Database:
             if isinstance(dataBase,Database) == False:
                 raise ValueError(f"self is not Database object")
             
-            if tableName not in dataBase.tableNames:
+            if not dataBase.isTableExists(tableName):
                 raise TableNotFoundError(f"Table {tableName} not found")
             return method(*args,**kwargs)
         return wrapper
@@ -79,14 +167,16 @@ class Database:
     @staticmethod
     def _checkColumnExists(method:Callable[P,R])-> Callable[P,R] :
         signature = inspect.signature(method)
+        getTableName = _argumentGetter(signature,"tableName")
+        getDataBase = _argumentGetter(signature,"self")
+        getColumnName = _argumentGetter(signature,"columnName")
+        getColumnAndValue = _argumentGetter(signature,"columnAndValue")
         @wraps(method)
         def wrapper(*args:P.args, **kwargs:P.kwargs)->R:
-            bound = signature.bind(*args,**kwargs)
-            bound.apply_defaults()
-            tableName:str|Any = bound.arguments.get("tableName")
-            dataBase:"Database"|Any= bound.arguments.get("self")
-            columnName:str|Any=bound.arguments.get("columnName")
-            columnAndValue:dict[str,Any]|Any = bound.arguments.get("columnAndValue")
+            tableName:str|Any = getTableName(args,kwargs)
+            dataBase:"Database"|Any= getDataBase(args,kwargs)
+            columnName:str|Any=getColumnName(args,kwargs)
+            columnAndValue:dict[str,Any]|Any = getColumnAndValue(args,kwargs)
 
             if tableName is None:
                 raise ArgumentError(f"function {method.__name__} doesn't have parameter tableName")
@@ -100,15 +190,10 @@ class Database:
             if isinstance(dataBase,Database) == False:
                 raise ValueError(f"self is not Database object")
 
-            columnsInTable = dataBase.getColumns(tableName)
-
-            if columnAndValue is not None:
-                columnsInInput=list(columnAndValue.keys())
-                for column in columnsInInput:
-                    if column not in columnsInTable:
-                        raise ColumnNotFoundError(f"Column {column} not found in the table {tableName}")
-            elif columnName not in columnsInTable:
-                    raise ColumnNotFoundError(f"Column {columnName} not found in the table {tableName}")
+            missingColumns = dataBase._missingColumns(tableName, list(columnAndValue.keys())
+                                                      if columnAndValue is not None else [columnName])
+            if missingColumns:
+                raise ColumnNotFoundError(f"Column {missingColumns[0]} not found in the table {tableName}")
                 
             return method(*args, **kwargs)
             
@@ -116,14 +201,10 @@ class Database:
 
 
     def getColumns(self, tableName:str)->list[str]:
-        if self.isTableExists(tableName) == False:
+        columnNames=self._tableColumns(tableName)
+        if columnNames is None:
             raise TableNotFoundError(f"Table name {tableName} not found in database")
-        self.cursor.execute(f"PRAGMA table_info('{tableName}')")
-        columnsInfoList:list[tuple[str]]=self.cursor.fetchall()
-
-        columnNames:list[str]=list(str(columnInfo[1]) for columnInfo in columnsInfoList
-                                   if len(columnInfo)>1)
-        return columnNames
+        return list(columnNames)
 
     def createTable(self,tableName:str, columnsAndDataTypes:dict[str, str]) -> None:
         if self.isTableExists(tableName):
@@ -132,15 +213,49 @@ class Database:
         columnAndDataTypesString=",".join([f"{column} {dataType}" 
                                            for column, dataType in columnsAndDataTypes.items()])
         self.cursor.execute(f"CREATE TABLE IF NOT EXISTS '{tableName}' ({columnAndDataTypesString})")    
+        self.refreshSchema()
 
     @_checkTableExists
     def insertColumn(self, tableName:str, columnName:str, columnDataType:str) -> None:
         self.cursor.execute(f"ALTER TABLE '{tableName}' ADD COLUMN '{columnName}' {columnDataType}")
+        self.refreshSchema()
+
+    @_checkTableExists
+    def createIndex(self, tableName:str, indexName:str, columnNames:list[str], unique:bool=False) -> None:
+        """Indexes columnNames of a table, nothing happens when an index named indexName exists."""
+        missingColumns = self._missingColumns(tableName, columnNames)
+        if missingColumns:
+            raise ColumnNotFoundError(f"Column {missingColumns[0]} not found in the table {tableName}")
+        self.cursor.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS '{indexName}' "
+                            f"ON '{tableName}' ({', '.join(columnNames)})")
+
+    @property
+    def userVersion(self)->int:
+        self.cursor.execute("PRAGMA user_version")
+        return int(self.cursor.fetchone()[0])
+
+    def migrate(self,migrations:Sequence[Callable[["Database"],object]])->int:
+        """
+        Upgrades the schema to version len(migrations), the version PRAGMA user_version keeps.
+        migrations[i] takes version i to i+1 and runs in one transaction with the version
+        update, so a migration that fails leaves the database at the version before it.
+        Returns how many migrations ran.
+        """
+        version=self.userVersion
+        if version>len(migrations):
+            raise SchemaVersionError(f"Database {self.dataBasePath} has schema version {version}, "
+                                     f"newer than the {len(migrations)} known here")
+        for number,migration in enumerate(migrations[version:],start=version+1):
+            with self.transaction():
+                migration(self)
+                # PRAGMA takes no parameters, number is an int
+                self.cursor.execute(f"PRAGMA user_version={number}")
+        return len(migrations)-version
 
     @_checkColumnExists
-    def insertData(self, tableName: str, columnAndValue: dict[str, Any], saveChanges: bool = False) -> None:
+    def insertData(self, tableName: str, columnAndValue: dict[str, Any], saveChanges: bool = False) -> int|None:
         """
-        Inserts data in an existing table.
+        Inserts data in an existing table and returns the rowid of the inserted row.
         columnAndValue - column name and value to be added in column as key value pair
         """
         columns = ", ".join(columnAndValue.keys())              
@@ -150,9 +265,161 @@ class Database:
         query = f"INSERT INTO {tableName} ({columns}) VALUES ({placeholders})"
         self.cursor.execute(query, values)
 
-        if saveChanges:
+        self._saveChanges(saveChanges)
+        return self.cursor.lastrowid
+
+    @_checkColumnExists
+    def updateData(self, tableName: str, columnAndValue: dict[str, Any], keyColumn: str, keyValue: Any,
+                   saveChanges: bool = False) -> int:
+        """
+        Updates the rows whose keyColumn equals keyValue and returns how many rows changed.
+        columnAndValue - column name and new value as key value pair
+        """
+        if keyColumn not in self.getColumns(tableName):
+            raise ColumnNotFoundError(f"Column {keyColumn} not found in the table {tableName}")
+        assignments = ", ".join(f"{column} = ?" for column in columnAndValue)
+        query = f"UPDATE {tableName} SET {assignments} WHERE {keyColumn} = ?"
+        self.cursor.execute(query, (*columnAndValue.values(), keyValue))
+
+        self._saveChanges(saveChanges)
+        return self.cursor.rowcount
+
+    def _saveChanges(self,saveChanges:bool)->None:
+        # inside transaction() the outermost block commits
+        if saveChanges and self._transactionDepth==0:
+            self.connection.commit()
+
+    def commit(self)->None:
+        """Commits now, or inside transaction() leaves it to the outermost block."""
+        self._saveChanges(True)
+
+    @contextmanager
+    def _savepoint(self)->Iterator[None]:
+        """Undoes the statements of the block if it raises, without committing when it doesn't."""
+        # releasing a savepoint that started the transaction would commit it
+        beganTransaction=not self.connection.in_transaction
+        if beganTransaction:
+            self.cursor.execute("BEGIN")
+        savepointName=f"savepoint_{self._savepointDepth}"
+        self.cursor.execute(f"SAVEPOINT {savepointName}")
+        self._savepointDepth+=1
+        try:
+            yield
+        except BaseException:
+            self._savepointDepth-=1
+            # the block may have changed the schema, the catalog is read again on next use
+            self._schemaVersion=None
+            if beganTransaction:
+                # ends the transaction the block began, so its write lock isn't held until the next commit
+                self.connection.rollback()
+            else:
+                self.cursor.execute(f"ROLLBACK TO {savepointName}")
+                self.cursor.execute(f"RELEASE {savepointName}")
+            raise
+        self._savepointDepth-=1
+        self.cursor.execute(f"RELEASE {savepointName}")
+
+    @contextmanager
+    def transaction(self)->Iterator["Database"]:
+        """
+        Runs the statements of the block as one unit: the outermost block commits when it
+        ends, and a block that raises undoes only its own statements, so nested blocks act
+        as savepoints. saveChanges of the calls inside doesn't commit early.
+        """
+        self._transactionDepth+=1
+        try:
+            with self._savepoint():
+                yield self
+        finally:
+            self._transactionDepth-=1
+        if self._transactionDepth==0:
             self.connection.commit()
 
+    def _checkedColumns(self,tableName:str,columnNames:list[str])->list[str]:
+        missingColumns=self._missingColumns(tableName,columnNames)
+        if missingColumns:
+            raise ColumnNotFoundError(f"Column {missingColumns[0]} not found in the table {tableName}")
+        return columnNames
+
+    def _rowsByColumns(self,tableName:str,rows:Iterable[dict[str, Any]],
+                       chunkSize:int)->Iterator[tuple[list[str],list[tuple[Any, ...]]]]:
+        """Chunks of consecutive rows that set the same columns, with the checked column names."""
+        for columns,rowsOfColumns in itertools.groupby(rows,key=lambda row: tuple(row)):
+            columnNames=self._checkedColumns(tableName,list(columns))
+            for chunk in itertools.batched(rowsOfColumns,chunkSize):
+                yield columnNames,[tuple(row.values()) for row in chunk]
+
+    def insertMany(self,tableName:str,rows:Iterable[dict[str, Any]],chunkSize:int=INSERT_CHUNK_SIZE,
+                   saveChanges:bool=False)->int:
+        """
+        Inserts rows with one executemany per chunkSize rows and returns how many were inserted.
+        Consecutive rows that set the same columns share a statement.
+        """
+        insertedRows=0
+        with self._savepoint():
+            for columnNames,values in self._rowsByColumns(tableName,rows,chunkSize):
+                self.cursor.executemany(f"INSERT INTO {tableName} ({', '.join(columnNames)}) "
+                                        f"VALUES ({', '.join('?' for _ in columnNames)})",values)
+                insertedRows+=len(values)
+        self._saveChanges(saveChanges)
+        return insertedRows
+
+    def insertReturningIds(self,tableName:str,rows:Iterable[dict[str, Any]],saveChanges:bool=False)->list[int]:
+        """
+        Inserts rows and returns their rowids, read with RETURNING from the multi-row inserts
+        themselves. SQLite returns them in no particular order, so they are sorted, which is
+        insertion order while SQLite assigns the rowids.
+        """
+        rowIds:list[int]=[]
+        maxVariables=self.connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        with self._savepoint():
+            for columns,rowsOfColumns in itertools.groupby(rows,key=lambda row: tuple(row)):
+                columnNames=self._checkedColumns(tableName,list(columns))
+                rowPlaceholders=f"({', '.join('?' for _ in columnNames)})"
+                for chunk in itertools.batched(rowsOfColumns,max(maxVariables//max(len(columnNames),1),1)):
+                    self.cursor.execute(f"INSERT INTO {tableName} ({', '.join(columnNames)}) "
+                                        f"VALUES {', '.join(rowPlaceholders for _ in chunk)} RETURNING rowid",
+                                        [value for row in chunk for value in row.values()])
+                    rowIds.extend(sorted(int(row[0]) for row in self.cursor.fetchall()))
+        self._saveChanges(saveChanges)
+        return rowIds
+
+    def _upsertStatement(self,tableName:str,columnNames:list[str],conflictColumns:list[str],
+                         updateColumns:list[str]|None)->str:
+        self._checkedColumns(tableName,conflictColumns)
+        updateColumns=self._checkedColumns(tableName,updateColumns if updateColumns is not None else
+                                           [column for column in columnNames if column not in conflictColumns])
+        conflictAction=(f"DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in updateColumns)}"
+                        if updateColumns else "DO NOTHING")
+        return (f"INSERT INTO {tableName} ({', '.join(columnNames)}) VALUES ({', '.join('?' for _ in columnNames)}) "
+                f"ON CONFLICT ({', '.join(conflictColumns)}) {conflictAction}")
+
+    @_checkColumnExists
+    def upsertData(self,tableName:str,columnAndValue:dict[str, Any],conflictColumns:list[str],
+                   updateColumns:list[str]|None=None,saveChanges:bool=False)->int|None:
+        """
+        Inserts a row, or updates the row it conflicts with on conflictColumns, and returns the
+        rowid of the row written, None when the conflict left it unchanged.
+        updateColumns - columns overwritten on conflict, by default every column not in conflictColumns
+        """
+        self.cursor.execute(self._upsertStatement(tableName,list(columnAndValue),conflictColumns,updateColumns)
+                            +" RETURNING rowid",tuple(columnAndValue.values()))
+        row=self.cursor.fetchone()
+        self._saveChanges(saveChanges)
+        return None if row is None else int(row[0])
+
+    def upsertMany(self,tableName:str,rows:Iterable[dict[str, Any]],conflictColumns:list[str],
+                   updateColumns:list[str]|None=None,chunkSize:int=INSERT_CHUNK_SIZE,saveChanges:bool=False)->int:
+        """upsertData for many rows with one executemany per chunk, returns how many rows were written."""
+        writtenRows=0
+        with self._savepoint():
+            for columnNames,values in self._rowsByColumns(tableName,rows,chunkSize):
+                self.cursor.executemany(self._upsertStatement(tableName,columnNames,conflictColumns,updateColumns),
+                                        values)
+                writtenRows+=self.cursor.rowcount
+        self._saveChanges(saveChanges)
+        return writtenRows
+
     @_checkTableExists
     def getAllData(self,tableName:str)->list[tuple[Any]] :
         self.cursor.execute(f"SELECT * FROM '{tableName}'")
@@ -210,6 +477,122 @@ class Database:
             self.connection.commit()
         self.connection.close()
 
+class DatabasePool:
+    """
+    Connections to one database file for a writer thread and concurrent readers.
+    The file is switched to WAL, where readers see the last commit instead of waiting
+    for a write in flight, with synchronous=NORMAL, which only syncs at checkpoints.
+    writer() lends the one writer connection to one thread at a time and commits what
+    the block wrote; reader() lends one of up to readerCount read-only connections.
+    Both are Database objects, and every connection waits up to busyTimeout seconds
+    for a lock held by another process. The connections live as long as the pool;
+    database_connections_opened_total counts every one it opens, and checkHealth
+    replaces those that stopped answering.
+    """
+    def __init__(self,dataBasePath:str,readerCount:int=POOL_READER_CONNECTIONS,
+                 busyTimeout:float=BUSY_TIMEOUT_SECONDS,metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.dataBasePath=dataBasePath
+        self.readerCount=readerCount
+        self.busyTimeout=busyTimeout
+        self.metrics=metrics
+        self._writerLock=threading.RLock()
+        self._writer=Database(dataBasePath,connection=self._connect(readOnly=False))
+        self._idleReaders:queue.LifoQueue[Database]=queue.LifoQueue()
+        self._openReaders=0
+        self._readersLock=threading.Lock()
+        self._closed=False
+
+    def _connect(self,readOnly:bool)->sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.dataBasePath), exist_ok=True)
+        connection=sqlite3.connect(self.dataBasePath,timeout=self.busyTimeout,check_same_thread=False,
+                                   detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={int(self.busyTimeout*1000)}")
+        if readOnly:
+            connection.execute("PRAGMA query_only=ON")
+        self.metrics.incrementCounter("database_connections_opened_total",role="reader" if readOnly else "writer")
+        return connection
+
+    @contextmanager
+    def writer(self)->Iterator[Database]:
+        """The writer connection; the block's writes are committed together, or undone if it raises."""
+        with self._writerLock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database pool.")
+            with self._writer.transaction():
+                yield self._writer
+
+    @contextmanager
+    def reader(self)->Iterator[Database]:
+        """A read-only connection, opened on first need; waits for one when readerCount are lent out."""
+        database=self._borrowReader()
+        try:
+            yield database
+        finally:
+            # a transaction left open would keep the connection reading an old snapshot
+            if database.connection.in_transaction:
+                database.connection.rollback()
+            if self._closed:
+                database.disconnect(False)
+            else:
+                self._idleReaders.put(database)
+
+    def _borrowReader(self)->Database:
+        with self._readersLock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database pool.")
+            if self._idleReaders.empty() and self._openReaders<self.readerCount:
+                self._openReaders+=1
+                return Database(self.dataBasePath,connection=self._connect(readOnly=True))
+        return self._idleReaders.get()
+
+    @staticmethod
+    def _isAlive(database:Database)->bool:
+        try:
+            database.connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def checkHealth(self)->bool:
+        """
+        Runs a trivial query on the writer and on the idle readers and opens a new
+        connection in place of each that fails. False when one had to be replaced.
+        """
+        healthy=True
+        with self._writerLock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database pool.")
+            if not self._isAlive(self._writer):
+                healthy=False
+                self.metrics.incrementCounter("database_connections_replaced_total",role="writer")
+                self._writer.connection.close()
+                self._writer=Database(self.dataBasePath,connection=self._connect(readOnly=False))
+        with self._readersLock:
+            idleReaders:list[Database]=[]
+            while not self._idleReaders.empty():
+                idleReaders.append(self._idleReaders.get_nowait())
+            for database in idleReaders:
+                if not self._isAlive(database):
+                    healthy=False
+                    self.metrics.incrementCounter("database_connections_replaced_total",role="reader")
+                    database.connection.close()
+                    database=Database(self.dataBasePath,connection=self._connect(readOnly=True))
+                self._idleReaders.put(database)
+        return healthy
+
+    def close(self)->None:
+        """Closes the writer and the idle readers; readers still lent out close when they come back."""
+        with self._writerLock, self._readersLock:
+            if self._closed:
+                return
+            self._closed=True
+            self._writer.disconnect(True)
+            while not self._idleReaders.empty():
+                self._idleReaders.get_nowait().disconnect(False)
+
+
 def test():      
     columnsAndDataTypes:dict[str,str]={"id" :"INTEGER PRIMARY KEY",
                                     "A": "TEXT"
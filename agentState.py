@@ -0,0 +1,13 @@
+from typing import TypedDict, Union
+from langchain_core.messages import HumanMessage, AIMessage
+
+
+class AgentState(TypedDict):
+    shortConversationHistory: list[Union[HumanMessage, AIMessage]]
+
+
+def updateShortConversationHistory(state:AgentState,newHumanMessage:HumanMessage,newAiMessage:AIMessage)->AgentState:
+    conversationHistory = state["shortConversationHistory"]
+    conversationHistory.append(newHumanMessage)
+    conversationHistory.append(newAiMessage)
+    return state
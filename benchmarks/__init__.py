@@ -0,0 +1,4 @@
+"""
+Offline end-to-end benchmarks of the chat loop in main.py and the agent in chat.py.
+Run with python -m benchmarks; see benchmarks/__main__.py for the options.
+"""
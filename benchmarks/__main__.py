@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import json
+import subprocess
+import tracemalloc
+from benchmarks.agentLoop import runAgentBenchmark
+from benchmarks.chatLoop import runChatLoopBenchmark
+from benchmarks.report import SessionTimings, buildReport, compareReports, loadReport
+from benchmarks.scriptedModel import ScriptedStreamingModel
+
+BENCHMARKS = {"chat": runChatLoopBenchmark, "agent": runAgentBenchmark}
+
+
+def getCommit() -> str|None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def runBenchmarks(names:list[str], turns:int, modelSettings:dict[str, float|int],
+                        question:str) -> list[SessionTimings]:
+    return [await BENCHMARKS[name](turns, modelSettings, question) for name in names]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the chat loop and the agent against a scripted model")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help=f"any of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--first-token-delay", type=float, default=ScriptedStreamingModel.model_fields["firstTokenDelay"].default)
+    parser.add_argument("--tokens-per-second", type=float, default=ScriptedStreamingModel.model_fields["tokensPerSecond"].default)
+    parser.add_argument("--response-tokens", type=int, default=ScriptedStreamingModel.model_fields["responseTokens"].default)
+    parser.add_argument("--question", default="What should I cook tonight with rice, eggs and spinach?")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report memory growth in bytes with tracemalloc, which slows every turn down")
+    parser.add_argument("--output", help="write the JSON report to this file instead of printing it")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    arguments = parser.parse_args()
+    unknownBenchmarks = set(arguments.benchmarks) - set(BENCHMARKS)
+    if unknownBenchmarks:
+        parser.error(f"unknown benchmarks {sorted(unknownBenchmarks)}")
+
+    modelSettings:dict[str, float|int] = {"firstTokenDelay": arguments.first_token_delay,
+                                          "tokensPerSecond": arguments.tokens_per_second,
+                                          "responseTokens": arguments.response_tokens}
+    if arguments.trace_memory:
+        tracemalloc.start()
+    sessions = asyncio.run(runBenchmarks(arguments.benchmarks, arguments.turns, modelSettings, arguments.question))
+    report = buildReport({**modelSettings, "turns": arguments.turns, "traceMemory": arguments.trace_memory},
+                         sessions, getCommit())
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as reportFile:
+            json.dump(report, reportFile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if arguments.baseline:
+        print(compareReports(loadReport(arguments.baseline), report))
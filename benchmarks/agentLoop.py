@@ -0,0 +1,34 @@
+import time
+from typing import Any
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from benchmarks.report import SessionTimings
+from benchmarks.scriptedModel import ScriptedStreamingModel
+
+
+async def runAgentBenchmark(turns:int, modelSettings:dict[str, Any], question:str) -> SessionTimings:
+    """Streams scripted turns through the agent of chat.py, which keeps the whole conversation in its messages."""
+    from chat import buildAgent
+
+    chatModel = ScriptedStreamingModel(**modelSettings, callSeconds=[])
+    agent = buildAgent(chatModel)
+    messages:list[BaseMessage] = []
+    timings = SessionTimings("agent")
+    startTime = time.perf_counter()
+    for _ in range(turns):
+        messages.append(HumanMessage(question))
+        turnStart = time.perf_counter()
+        firstTokenTime:float|None = None
+        aggregatedChunk:AIMessageChunk|None = None
+        async for chunk, _ in agent.astream({"messages": messages}, stream_mode="messages"): # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+            if not isinstance(chunk, AIMessageChunk):
+                continue
+            if firstTokenTime is None:
+                firstTokenTime = time.perf_counter()
+                timings.timeToFirstToken.append(firstTokenTime - turnStart)
+            aggregatedChunk = chunk if aggregatedChunk is None else aggregatedChunk + chunk
+        messages.append(AIMessage(aggregatedChunk.content if aggregatedChunk is not None else ""))
+        timings.turnLatency.append(time.perf_counter() - turnStart)
+        timings.sampleMemory(len(timings.turnLatency), turns)
+    timings.wallTimeSeconds = time.perf_counter() - startTime
+    timings.modelSeconds = list(chatModel.callSeconds)
+    return timings
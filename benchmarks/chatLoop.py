@@ -0,0 +1,97 @@
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from typing import Any
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from constants import HISTORY_DB_ENV_VARIABLE
+from metrics import metricsRegistry
+from benchmarks.report import SessionTimings
+from benchmarks.scriptedModel import ScriptedStreamingModel
+
+EMBEDDING_SIZE = 256
+
+
+def countConnectionsOpened() -> int:
+    return int(sum(metricsRegistry.getCounter("database_connections_opened_total", role=role)
+                   for role in ("reader", "writer")))
+
+
+async def runChatLoopBenchmark(turns:int, modelSettings:dict[str, Any], question:str) -> SessionTimings:
+    """
+    Drives the compiled graph of main.py for one session of scripted turns.
+    main reads the history database path when it is imported, so this has to run in
+    a process that has not imported main yet; the database lives in a temporary folder.
+    """
+    if "main" in sys.modules:
+        raise RuntimeError("the chat loop benchmark needs a process that has not imported main yet")
+    with tempfile.TemporaryDirectory() as temporaryFolder:
+        os.environ[HISTORY_DB_ENV_VARIABLE] = os.path.join(temporaryFolder, "conversation history.db")
+        import main
+        from chatEngine import EXIT_COMMAND
+        from chatGraph import chatEngineConfig
+        from checkpoints import getThreadId
+        from semanticMemory import SemanticMemoryIndex
+        from sessionDriver import SessionDriver
+
+        chatModel = ScriptedStreamingModel(**modelSettings, callSeconds=[])
+        main.gv.model = chatModel
+        main.gv.summaryModel = ScriptedStreamingModel(firstTokenDelay=0, responseTokens=20, token="summary ",
+                                                      callSeconds=[])
+        main.gv.semanticMemory = SemanticMemoryIndex(DeterministicFakeEmbedding(size=EMBEDDING_SIZE), "fake-embeddings")
+
+        timings = SessionTimings("chat")
+        turnStart:float|None = None
+        firstTokenTime:float|None = None
+
+        async def readInput() -> str:
+            nonlocal turnStart, firstTokenTime
+            if turnStart is not None:
+                timings.turnLatency.append(time.perf_counter() - turnStart)
+                timings.sampleMemory(len(timings.turnLatency), turns)
+            if len(timings.turnLatency) == turns:
+                return EXIT_COMMAND
+            turnStart, firstTokenTime = time.perf_counter(), None
+            return question
+
+        def writeOutput(piece:str) -> None:
+            nonlocal firstTokenTime
+            if firstTokenTime is None and turnStart is not None:
+                firstTokenTime = time.perf_counter()
+                timings.timeToFirstToken.append(firstTokenTime - turnStart)
+
+        main.chatEngine.readInput = readInput
+        main.chatEngine.writeOutput = writeOutput
+        main.chatEngine.onResponseComplete = lambda response: None
+
+        main.prepareUser()
+        main.loadChatModel()
+        main.loadSemanticMemory()
+        checkpointer = await main.openCheckpoints()
+        initialState = await main.loadInitialState(checkpointer)
+        compiledGraph = main.loadChatGraph(checkpointer)
+        main.persistenceQueue.start()
+        main.memoryIndexer.start()
+        connectionsAtStart = countConnectionsOpened()
+        startTime = time.perf_counter()
+        try:
+            # the prompt reuse report of every turn is printed, like in the CLI, but not shown
+            with open(os.devnull, "w") as devNull, contextlib.redirect_stdout(devNull):
+                sessionDriver = SessionDriver(compiledGraph, chatEngineConfig(
+                    main.chatEngine, getThreadId(main.gv.userName, main.gv.conversationId)))
+                await sessionDriver.run(initialState)
+                await main.chatEngine.flushPendingWrites()
+        finally:
+            main.persistenceQueue.close()
+            main.memoryIndexer.close()
+            await main.summarizer.flush()
+            await checkpointer.close()
+            main.gv.closeHistoryPool()
+        timings.wallTimeSeconds = time.perf_counter() - startTime
+        timings.modelSeconds = list(chatModel.callSeconds)
+        flushSummary = metricsRegistry.getSummary("persistence_flush_seconds")
+        timings.dbWrites = flushSummary.count
+        timings.dbWriteSeconds = flushSummary.total
+        timings.dbConnectionsOpened = countConnectionsOpened() - connectionsAtStart
+        return timings
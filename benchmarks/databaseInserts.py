@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from DB import Database
+
+TABLE_NAME = "messages"
+COLUMNS = {"message_id": "INTEGER PRIMARY KEY", "conversation_id": "INTEGER NOT NULL", "sender": "TEXT",
+           "content": "TEXT"}
+
+
+def _row(index:int) -> dict[str, int|str]:
+    return {"conversation_id": index % 10, "sender": "user", "content": f"message {index}"}
+
+
+def timeRawInserts(path:str, rows:int) -> float:
+    """Seconds per row of plain sqlite3 inserts, the floor for Database.insertData."""
+    connection = sqlite3.connect(path)
+    connection.execute(f"CREATE TABLE {TABLE_NAME} ({', '.join(f'{name} {kind}' for name, kind in COLUMNS.items())})")
+    cursor = connection.cursor()
+    startTime = time.perf_counter()
+    for index in range(rows):
+        row = _row(index)
+        cursor.execute(f"INSERT INTO {TABLE_NAME} ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                       tuple(row.values()))
+    elapsed = time.perf_counter() - startTime
+    connection.commit()
+    connection.close()
+    return elapsed / rows
+
+
+def timeDatabaseInserts(path:str, rows:int) -> tuple[float, int]:
+    """Seconds per row of Database.insertData, and the statements each insert ran."""
+    database = Database(path)
+    database.createTable(TABLE_NAME, COLUMNS)
+    database.insertData(TABLE_NAME, _row(0))
+    statements:list[str] = []
+    database.connection.set_trace_callback(statements.append)
+    database.insertData(TABLE_NAME, _row(1))
+    database.connection.set_trace_callback(None)
+    startTime = time.perf_counter()
+    for index in range(2, rows + 2):
+        database.insertData(TABLE_NAME, _row(index))
+    elapsed = time.perf_counter() - startTime
+    database.disconnect(True)
+    return elapsed / rows, len(statements)
+
+
+def timeBulkInserts(path:str, rows:int) -> tuple[float, float]:
+    """Rows per second of Database.insertMany and of Database.insertReturningIds."""
+    database = Database(path)
+    database.createTable(TABLE_NAME, COLUMNS)
+    startTime = time.perf_counter()
+    database.insertMany(TABLE_NAME, (_row(index) for index in range(rows)), saveChanges=True)
+    insertManySeconds = time.perf_counter() - startTime
+    startTime = time.perf_counter()
+    database.insertReturningIds(TABLE_NAME, [_row(index) for index in range(rows)], saveChanges=True)
+    returningSeconds = time.perf_counter() - startTime
+    database.disconnect(False)
+    return rows / insertManySeconds, rows / returningSeconds
+
+
+def runInsertBenchmark(rows:int) -> dict[str, float|int]:
+    with tempfile.TemporaryDirectory() as temporaryFolder:
+        rawSeconds = timeRawInserts(os.path.join(temporaryFolder, "raw.db"), rows)
+        databaseSeconds, statementsPerInsert = timeDatabaseInserts(os.path.join(temporaryFolder, "database.db"), rows)
+        insertManyRate, returningRate = timeBulkInserts(os.path.join(temporaryFolder, "bulk.db"), rows)
+    return {"rows": rows, "rawInsertUs": round(rawSeconds * 1e6, 2), "databaseInsertUs": round(databaseSeconds * 1e6, 2),
+            "overheadRatio": round(databaseSeconds / rawSeconds, 2), "statementsPerInsert": statementsPerInsert,
+            "insertManyRowsPerSecond": round(insertManyRate), "insertReturningIdsRowsPerSecond": round(returningRate)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare Database inserts with plain sqlite3 inserts")
+    parser.add_argument("--rows", type=int, default=20000)
+    print(json.dumps(runInsertBenchmark(parser.parse_args().rows), indent=2))
@@ -0,0 +1,79 @@
+import json
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Any
+from loadTest import percentile
+
+# memory is sampled every this many turns, and after the first and the last turn
+MEMORY_SAMPLE_INTERVAL = 50
+
+
+@dataclass
+class SessionTimings:
+    """Timings of one benchmarked session, one entry per turn unless noted otherwise."""
+    name:str
+    timeToFirstToken:list[float] = field(default_factory=list[float], repr=False)
+    turnLatency:list[float] = field(default_factory=list[float], repr=False)
+    modelSeconds:list[float] = field(default_factory=list[float], repr=False)
+    # allocated blocks and, with tracemalloc running, traced bytes per sample
+    memoryBlocks:list[int] = field(default_factory=list[int], repr=False)
+    memoryBytes:list[int] = field(default_factory=list[int], repr=False)
+    dbWrites:int = 0
+    dbWriteSeconds:float = 0.0
+    # history database connections opened after startup, a session should open none
+    dbConnectionsOpened:int = 0
+    wallTimeSeconds:float = 0.0
+
+    def sampleMemory(self, completedTurns:int, totalTurns:int) -> None:
+        if completedTurns not in (1, totalTurns) and completedTurns % MEMORY_SAMPLE_INTERVAL != 0:
+            return
+        self.memoryBlocks.append(sys.getallocatedblocks())
+        if tracemalloc.is_tracing():
+            self.memoryBytes.append(tracemalloc.get_traced_memory()[0])
+
+    def summary(self) -> dict[str, Any]:
+        # the part of a turn spent in the graph, prompt building and persistence rather than the model
+        overhead = [latency - modelSeconds for latency, modelSeconds in zip(self.turnLatency, self.modelSeconds)]
+        summary:dict[str, Any] = {"turns": len(self.turnLatency),
+                                  "wallTimeSeconds": round(self.wallTimeSeconds, 3)}
+        for metricName, values in (("ttft", self.timeToFirstToken), ("turn", self.turnLatency),
+                                   ("overhead", overhead)):
+            for fraction in (0.50, 0.95, 0.99):
+                summary[f"{metricName}P{round(fraction * 100)}Ms"] = round(percentile(values, fraction) * 1000, 3)
+        summary["dbWrites"] = self.dbWrites
+        summary["dbWriteMsPerTurn"] = round(self.dbWriteSeconds * 1000 / max(len(self.turnLatency), 1), 3)
+        summary["dbConnectionsOpened"] = self.dbConnectionsOpened
+        if self.memoryBlocks:
+            summary["memoryGrowthBlocks"] = self.memoryBlocks[-1] - self.memoryBlocks[0]
+        if self.memoryBytes:
+            summary["memoryGrowthKiB"] = round((self.memoryBytes[-1] - self.memoryBytes[0]) / 1024, 1)
+        return summary
+
+
+def buildReport(settings:dict[str, Any], sessions:list[SessionTimings], commit:str|None) -> dict[str, Any]:
+    return {"commit": commit,
+            "createdAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "settings": settings,
+            "results": {session.name: session.summary() for session in sessions}}
+
+
+def compareReports(baseline:dict[str, Any], current:dict[str, Any]) -> str:
+    """One line per metric present in both reports, with the relative change against the baseline."""
+    lines = [f"compared with {baseline.get('commit') or 'baseline'}"]
+    for sessionName, results in current["results"].items():
+        baselineResults = baseline.get("results", {}).get(sessionName, {})
+        for metricName, value in results.items():
+            baselineValue = baselineResults.get(metricName)
+            if not isinstance(value, (int, float)) or not isinstance(baselineValue, (int, float)):
+                continue
+            change = f"{(value - baselineValue) / baselineValue:+.1%}" if baselineValue else "n/a"
+            lines.append(f"{sessionName}.{metricName}: {baselineValue} -> {value} ({change})")
+    return "\n".join(lines)
+
+
+def loadReport(path:str) -> dict[str, Any]:
+    with open(path, encoding="utf-8") as reportFile:
+        return json.load(reportFile)
@@ -0,0 +1,67 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Sequence
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.language_models.chat_models import generate_from_stream
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+
+
+class ScriptedStreamingModel(BaseChatModel):
+    """
+    Streams the same response of responseTokens tokens for every prompt, after
+    firstTokenDelay seconds and at tokensPerSecond, like a model that is already loaded.
+    The time spent inside each call is kept in callSeconds so benchmarks can tell the
+    model's share of a turn from the overhead around it.
+    """
+    firstTokenDelay:float = 0.01
+    tokensPerSecond:float = 2000.0
+    responseTokens:int = 40
+    token:str = "lorem "
+    callSeconds:list[float] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-fake"
+
+    def _chunk(self, tokenIndex:int) -> ChatGenerationChunk:
+        if tokenIndex < self.responseTokens - 1:
+            return ChatGenerationChunk(message=AIMessageChunk(self.token))
+        return ChatGenerationChunk(message=AIMessageChunk(self.token, usage_metadata={
+            "input_tokens": 0, "output_tokens": self.responseTokens, "total_tokens": self.responseTokens}))
+
+    def _stream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> Iterator[ChatGenerationChunk]:
+        startTime = time.perf_counter()
+        time.sleep(self.firstTokenDelay)
+        for tokenIndex in range(self.responseTokens):
+            if tokenIndex > 0:
+                time.sleep(1 / self.tokensPerSecond)
+            yield self._chunk(tokenIndex)
+        self.callSeconds.append(time.perf_counter() - startTime)
+
+    async def _astream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                       run_manager:AsyncCallbackManagerForLLMRun|None=None,
+                       **kwargs:Any) -> AsyncIterator[ChatGenerationChunk]:
+        startTime = time.perf_counter()
+        await asyncio.sleep(self.firstTokenDelay)
+        for tokenIndex in range(self.responseTokens):
+            if tokenIndex > 0:
+                await asyncio.sleep(1 / self.tokensPerSecond)
+            chunk = self._chunk(tokenIndex)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        self.callSeconds.append(time.perf_counter() - startTime)
+
+    def _generate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                  run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, **kwargs))
+
+    def bind_tools(self, tools:Sequence[dict[str, Any]|type|Callable[..., Any]|BaseTool],
+                   **kwargs:Any) -> Runnable[LanguageModelInput, AIMessage]:
+        # the script never calls tools, so an agent built on it answers in one model call
+        return self
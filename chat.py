@@ -1,50 +1,77 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_ollama import ChatOllama
-from langchain.agents import create_agent 
-from langchain_core.messages import HumanMessage,BaseMessage,AIMessageChunk,ToolMessage,message_to_dict
-from pprint import pprint
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage,HumanMessage,BaseMessage,AIMessageChunk,ToolMessage
+from pprint import pformat
 from tools.fileManager import readFile,writeFile,listDirectoryContent,createFolder
 from typing import Any
+from getpass import getuser
+import asyncio
 import os
+from providers import providerRegistry
+from routing import RoutingChatModel
+from tracing import TracingCallbackHandler
+from scheduler import RequestPriority, ScheduledChatModel, requestScheduler
+from streamingPipeline import StreamingPipeline, TerminalSink
 
-API_KEY = os.getenv("GOOGLE_API_KEY")
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro",google_api_key=API_KEY)
-localLlm = ChatOllama(model=r"qwen3-coder:latest")
-agent= create_agent(model=localLlm,tools=[readFile,writeFile,listDirectoryContent,createFolder]) 
-messages:list[BaseMessage]= []
-firstMessage = HumanMessage("write me some sample UI in Pyside6 with dynamic check boxes and text boxes that appears based on user input selection." \
-"Also Add good stying to the user interface")
-
-messages.append(firstMessage)
-responseChunk = agent.stream({"messages":messages},stream_mode="messages") # pyright: ignore[reportUnknownMemberType]
-for chunk in responseChunk:
-    responseChunk = chunk[0]
-    langGraphInfoChunk = chunk[1]
-
-    contentChunk:Any = responseChunk.content
-    
-    if hasattr(responseChunk,"tool_calls") and len(responseChunk.tool_calls)>0:
-        toolInfo = responseChunk.tool_calls[0]
-        print("")
-        print("Calling Tool")
-        print(f"Tool Name: {toolInfo["name"]}")
-        print(f"Tool Args: ")
-        pprint(toolInfo["args"])
-    if isinstance(responseChunk,ToolMessage):
-        print(f"Tool Message : {contentChunk}")
-
-
-    if isinstance(responseChunk,AIMessageChunk):
-        if isinstance(contentChunk,str) :
-            if contentChunk.strip()=="":
-                continue
-            else:
-                print(contentChunk,end ="")
-        elif isinstance(contentChunk,list) and len(contentChunk)>0:
-            data = contentChunk[0]
-            if isinstance(data,dict) :
-                #print(f"output data type :{data.get("type")}")
-                print(f"{data.get("text")}",end="")
-        
-    
+LOCAL_MODEL_NAME = r"qwen3-coder:latest"
+GEMINI_MODEL_NAME = "gemini-2.5-pro"
+FIRST_MESSAGE = "write me some sample UI in Pyside6 with dynamic check boxes and text boxes that appears based on user input selection." \
+"Also Add good stying to the user interface"
 
+
+def getLocalLlm()->BaseChatModel:
+    return ScheduledChatModel(innerModel=providerRegistry.getChatModel("ollama",LOCAL_MODEL_NAME),
+                              scheduler=requestScheduler,userName=getuser(),priority=RequestPriority.AGENT)
+
+
+def getGeminiLlm()->BaseChatModel:
+    return providerRegistry.getChatModel("gemini",GEMINI_MODEL_NAME)
+
+
+def getAgentLlm()->BaseChatModel:
+    # Gemini only takes part, as the hedge behind the local model, when an API key is configured
+    if os.getenv("GOOGLE_API_KEY") is None:
+        return getLocalLlm()
+    return RoutingChatModel(providers={"ollama":getLocalLlm(),"gemini":getGeminiLlm()})
+
+
+def buildAgent(model:BaseChatModel):
+    # langchain.agents pulls in most of LangGraph, so it is only imported when an agent is built
+    from langchain.agents import create_agent
+    return create_agent(model=model,tools=[readFile,writeFile,listDirectoryContent,createFolder])
+
+
+def renderAgentMessage(message:BaseMessage)->str:
+    """Console text of one message of the agent's stream."""
+    if isinstance(message,ToolMessage):
+        return f"Tool Message : {message.content}\n"
+    if not isinstance(message,AIMessageChunk):
+        return ""
+    text = ""
+    if len(message.tool_calls)>0:
+        toolInfo = message.tool_calls[0]
+        text = f"\nCalling Tool\nTool Name: {toolInfo["name"]}\nTool Args: \n{pformat(toolInfo["args"])}\n"
+    content:Any = message.content
+    if isinstance(content,str):
+        return text if content.strip()=="" else text+content
+    if isinstance(content,list) and len(content)>0 and isinstance(content[0],dict):
+        text += f"{content[0].get("text")}"
+    return text
+
+
+async def main():
+    agent = buildAgent(getAgentLlm())
+    messages:list[BaseMessage]= []
+    messages.append(HumanMessage(FIRST_MESSAGE))
+    outputPipeline = StreamingPipeline([TerminalSink()])
+    try:
+        # every tool call gets its own span, see tracing.py
+        async for message,langGraphInfo in agent.astream({"messages":messages},{"callbacks":[TracingCallbackHandler()]}, # pyright: ignore[reportUnknownMemberType]
+                                                         stream_mode="messages"):
+            outputPipeline.write(renderAgentMessage(message))
+        outputPipeline.endResponse(AIMessage(""))
+    finally:
+        await outputPipeline.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,315 @@
+import asyncio
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import aclosing
+from types import FrameType
+from typing import Awaitable, Callable
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.messages.ai import add_ai_message_chunks
+from agentState import AgentState
+from constants import PARTIAL_RESPONSE_SAVE_INTERVAL_SECONDS, RESPONSE_RESUME_DELAY_SECONDS
+from tracing import Span, Tracer, responseAttributes, tracer as defaultTracer
+
+EXIT_COMMAND = "exit"
+INPUT_PROMPT = "Enter your input: "
+
+PromptPart = str | BaseMessage
+# response_metadata of a response that was stopped before the model finished it
+TRUNCATED_METADATA_KEY = "truncated"
+STOP_REASON_METADATA_KEY = "stop_reason"
+STOP_REASON_CANCELLED = "cancelled"
+STOP_REASON_TIMEOUT = "timeout"
+# Ollama's done_reason when num_predict ended the response
+STOP_REASON_LENGTH = "length"
+# response_metadata count of the times a failed stream was continued from its partial answer
+RESUMED_METADATA_KEY = "resumed"
+
+
+def isTruncated(response: AIMessage) -> bool:
+    return bool(response.response_metadata.get(TRUNCATED_METADATA_KEY))
+
+
+async def readConsoleInput() -> str:
+    return await asyncio.to_thread(input, INPUT_PROMPT)
+
+def writeConsoleOutput(piece: str) -> None:
+    print(piece, end="", flush=True)
+
+def endConsoleResponse(response: AIMessage) -> None:
+    print(f" [stopped: {response.response_metadata[STOP_REASON_METADATA_KEY]}]" if isTruncated(response) else "")
+
+
+class ChatEngine:
+    """
+    Non-blocking core of a chat turn.
+    User input is read while the prompt prefix for the turn is assembled, tokens are
+    streamed with astream and the finished turn is persisted by a background task so
+    the next prompt is shown without waiting for the database.
+    A response can be cancelled while it streams, or stopped by responseTimeout; the
+    part received so far is kept in the history and persisted, marked as truncated.
+    The answer being streamed is handed to saveProgress every progressInterval seconds,
+    and to saveProgress with None once the turn is recorded. recordTurn may return a
+    future for a write it only queued: the saved part is then deleted once the future
+    is done, and kept when it fails. A stream that fails midway
+    is requested again up to resumeAttempts times with the partial answer as a trailing
+    assistant message, which the model continues instead of starting over.
+    """
+    def __init__(self,
+                 getModel: Callable[[], BaseChatModel],
+                 buildPromptPrefix: Callable[[AgentState], list[PromptPart]],
+                 buildPromptSuffix: Callable[[HumanMessage], list[PromptPart]],
+                 updateHistory: Callable[[AgentState, HumanMessage, AIMessage], AgentState],
+                 recordTurn: Callable[[HumanMessage, AIMessage], Future[None] | None],
+                 readInput: Callable[[], Awaitable[str]] = readConsoleInput,
+                 writeOutput: Callable[[str], None] = writeConsoleOutput,
+                 onResponseComplete: Callable[[AIMessage], None] = endConsoleResponse,
+                 observeTurn: Callable[[list[PromptPart], AIMessage], object] | None = None,
+                 tracer: Tracer = defaultTracer,
+                 responseTimeout: float | None = None,
+                 saveProgress: Callable[[HumanMessage, str | None], None] | None = None,
+                 progressInterval: float = PARTIAL_RESPONSE_SAVE_INTERVAL_SECONDS,
+                 resumeAttempts: int = 0,
+                 resumeDelay: float = RESPONSE_RESUME_DELAY_SECONDS) -> None:
+        self.getModel = getModel
+        self.buildPromptPrefix = buildPromptPrefix
+        self.buildPromptSuffix = buildPromptSuffix
+        self.updateHistory = updateHistory
+        self.recordTurn = recordTurn
+        self.readInput = readInput
+        self.writeOutput = writeOutput
+        self.onResponseComplete = onResponseComplete
+        self.observeTurn = observeTurn
+        self.tracer = tracer
+        self.responseTimeout = responseTimeout
+        self.saveProgress = saveProgress
+        self.progressInterval = progressInterval
+        self.resumeAttempts = resumeAttempts
+        self.resumeDelay = resumeDelay
+        self._progressSaved = False
+        self._responseTask: asyncio.Task[None] | None = None
+        self._pendingWrites: set[asyncio.Task[None]] = set()
+        self._writeLock = asyncio.Lock()
+
+    def _buildPrefix(self, state: AgentState) -> list[PromptPart]:
+        with self.tracer.span("prompt.prefix"):
+            return self.buildPromptPrefix(state)
+
+    def _buildSuffix(self, humanMessage: HumanMessage) -> list[PromptPart]:
+        with self.tracer.span("prompt.suffix"):
+            return self.buildPromptSuffix(humanMessage)
+
+    async def runTurn(self, state: AgentState) -> AgentState:
+        prefixTask = asyncio.create_task(asyncio.to_thread(self._buildPrefix, state))
+        try:
+            currentUserInput = await self.readInput()
+        except BaseException:
+            prefixTask.cancel()
+            raise
+
+        if currentUserInput.lower() == EXIT_COMMAND:
+            prefixTask.cancel()
+            await self.flushPendingWrites()
+            state["shortConversationHistory"].append(HumanMessage(EXIT_COMMAND))
+            return state
+
+        with self.tracer.span("turn"):
+            currentHumanMessage = HumanMessage(content=currentUserInput)
+            # the suffix may look up recalled context, which blocks on the embedding model
+            with self.tracer.span("prompt.wait"):
+                currentPrompt = [*await prefixTask, *await asyncio.to_thread(self._buildSuffix, currentHumanMessage)]
+            fullResponse = await self.streamResponse(currentPrompt, currentHumanMessage)
+            return self._finishTurn(state, currentPrompt, currentHumanMessage, fullResponse)
+
+    async def resumeTurn(self, state: AgentState, humanMessage: HumanMessage, partialText: str) -> AgentState:
+        """Finishes a turn whose answer was cut off when the last session died, continuing its saved part."""
+        with self.tracer.span("turn", resumed=True):
+            prompt = [*await asyncio.to_thread(self._buildPrefix, state),
+                      *await asyncio.to_thread(self._buildSuffix, humanMessage)]
+            self.writeOutput(partialText)
+            # the saved part is deleted once the finished turn is recorded
+            self._progressSaved = True
+            fullResponse = await self.streamResponse(prompt, humanMessage, partialText)
+            return self._finishTurn(state, prompt, humanMessage, fullResponse)
+
+    def _finishTurn(self, state: AgentState, prompt: list[PromptPart], humanMessage: HumanMessage,
+                    response: AIMessage) -> AgentState:
+        if self.observeTurn is not None:
+            self.observeTurn(prompt, response)
+
+        self._schedulePersistence(humanMessage, response)
+        with self.tracer.span("history.update"):
+            return self.updateHistory(state, humanMessage, response)
+
+    @property
+    def isResponding(self) -> bool:
+        return self._responseTask is not None and not self._responseTask.done()
+
+    def cancelResponse(self) -> bool:
+        """Stops the response being streamed, returns whether there was one. Call it from the event loop."""
+        if self._responseTask is None or self._responseTask.done():
+            return False
+        self._responseTask.cancel()
+        return True
+
+    def installInterruptHandler(self) -> None:
+        """Ctrl-C cancels the response being streamed, and interrupts the program as before otherwise."""
+        loop = asyncio.get_running_loop()
+        previousHandler = signal.getsignal(signal.SIGINT)
+
+        def onInterrupt(signalNumber: int, frame: FrameType | None) -> None:
+            if self.isResponding:
+                loop.call_soon_threadsafe(self.cancelResponse)
+            elif callable(previousHandler):
+                previousHandler(signalNumber, frame)
+            else:
+                raise KeyboardInterrupt
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, onInterrupt)
+
+    @staticmethod
+    def _partialText(receivedChunks: list[AIMessageChunk]) -> str:
+        return "".join(chunk.content for chunk in receivedChunks) # pyright: ignore[reportArgumentType]
+
+    def _continuationPrompt(self, prompt: list[PromptPart], receivedChunks: list[AIMessageChunk]) -> list[PromptPart]:
+        partialText = self._partialText(receivedChunks)
+        return [*prompt, AIMessage(partialText)] if partialText else prompt
+
+    async def _receiveChunks(self, prompt: list[PromptPart], receivedChunks: list[AIMessageChunk],
+                             humanMessage: HumanMessage | None) -> int:
+        """Streams the response into receivedChunks, returns how many times a failed stream was continued."""
+        # from sending the request until the first chunk arrives
+        firstChunkSpan: Span | None = self.tracer.startSpan("llm.first_chunk")
+        lastSaveTime = time.monotonic()
+        resumedCount = 0
+        try:
+            while True:
+                try:
+                    # closing the stream closes the HTTP response, which makes Ollama stop generating
+                    async with aclosing(self.getModel().astream( # pyright: ignore[reportArgumentType]
+                            self._continuationPrompt(prompt, receivedChunks))) as chunks:
+                        async for chunk in chunks:
+                            if firstChunkSpan is not None:
+                                self.tracer.endSpan(firstChunkSpan)
+                                firstChunkSpan = None
+                            if not isinstance(chunk.content, str):
+                                raise TypeError(f"stream returned unknown datatype")
+                            self.writeOutput(chunk.content)
+                            receivedChunks.append(chunk)
+                            if humanMessage is not None and time.monotonic() - lastSaveTime >= self.progressInterval:
+                                lastSaveTime = time.monotonic()
+                                self._scheduleProgressSave(humanMessage, receivedChunks)
+                    break
+                except TypeError:
+                    raise
+                except Exception:
+                    if resumedCount >= self.resumeAttempts:
+                        raise
+                    resumedCount += 1
+                    self.tracer.metrics.incrementCounter("responses_resumed_total")
+                    if humanMessage is not None:
+                        self._scheduleProgressSave(humanMessage, receivedChunks)
+                    await asyncio.sleep(self.resumeDelay)
+        except BaseException as error:
+            if firstChunkSpan is not None:
+                self.tracer.endSpan(firstChunkSpan, error)
+            raise
+        if firstChunkSpan is not None:
+            self.tracer.endSpan(firstChunkSpan)
+        return resumedCount
+
+    async def streamResponse(self, prompt: list[PromptPart], humanMessage: HumanMessage | None = None,
+                             partialText: str = "") -> AIMessage:
+        """Streams the answer to prompt; progress is only saved for the answer to a humanMessage."""
+        receivedChunks: list[AIMessageChunk] = [AIMessageChunk(content=partialText)] if partialText else []
+        stopReason: str | None = None
+        resumedCount = 0
+        with self.tracer.span("llm.stream") as streamSpan:
+            responseTask = self._responseTask = asyncio.create_task(
+                self._receiveChunks(prompt, receivedChunks, humanMessage))
+            try:
+                finished, _ = await asyncio.wait([responseTask], timeout=self.responseTimeout)
+                if not finished:
+                    stopReason = STOP_REASON_TIMEOUT
+                    responseTask.cancel()
+                    await asyncio.gather(responseTask, return_exceptions=True)
+                elif responseTask.cancelled():
+                    stopReason = STOP_REASON_CANCELLED
+                else:
+                    resumedCount = responseTask.result()
+            except BaseException:
+                responseTask.cancel()
+                raise
+            finally:
+                self._responseTask = None
+
+            if not receivedChunks:
+                fullResponse = AIMessage(content="")
+            else:
+                aggregatedChunk = add_ai_message_chunks(*receivedChunks)
+                fullResponse = AIMessage(content=aggregatedChunk.content,
+                                         response_metadata=aggregatedChunk.response_metadata,
+                                         usage_metadata=aggregatedChunk.usage_metadata)
+            if resumedCount:
+                fullResponse.response_metadata[RESUMED_METADATA_KEY] = resumedCount
+                streamSpan.attributes[RESUMED_METADATA_KEY] = resumedCount
+            if stopReason is None and fullResponse.response_metadata.get("done_reason") == STOP_REASON_LENGTH:
+                stopReason = STOP_REASON_LENGTH
+            if stopReason is not None:
+                fullResponse.response_metadata[TRUNCATED_METADATA_KEY] = True
+                fullResponse.response_metadata[STOP_REASON_METADATA_KEY] = stopReason
+                self.tracer.metrics.incrementCounter("responses_truncated_total", reason=stopReason)
+                streamSpan.attributes[STOP_REASON_METADATA_KEY] = stopReason
+            streamSpan.attributes.update(responseAttributes(fullResponse))
+        self.onResponseComplete(fullResponse)
+        return fullResponse
+
+    def _schedulePersistence(self, humanMessage: HumanMessage, aiMessage: AIMessage) -> None:
+        self._trackWrite(asyncio.create_task(self._persist(humanMessage, aiMessage, self._progressSaved)))
+        self._progressSaved = False
+
+    def _scheduleProgressSave(self, humanMessage: HumanMessage, receivedChunks: list[AIMessageChunk]) -> None:
+        if self.saveProgress is None:
+            return
+        self._progressSaved = True
+        self._trackWrite(asyncio.create_task(self._saveProgress(humanMessage, self._partialText(receivedChunks))))
+
+    def _trackWrite(self, task: asyncio.Task[None]) -> None:
+        self._pendingWrites.add(task)
+        task.add_done_callback(self._onPersistenceDone)
+
+    def _onPersistenceDone(self, task: asyncio.Task[None]) -> None:
+        # failed writes stay pending so flushPendingWrites re-raises them
+        if task.cancelled() or task.exception() is None:
+            self._pendingWrites.discard(task)
+
+    async def _persist(self, humanMessage: HumanMessage, aiMessage: AIMessage, clearProgress: bool) -> None:
+        # turns are written one at a time so rows keep the conversation order
+        async with self._writeLock:
+            with self.tracer.span("db.record"):
+                recorded = await asyncio.to_thread(self.recordTurn, humanMessage, aiMessage)
+            # only answers that outlasted progressInterval left a partial answer to delete
+            if not clearProgress or self.saveProgress is None:
+                return
+            if recorded is not None:
+                try:
+                    await asyncio.wrap_future(recorded)
+                except Exception:
+                    # the turn did not reach the database, so its partial answer is kept; the writer reports why
+                    self.tracer.metrics.incrementCounter("partial_responses_kept_total")
+                    return
+            await asyncio.to_thread(self.saveProgress, humanMessage, None)
+
+    async def _saveProgress(self, humanMessage: HumanMessage, partialText: str) -> None:
+        # shares the lock with _persist, so a late save can't outlive the turn's cleanup
+        async with self._writeLock:
+            await asyncio.to_thread(self.saveProgress, humanMessage, partialText) # pyright: ignore[reportArgumentType]
+
+    async def flushPendingWrites(self) -> None:
+        pendingWrites = list(self._pendingWrites)
+        self._pendingWrites.clear()
+        if pendingWrites:
+            await asyncio.gather(*pendingWrites)
@@ -0,0 +1,48 @@
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.graph import StateGraph, START, END
+from langgraph.graph.state import CompiledStateGraph
+from agentState import AgentState
+from chatEngine import ChatEngine, EXIT_COMMAND
+
+CHAT_ENGINE_CONFIG_KEY = "chatEngine"
+
+
+def chatEngineConfig(chatEngine:ChatEngine, threadId:str|None=None, **configValues:object) -> RunnableConfig:
+    """threadId selects the checkpoint thread when the graph was compiled with a checkpointer."""
+    configurable:dict[str, object] = {CHAT_ENGINE_CONFIG_KEY:chatEngine}
+    if threadId is not None:
+        configurable["thread_id"] = threadId
+    return RunnableConfig(configurable=configurable, **configValues) # pyright: ignore[reportArgumentType]
+
+
+async def chatToLlm(state: AgentState, config: RunnableConfig) -> AgentState:
+    chatEngine:ChatEngine = config["configurable"][CHAT_ENGINE_CONFIG_KEY] # pyright: ignore[reportTypedDictNotRequiredAccess]
+    return await chatEngine.runTurn(state)
+
+
+def isEndLoop (state:AgentState)->bool:
+    conversation=state["shortConversationHistory"]
+    if conversation and isinstance(conversation[-1],HumanMessage):
+        if conversation[-1].content==EXIT_COMMAND : # pyright: ignore[reportUnknownMemberType]
+            state["shortConversationHistory"].pop()
+            return True
+    return False
+
+
+def buildChatGraph(checkpointer:BaseCheckpointSaver|None=None) -> CompiledStateGraph:  # pyright: ignore[reportMissingTypeArgument]
+    """
+    The AgentState graph shared by the CLI and the server, one invocation runs one turn.
+    The engine driving the turns comes from the run config, so one compiled graph
+    serves every session; SessionDriver invokes it until the user exits. With a
+    checkpointer the state is saved after every turn.
+    """
+    graph = StateGraph(state_schema=AgentState)
+
+    graph.add_node(chatToLlm.__name__, chatToLlm) # pyright: ignore[reportUnknownMemberType]
+
+    graph.add_edge(start_key=START, end_key=chatToLlm.__name__)
+    graph.add_edge(start_key=chatToLlm.__name__, end_key=END)
+
+    return graph.compile(checkpointer=checkpointer) # pyright: ignore[reportUnknownMemberType]
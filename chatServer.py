@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import uuid
+from concurrent.futures import Future
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from constants import (CHAT_SERVER_HOST, CHAT_SERVER_PORT, GENERATION_PROFILES_ENABLED, MODEL_KEEP_ALIVE,
+                       MODEL_NAME, PROMPT_LAYOUT, RESPONSE_NUM_PREDICT, RESPONSE_RESUME_ATTEMPTS, RESPONSE_TIMEOUT_SECONDS,
+                       SUMMARY_MODEL_NAME,
+                       SUMMARY_TOKEN_RESERVE, SYSTEM_PROMPT)
+from globals import (createConversation, getConversationHistoryDbPath, getMessageRows, getOrCreateUserId,
+                     getPastMessages, openConversationHistoryPool, updateConversationDescription)
+from agentState import AgentState
+from DB import DatabasePool
+from contextWindow import CalibratedTokenEstimator, CharRatioCalibrationStore, ContextWindowManager, getNumCtx
+from chatEngine import ChatEngine, EXIT_COMMAND, isTruncated
+from chatGraph import buildChatGraph, chatEngineConfig
+from httpUtils import ChunkedResponse, HttpError, HttpRequest, formatServerSentEvent, startHttpServer, writeResponse
+from generationProfiles import ProfiledChatModel
+from promptBuilder import PromptReuseTracker, createPromptBuilder
+from scheduler import RequestPriority, RequestScheduler, ScheduledChatModel, requestScheduler
+from summarizer import RollingSummarizer
+from persistenceQueue import WriteBehindQueue
+from sessionDriver import SessionDriver
+from startup import StartupOrchestrator, preloadModel
+from providers import providerRegistry
+from tracing import TracingCallbackHandler, serveMetrics
+
+
+class SessionNotFoundError(Exception):...
+
+
+class ChatSession:
+    """
+    One user conversation hosted by the server.
+    Messages arrive through the inbox and the streamed answer of the current turn is
+    handed to the request waiting on the outbox.
+    """
+    def __init__(self, server:"ChatServer", sessionId:str, userName:str, userId:int, conversationId:int,
+                 pastMessages:list[HumanMessage|AIMessage]) -> None:
+        self.server = server
+        self.sessionId = sessionId
+        self.userName = userName
+        self.userId = userId
+        self.conversationId = conversationId
+        self.state = AgentState(shortConversationHistory=pastMessages)
+        self.inbox:asyncio.Queue[str] = asyncio.Queue()
+        self.outbox:asyncio.Queue[str|AIMessage|BaseException]|None = None
+        self.turnLock = asyncio.Lock()
+        self.summarizer:RollingSummarizer|None = None
+        summaryTokens = 0
+        if server.summaryModel is not None:
+            summaryModel = ScheduledChatModel(innerModel=server.summaryModel, scheduler=server.scheduler,
+                                              userName=userName, priority=RequestPriority.BATCH)
+            self.summarizer = RollingSummarizer(lambda: summaryModel, self.persistSummary)
+            summaryTokens = SUMMARY_TOKEN_RESERVE
+        self.promptBuilder = createPromptBuilder(SystemMessage(SYSTEM_PROMPT), PROMPT_LAYOUT,
+                                                 lambda: self.summarizer.summaryMessage if self.summarizer else None)
+        self.promptReuseTracker = PromptReuseTracker(estimator=server.tokenEstimator)
+        self.contextWindowManager = ContextWindowManager(
+            getNumCtx(server.model), server.tokenEstimator,
+            fixedPromptTokens=server.tokenEstimator.estimate(SYSTEM_PROMPT) + summaryTokens,
+            onEvicted=self.summarizer.scheduleFold if self.summarizer else None)
+        self.contextWindowManager.fit(self.state)
+        self.model = ScheduledChatModel(innerModel=server.model, scheduler=server.scheduler,
+                                        userName=userName, priority=RequestPriority.INTERACTIVE)
+        self.engine = ChatEngine(getModel=lambda: self.model,
+                                 buildPromptPrefix=self.promptBuilder.buildPrefix,
+                                 buildPromptSuffix=self.promptBuilder.buildSuffix,
+                                 updateHistory=self.contextWindowManager.updateHistory,
+                                 recordTurn=self.recordTurn,
+                                 readInput=self.inbox.get,
+                                 writeOutput=self._writePiece,
+                                 onResponseComplete=self._endResponse,
+                                 observeTurn=self.promptReuseTracker.recordTurn,
+                                 responseTimeout=RESPONSE_TIMEOUT_SECONDS,
+                                 resumeAttempts=RESPONSE_RESUME_ATTEMPTS)
+        self.graphTask:asyncio.Task[object]|None = None
+
+    def start(self) -> None:
+        config = chatEngineConfig(self.engine, callbacks=[TracingCallbackHandler()])
+        self.graphTask = asyncio.create_task(SessionDriver(self.server.compiledGraph, config).run(self.state))
+        self.graphTask.add_done_callback(self._onGraphDone)
+
+    def recordTurn(self, humanMessage:HumanMessage, aiMessage:AIMessage) -> Future[None]:
+        return self.server.persistenceQueue.enqueue(getMessageRows(self.conversationId, self.userName,
+                                                            self.server.modelName, humanMessage, aiMessage))
+
+    def persistSummary(self, summary:str) -> None:
+        with self.server.historyPool.writer() as database:
+            updateConversationDescription(database, self.conversationId, summary)
+
+    def _writePiece(self, piece:str) -> None:
+        if self.outbox is not None:
+            self.outbox.put_nowait(piece)
+
+    def _endResponse(self, response:AIMessage) -> None:
+        if self.outbox is not None:
+            self.outbox.put_nowait(response)
+
+    def _onGraphDone(self, task:asyncio.Task[object]) -> None:
+        if self.outbox is None:
+            return
+        if task.cancelled():
+            self.outbox.put_nowait(asyncio.CancelledError())
+        elif (error := task.exception()) is not None:
+            self.outbox.put_nowait(error)
+
+    async def streamTurn(self, content:str, response:ChunkedResponse) -> None:
+        async with self.turnLock:
+            if self.graphTask is None or self.graphTask.done():
+                raise HttpError(409, f"Session {self.sessionId} has ended")
+            self.outbox = asyncio.Queue()
+            await self.inbox.put(content)
+            await response.start(contentType="text/event-stream", extraHeaders={"Cache-Control": "no-cache"})
+            try:
+                while True:
+                    item = await self.outbox.get()
+                    if isinstance(item, str):
+                        await response.write(formatServerSentEvent({"content": item}, "token"))
+                    elif isinstance(item, AIMessage):
+                        await response.write(formatServerSentEvent({"content": item.content,
+                                                                    "truncated": isTruncated(item)}, "done"))
+                        break
+                    else:
+                        await response.write(formatServerSentEvent({"error": repr(item)}, "error"))
+                        break
+            finally:
+                self.outbox = None
+            await response.end()
+
+    def cancelResponse(self) -> bool:
+        return self.engine.cancelResponse()
+
+    async def close(self) -> None:
+        if self.graphTask is not None and not self.graphTask.done():
+            await self.inbox.put(EXIT_COMMAND)
+            await self.graphTask
+        await self.engine.flushPendingWrites()
+        if self.summarizer is not None:
+            await self.summarizer.flush()
+
+
+class ChatServer:
+    """
+    Hosts many concurrent chat sessions over one compiled AgentState graph.
+    Every session gets its own users/conversations rows in the history database.
+
+    POST   /sessions                  {"userName": "..."} -> session id
+    POST   /sessions/{id}/messages    {"content": "..."} -> server-sent token events
+    POST   /sessions/{id}/cancel      stops the response being streamed, it ends as truncated
+    DELETE /sessions/{id}
+    GET    /health
+    """
+    def __init__(self, model:BaseChatModel, modelName:str=MODEL_NAME, dataBasePath:str|None=None,
+                 scheduler:RequestScheduler=requestScheduler, summaryModel:BaseChatModel|None=None) -> None:
+        self.model = model
+        self.summaryModel = summaryModel
+        self.scheduler = scheduler
+        self.modelName = modelName
+        self.dataBasePath = dataBasePath or getConversationHistoryDbPath()
+        self.tokenEstimator = CalibratedTokenEstimator(modelName, CharRatioCalibrationStore())
+        self.compiledGraph = buildChatGraph()
+        self._historyPool:DatabasePool|None = None
+        # turns of all sessions share one writer, so concurrent sessions batch into the same transactions
+        self.persistenceQueue = WriteBehindQueue(lambda: self.historyPool.writer())
+        self.sessions:dict[str, ChatSession] = {}
+        self.server:asyncio.Server|None = None
+
+    @property
+    def historyPool(self) -> DatabasePool:
+        """Connections to the history database; sessions read it while the persistence queue writes."""
+        if self._historyPool is None:
+            raise RuntimeError("the chat server has not been started")
+        return self._historyPool
+
+    async def start(self, host:str=CHAT_SERVER_HOST, port:int=CHAT_SERVER_PORT) -> str:
+        self._historyPool = await asyncio.to_thread(openConversationHistoryPool, self.dataBasePath)
+        self.persistenceQueue.start()
+        self.server = await startHttpServer(self.handleRequest, host, port)
+        boundPort = self.server.sockets[0].getsockname()[1]
+        return f"http://{host}:{boundPort}"
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(session.close() for session in list(self.sessions.values())))
+        self.sessions.clear()
+        await asyncio.to_thread(self.persistenceQueue.close)
+        if self._historyPool is not None:
+            await asyncio.to_thread(self._historyPool.close)
+        if self.server is not None:
+            self.server.close()
+            self.server.close_clients()
+            await self.server.wait_closed()
+
+    async def createSession(self, userName:str) -> ChatSession:
+        def prepareRows() -> tuple[int, int, list[HumanMessage|AIMessage]]:
+            with self.historyPool.reader() as database:
+                pastMessages = getPastMessages(database, userName, 10)
+            with self.historyPool.writer() as database:
+                userId = getOrCreateUserId(database, userName)
+                return userId, createConversation(database, userId), pastMessages
+
+        userId, conversationId, pastMessages = await asyncio.to_thread(prepareRows)
+        session = ChatSession(self, uuid.uuid4().hex, userName, userId, conversationId, pastMessages)
+        self.sessions[session.sessionId] = session
+        session.start()
+        return session
+
+    def getSession(self, sessionId:str) -> ChatSession:
+        try:
+            return self.sessions[sessionId]
+        except KeyError:
+            raise SessionNotFoundError(f"Session {sessionId} not found")
+
+    async def closeSession(self, sessionId:str) -> None:
+        session = self.getSession(sessionId)
+        del self.sessions[sessionId]
+        await session.close()
+
+    async def handleRequest(self, request:HttpRequest, writer:asyncio.StreamWriter) -> None:
+        pathParts = [part for part in request.path.split("/") if part]
+        try:
+            if pathParts == ["health"]:
+                # a history connection that stopped answering is replaced before it fails a turn
+                databaseHealthy = await asyncio.to_thread(self.historyPool.checkHealth)
+                await writeResponse(writer, 200, {"status": "ok", "sessions": len(self.sessions),
+                                                  "database": "ok" if databaseHealthy else "reconnected"})
+            elif pathParts == ["metrics"]:
+                await serveMetrics(request, writer)
+            elif pathParts == ["sessions"] and request.method == "POST":
+                userName = str(request.json().get("userName", "")).strip()
+                if userName == "":
+                    raise HttpError(400, "userName is required")
+                session = await self.createSession(userName)
+                await writeResponse(writer, 201, {"sessionId": session.sessionId,
+                                                  "conversationId": session.conversationId})
+            elif len(pathParts) == 3 and pathParts[0] == "sessions" and pathParts[2] == "messages" \
+                    and request.method == "POST":
+                content = str(request.json().get("content", ""))
+                if content.strip() == "" or content.lower() == EXIT_COMMAND:
+                    raise HttpError(400, "content must be a non-empty message")
+                await self.getSession(pathParts[1]).streamTurn(content, ChunkedResponse(writer))
+            elif len(pathParts) == 3 and pathParts[0] == "sessions" and pathParts[2] == "cancel" \
+                    and request.method == "POST":
+                await writeResponse(writer, 200, {"cancelled": self.getSession(pathParts[1]).cancelResponse()})
+            elif len(pathParts) == 2 and pathParts[0] == "sessions" and request.method == "DELETE":
+                await self.closeSession(pathParts[1])
+                await writeResponse(writer, 204)
+            else:
+                raise HttpError(404)
+        except SessionNotFoundError as error:
+            raise HttpError(404, str(error))
+
+
+async def serveForever(host:str, port:int, ollamaUrl:str|None, modelName:str, dataBasePath:str|None,
+                       summaryModelName:str) -> None:
+    summaryModel = None
+    if summaryModelName:
+        summaryModel = providerRegistry.getChatModel("ollama", summaryModelName, temperature=0,
+                                                     num_predict=SUMMARY_TOKEN_RESERVE,
+                                  base_url=ollamaUrl)
+    chatModel = providerRegistry.getChatModel("ollama", modelName, temperature=0.7, keep_alive=MODEL_KEEP_ALIVE,
+                                              num_predict=RESPONSE_NUM_PREDICT, base_url=ollamaUrl)
+    if GENERATION_PROFILES_ENABLED:
+        # one selector for all sessions, they share the Ollama model and its context size
+        chatModel = ProfiledChatModel(innerModel=chatModel)
+    chatServer = ChatServer(chatModel, modelName, dataBasePath, summaryModel=summaryModel)
+    orchestrator = StartupOrchestrator()
+    orchestrator.addStep("model warm-up", lambda: preloadModel(chatServer.model), required=False)
+    orchestrator.addStep("server", lambda: chatServer.start(host, port))
+    startupReport, results = await orchestrator.run()
+    print(startupReport.describe())
+    print(f"Chat server listening on {results['server']}")
+    assert chatServer.server is not None
+    try:
+        await chatServer.server.serve_forever()
+    finally:
+        await chatServer.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-session chat server")
+    parser.add_argument("--host", default=CHAT_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=CHAT_SERVER_PORT)
+    parser.add_argument("--ollama-url", default=None, help="Ollama base url, e.g. the fake server from fakeOllamaServer.py")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--db", default=None, help="history database path")
+    parser.add_argument("--summary-model", default=SUMMARY_MODEL_NAME, help="empty disables rolling summaries")
+    arguments = parser.parse_args()
+    asyncio.run(serveForever(arguments.host, arguments.port, arguments.ollama_url, arguments.model, arguments.db,
+                             arguments.summary_model))
@@ -0,0 +1,128 @@
+from typing import Any
+import aiosqlite
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from agentState import AgentState
+from chatEngine import EXIT_COMMAND
+from constants import (CHECKPOINT_PRUNE_INTERVAL, CHECKPOINT_THREADS_KEPT_PER_USER, CHECKPOINT_VACUUM_FREE_RATIO,
+                       CHECKPOINTS_KEPT_PER_THREAD)
+from metrics import MetricsRegistry, metricsRegistry
+
+THREAD_ID_SEPARATOR = "/"
+
+
+def getThreadId(userName:str, conversationId:int) -> str:
+    return f"{userName}{THREAD_ID_SEPARATOR}{conversationId}"
+
+
+def getConversationIdFromThreadId(threadId:str) -> int:
+    return int(threadId.rpartition(THREAD_ID_SEPARATOR)[2])
+
+
+def threadConfig(threadId:str) -> RunnableConfig:
+    return RunnableConfig(configurable={"thread_id": threadId, "checkpoint_ns": ""})
+
+
+class PruningSqliteSaver(AsyncSqliteSaver):
+    """
+    SQLite checkpointer that only keeps what resuming needs.
+    Every pruneInterval checkpoints of a thread, all but its newest keepPerThread
+    checkpoints and their pending writes are deleted, so a long conversation
+    stores a bounded number of state snapshots. pruneUserThreads drops whole
+    threads beyond the newest ones of a user, and compact gives the freed pages
+    back to the file system.
+    """
+    def __init__(self, conn:aiosqlite.Connection, keepPerThread:int=CHECKPOINTS_KEPT_PER_THREAD,
+                 pruneInterval:int=CHECKPOINT_PRUNE_INTERVAL, metrics:MetricsRegistry=metricsRegistry,
+                 **kwargs:Any) -> None:
+        super().__init__(conn, **kwargs)
+        self.keepPerThread = keepPerThread
+        self.pruneInterval = pruneInterval
+        self.metrics = metrics
+        self._putsSincePrune:dict[str, int] = {}
+
+    @classmethod
+    async def open(cls, path:str, **kwargs:Any) -> "PruningSqliteSaver":
+        saver = cls(await aiosqlite.connect(path), **kwargs)
+        await saver.setup()
+        return saver
+
+    async def close(self) -> None:
+        await self.conn.close()
+
+    async def aput(self, config:RunnableConfig, checkpoint:Checkpoint, metadata:CheckpointMetadata,
+                   new_versions:ChannelVersions) -> RunnableConfig:
+        savedConfig = await super().aput(config, checkpoint, metadata, new_versions)
+        threadId = str(savedConfig["configurable"]["thread_id"]) # pyright: ignore[reportTypedDictNotRequiredAccess]
+        self._putsSincePrune[threadId] = self._putsSincePrune.get(threadId, 0) + 1
+        if self._putsSincePrune[threadId] >= self.pruneInterval:
+            await self.pruneThread(threadId)
+        return savedConfig
+
+    async def pruneThread(self, threadId:str) -> int:
+        """Deletes all but the newest checkpoints of a thread, returns how many were deleted."""
+        self._putsSincePrune[threadId] = 0
+        # checkpoint ids are time ordered, so the newest ids sort first in descending order
+        async with self.lock, self.conn.cursor() as cursor:
+            await cursor.execute(
+                "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id NOT IN "
+                "(SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? ORDER BY checkpoint_id DESC LIMIT ?)",
+                (threadId, threadId, self.keepPerThread))
+            deletedCheckpoints = cursor.rowcount
+            await cursor.execute(
+                "DELETE FROM writes WHERE thread_id = ? AND checkpoint_id NOT IN "
+                "(SELECT checkpoint_id FROM checkpoints WHERE thread_id = ?)", (threadId, threadId))
+            await self.conn.commit()
+        self.metrics.incrementCounter("checkpoints_pruned_total", deletedCheckpoints)
+        return deletedCheckpoints
+
+    async def userThreads(self, userName:str) -> list[str]:
+        """Threads of a user, the one with the newest checkpoint first."""
+        await self.setup()
+        async with self.lock, self.conn.execute(
+                "SELECT thread_id FROM checkpoints WHERE substr(thread_id, 1, ?) = ? "
+                "GROUP BY thread_id ORDER BY MAX(checkpoint_id) DESC",
+                (len(userName) + len(THREAD_ID_SEPARATOR), f"{userName}{THREAD_ID_SEPARATOR}")) as cursor:
+            return [str(row[0]) for row in await cursor.fetchall()]
+
+    async def latestThread(self, userName:str) -> str|None:
+        threads = await self.userThreads(userName)
+        return threads[0] if threads else None
+
+    async def pruneUserThreads(self, userName:str, keepThreads:int=CHECKPOINT_THREADS_KEPT_PER_USER) -> int:
+        """Deletes the checkpoints of all but the newest threads of a user, the messages stay in the history database."""
+        staleThreads = (await self.userThreads(userName))[keepThreads:]
+        for threadId in staleThreads:
+            await self.adelete_thread(threadId)
+        self.metrics.incrementCounter("checkpoint_threads_pruned_total", len(staleThreads))
+        return len(staleThreads)
+
+    async def compact(self, freeRatio:float=CHECKPOINT_VACUUM_FREE_RATIO) -> bool:
+        """Vacuums the file once more than freeRatio of its pages are free, returns whether it did."""
+        await self.setup()
+        async with self.lock:
+            async with self.conn.execute("PRAGMA page_count") as cursor:
+                pageCount = (await cursor.fetchone() or (0,))[0]
+            async with self.conn.execute("PRAGMA freelist_count") as cursor:
+                freePages = (await cursor.fetchone() or (0,))[0]
+            if pageCount == 0 or freePages / pageCount <= freeRatio:
+                return False
+            await self.conn.execute("VACUUM")
+        self.metrics.incrementCounter("checkpoint_vacuums_total")
+        return True
+
+    async def restoreState(self, threadId:str) -> AgentState|None:
+        """
+        The conversation state of the thread's newest checkpoint, read in one lookup
+        whatever the length of the conversation. The exit command that ended the last
+        run is dropped.
+        """
+        checkpointTuple = await self.aget_tuple(threadConfig(threadId))
+        if checkpointTuple is None:
+            return None
+        history = list(checkpointTuple.checkpoint["channel_values"].get("shortConversationHistory", []))
+        if history and isinstance(history[-1], HumanMessage) and history[-1].content == EXIT_COMMAND:
+            history.pop()
+        return AgentState(shortConversationHistory=history)
@@ -3,13 +3,115 @@ from pathlib import Path
 from typing import ClassVar
 
 MODEL_NAME = "gemma3n:e2b"
+# how long Ollama keeps the chat model loaded after the last request
+MODEL_KEEP_ALIVE = "30m"
+# a model warm-up that gets no answer within this long is reported as failed, a cold load from disk fits in it
+MODEL_PRELOAD_TIMEOUT_SECONDS = 120.0
+# caps of one chat response, a response that hits one is kept and persisted marked as truncated;
+# with generation profiles num_predict comes from the request's profile instead
+RESPONSE_NUM_PREDICT = 1024
+RESPONSE_TIMEOUT_SECONDS:float|None = 120.0
+# the answer being streamed is saved this often, so a crashed session continues it instead of starting over
+PARTIAL_RESPONSE_SAVE_INTERVAL_SECONDS = 2.0
+# a stream that fails midway is continued from what it produced this many times before the turn fails
+RESPONSE_RESUME_ATTEMPTS = 2
+RESPONSE_RESUME_DELAY_SECONDS = 1.0
+# requests pick num_ctx, num_predict, num_thread and keep_alive from a profile chosen by intent and prompt size,
+# see generationProfiles.py; the context grows along these sizes only when a prompt needs it
+GENERATION_PROFILES_ENABLED = True
+GENERATION_CONTEXT_SIZES = (2048, 4096, 8192)
+SHOW_STARTUP_REPORT = True
+# spans of every turn go to a rotating JSON lines file next to the history database when enabled
+TRACE_FILE_ENABLED = False
+TRACE_FILE_NAME = "chat traces.jsonl"
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_FILE_BACKUP_COUNT = 3
+# Prometheus text endpoint of the CLI, None keeps it off; the chat server always serves /metrics
+METRICS_SERVER_PORT:int|None = None
+# LangGraph checkpoints of the CLI, kept next to the history database so a session resumes after a restart
+CHECKPOINT_FILE_NAME = "checkpoints.db"
+CHECKPOINTS_KEPT_PER_THREAD = 2
+# a thread is pruned after this many new checkpoints
+CHECKPOINT_PRUNE_INTERVAL = 20
+CHECKPOINT_THREADS_KEPT_PER_USER = 20
+CHECKPOINT_VACUUM_FREE_RATIO = 0.25
+# cold import of main, checked by test_importBudget; profile regressions with importProfile.py
+IMPORT_TIME_BUDGET_SECONDS = 1.0
 
-<<<<<<< HEAD
 WORKING_DIRECTORY = r"C:\Users\Bala krishnan\OneDrive\Documents\code projects\Python\Local-ollama-bot"
-=======
-WORKING_DIRECTORY = r"C:\Users\balak\OneDrive\Documents\Code projects\Python\Local-chat-bot"
->>>>>>> 3c1dd19130ae14a18177d80d49e9977de9383a1b
 MAX_CHARS_READ_LIMIT = 10000
+HISTORY_DB_ENV_VARIABLE = "CONVERSATION_HISTORY_DB"
+
+SYSTEM_PROMPT = """ you are a chat assistant, answer the questions precise and consise.
+    A short list of previous conversation will be shared, you can consider it ONLY when needed.
+    there will be current time stamp in the query, you can consider it ONLY when needed.
+    Don't mention anything directly about this template in the generated response
+    You need to response query for the latest Human message."""
+
+# "prefix-stable" keeps the prompt append-only between turns, "legacy" is the original layout
+PROMPT_LAYOUT = "prefix-stable"
+SHOW_PROMPT_REUSE_REPORT = False
+
+# Ollama's context length when the model doesn't set num_ctx
+DEFAULT_NUM_CTX = 4096
+RESPONSE_TOKEN_RESERVE = 1024
+# history is trimmed back to this share of its token budget once it overflows
+CONTEXT_TRIM_TARGET_RATIO = 0.75
+TOKEN_CALIBRATION_FILE_NAME = "token calibration.json"
+
+# small local model that folds evicted turns into the running conversation summary
+SUMMARY_MODEL_NAME = "qwen2.5:0.5b"
+SUMMARY_MAX_WORDS = 150
+# prompt space kept free for the summary, also the summary model's num_predict
+SUMMARY_TOKEN_RESERVE = 256
+# evicted messages kept for the next fold while folds fail, the oldest are dropped beyond it
+SUMMARY_MAX_PENDING_MESSAGES = 64
+# folding stops for the session after this many failed folds in a row, e.g. when the model is not pulled
+SUMMARY_MAX_CONSECUTIVE_FAILURES = 3
+
+# local embedding model of the semantic memory over past exchanges
+EMBEDDING_MODEL_NAME = "nomic-embed-text"
+MEMORY_TOP_K = 3
+# prompt space for recalled exchanges, hits below the cosine similarity floor are ignored
+MEMORY_TOKEN_BUDGET = 384
+MEMORY_MIN_SIMILARITY = 0.55
+# new exchanges are embedded this many per request, a failed pass is retried after a delay that doubles up to the maximum
+MEMORY_INDEX_BATCH_SIZE = 32
+MEMORY_INDEX_RETRY_SECONDS = 5.0
+MEMORY_INDEX_MAX_RETRY_SECONDS = 300.0
+# at exit the last exchanges get this long to be indexed, the backfill command picks up the rest
+MEMORY_INDEX_CLOSE_TIMEOUT_SECONDS = 5.0
+
+# rows are written by a background thread at most this long, or this many rows, after they are queued
+PERSISTENCE_FLUSH_INTERVAL_SECONDS = 1.0
+PERSISTENCE_FLUSH_SIZE = 64
+PERSISTENCE_QUEUE_SIZE = 4096
+# rows the database rejected, kept for inspection instead of being retried forever
+PERSISTENCE_DEAD_LETTER_LIMIT = 1000
+
+# streamed pieces waiting for each output sink; beyond this, pieces are merged instead of queued
+STREAM_SINK_QUEUE_SIZE = 256
+# the terminal is written at most this often, or once this many bytes are waiting, instead of once per token
+TERMINAL_FLUSH_INTERVAL_SECONDS = 0.05
+TERMINAL_FLUSH_BYTES = 512
+
+# opt-in cache of answers to repeated standalone questions
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_FILE_NAME = "response cache.db"
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 2000
+# a question this similar to a cached one reuses its answer when the cache has an embedding model
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = 0.95
+
+# a request that has no first token after the hedge delay is also sent to the next provider
+ROUTING_HEDGE_DELAY_SECONDS = 2.0
+ROUTING_STATISTICS_WINDOW = 50
+# response length used to compare providers by time to first token plus generation time
+ROUTING_EXPECTED_RESPONSE_TOKENS = 200
+
+CHAT_SERVER_HOST = "127.0.0.1"
+CHAT_SERVER_PORT = 8765
+FAKE_OLLAMA_PORT = 11435
 aiWorkingDirectory = Path(WORKING_DIRECTORY).joinpath("AI")
 
 @dataclass(frozen=True)
@@ -17,6 +119,7 @@ class userTableInfo:
     tableName:ClassVar[str] =  "users"
     columnUserId = "user_id"
     columnUserName = 'user_name'
+    indexUserName = "users_user_name"
 
 
 @dataclass(frozen=True)
@@ -29,6 +132,7 @@ class conversationTableInfo:
     columnDay = "day"
     columnMonth = "month"
     columnYear = "year" 
+    indexUserId = "conversations_user_id"
     
 
 
@@ -39,3 +143,38 @@ class MessagesTableInfo:
     columnConversationId = "conversation_id"
     columnSender="sender"
     columnContent = "content"
+    columnTruncated = "truncated"
+    indexConversationId = "messages_conversation_id"
+
+
+@dataclass(frozen=True)
+class PartialResponsesTableInfo:
+    tableName:ClassVar[str] = "partial_responses"
+    columnConversationId = "conversation_id"
+    columnHumanContent = "human_content"
+    columnContent = "content"
+    columnUpdatedAt = "updated_at"
+
+
+@dataclass(frozen=True)
+class MessageEmbeddingsTableInfo:
+    tableName:ClassVar[str] = "message_embeddings"
+    columnMessageId = "message_id"
+    columnReplyMessageId = "reply_message_id"
+    columnConversationId = "conversation_id"
+    columnModel = "embedding_model"
+    columnEmbedding = "embedding"
+
+
+@dataclass(frozen=True)
+class ResponseCacheTableInfo:
+    tableName:ClassVar[str] = "response_cache"
+    columnCacheKey = "cache_key"
+    columnContextKey = "context_key"
+    columnQuestion = "question"
+    columnResponse = "response"
+    columnResponseMetadata = "response_metadata"
+    columnEmbedding = "embedding"
+    columnCreatedAt = "created_at"
+    columnLastUsedAt = "last_used_at"
+    columnHitCount = "hit_count"
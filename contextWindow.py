@@ -0,0 +1,158 @@
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Protocol
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from agentState import AgentState, updateShortConversationHistory
+from constants import CONTEXT_TRIM_TARGET_RATIO, DEFAULT_NUM_CTX, RESPONSE_TOKEN_RESERVE
+from metrics import MetricsRegistry, metricsRegistry
+from scheduler import innermostModel
+
+PINNED_KEY = "pinned"
+MESSAGE_TOKEN_OVERHEAD = 4
+DEFAULT_CHARS_PER_TOKEN = 4.0
+ESTIMATE_CACHE_SIZE = 4096
+
+
+class TokenEstimator(Protocol):
+    def estimate(self, text:str) -> int:...
+
+
+def pinMessage(message:BaseMessage) -> BaseMessage:
+    message.additional_kwargs[PINNED_KEY] = True
+    return message
+
+def isPinned(message:BaseMessage) -> bool:
+    return bool(message.additional_kwargs.get(PINNED_KEY))
+
+def messageText(message:str|BaseMessage) -> str:
+    return message if isinstance(message, str) else message.text
+
+def getNumCtx(model:BaseChatModel) -> int:
+    """The largest context the model runs with, wrappers that choose num_ctx per request report it as maxNumCtx."""
+    while (maxNumCtx := getattr(model, "maxNumCtx", None)) is None \
+            and isinstance(innerModel := getattr(model, "innerModel", None), BaseChatModel):
+        model = innerModel
+    if maxNumCtx:
+        return int(maxNumCtx)
+    numCtx = getattr(model, "num_ctx", None)
+    return int(numCtx) if numCtx else DEFAULT_NUM_CTX
+
+
+class CharRatioCalibrationStore:
+    """Keeps the measured characters-per-token ratio of every model in a small JSON file."""
+    def __init__(self, filePath:str|None=None) -> None:
+        self.filePath = filePath
+        self._lock = threading.Lock()
+        self._ratios:dict[str, float] = {}
+        if filePath is not None and Path(filePath).exists():
+            try:
+                self._ratios = {str(name): float(ratio) for name, ratio in json.loads(Path(filePath).read_text()).items()}
+            except (ValueError, AttributeError):
+                self._ratios = {}
+
+    def get(self, modelName:str) -> float|None:
+        with self._lock:
+            return self._ratios.get(modelName)
+
+    def set(self, modelName:str, charsPerToken:float) -> None:
+        with self._lock:
+            self._ratios[modelName] = charsPerToken
+            if self.filePath is not None:
+                Path(self.filePath).write_text(json.dumps(self._ratios, indent=2))
+
+
+class CalibratedTokenEstimator:
+    """
+    Estimates tokens from the characters-per-token ratio of one model.
+    The ratio starts at a generic default and follows the prompt_eval_count Ollama
+    reports for prompts that were evaluated in full. Estimates are cached per text.
+    """
+    def __init__(self, modelName:str, store:CharRatioCalibrationStore|None=None, smoothing:float=0.3) -> None:
+        self.modelName = modelName
+        self.store = store or CharRatioCalibrationStore()
+        self.smoothing = smoothing
+        self.charsPerToken = self.store.get(modelName) or DEFAULT_CHARS_PER_TOKEN
+        self._cache:OrderedDict[str, int] = OrderedDict()
+
+    def estimate(self, text:str) -> int:
+        cachedEstimate = self._cache.get(text)
+        if cachedEstimate is not None:
+            self._cache.move_to_end(text)
+            return cachedEstimate
+        estimate = round(len(text) / self.charsPerToken) if text else 0
+        self._cache[text] = estimate
+        if len(self._cache) > ESTIMATE_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return estimate
+
+    def calibrate(self, characterCount:int, tokenCount:int) -> None:
+        if characterCount <= 0 or tokenCount <= 0:
+            return
+        measuredRatio = characterCount / tokenCount
+        self.charsPerToken += self.smoothing * (measuredRatio - self.charsPerToken)
+        self._cache.clear()
+        self.store.set(self.modelName, self.charsPerToken)
+
+
+class ContextWindowManager:
+    """
+    Bounds shortConversationHistory by an estimated token budget.
+    The budget is the model's num_ctx minus the space reserved for the answer and for
+    the parts sent every turn. When the history outgrows it, whole turns are dropped
+    from the front until it is back at a fraction of the budget, so the trimmed prompt
+    prefix stays stable for several turns before the next trim. Pinned messages are
+    never dropped, evicted ones are handed to onEvicted.
+    """
+    def __init__(self, numCtx:int, estimator:TokenEstimator, reservedForResponse:int=RESPONSE_TOKEN_RESERVE,
+                 fixedPromptTokens:int=0, trimTargetRatio:float=CONTEXT_TRIM_TARGET_RATIO,
+                 metrics:MetricsRegistry=metricsRegistry,
+                 onEvicted:Callable[[list[HumanMessage|AIMessage]], None]|None=None) -> None:
+        self.numCtx = numCtx
+        self.estimator = estimator
+        self.reservedForResponse = reservedForResponse
+        self.fixedPromptTokens = fixedPromptTokens
+        self.trimTargetRatio = trimTargetRatio
+        self.metrics = metrics
+        self.onEvicted = onEvicted
+
+    @property
+    def historyBudget(self) -> int:
+        return max(self.numCtx - self.reservedForResponse - self.fixedPromptTokens, 0)
+
+    def countTokens(self, messages:list[str|BaseMessage]) -> int:
+        return sum(self.estimator.estimate(messageText(message)) + MESSAGE_TOKEN_OVERHEAD for message in messages)
+
+    def fit(self, state:AgentState) -> list[HumanMessage|AIMessage]:
+        """Trims the history in place and returns the evicted messages in their original order."""
+        history = state["shortConversationHistory"]
+        historyTokens = self.countTokens(list(history))
+        evictedMessages:list[HumanMessage|AIMessage] = []
+        if historyTokens > self.historyBudget:
+            targetTokens = int(self.historyBudget * self.trimTargetRatio)
+            keptMessages:list[HumanMessage|AIMessage] = []
+            for index, message in enumerate(history):
+                # drop from the front until the rest fits the target, stopping only where a turn starts
+                if historyTokens <= targetTokens and (isinstance(message, HumanMessage) or isPinned(message)):
+                    keptMessages.extend(history[index:])
+                    break
+                if isPinned(message):
+                    keptMessages.append(message)
+                    continue
+                evictedMessages.append(message)
+                historyTokens -= self.countTokens([message])
+            history[:] = keptMessages
+
+        self.metrics.setGauge("context_history_tokens", historyTokens)
+        if evictedMessages:
+            self.metrics.incrementCounter("context_evicted_messages_total", len(evictedMessages))
+            if self.onEvicted is not None:
+                self.onEvicted(evictedMessages)
+        return evictedMessages
+
+    def updateHistory(self, state:AgentState, newHumanMessage:HumanMessage, newAiMessage:AIMessage) -> AgentState:
+        updateShortConversationHistory(state, newHumanMessage, newAiMessage)
+        self.fit(state)
+        return state
@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any
+from constants import CHAT_SERVER_HOST, FAKE_OLLAMA_PORT
+from httpUtils import ChunkedResponse, HttpError, HttpRequest, startHttpServer, writeResponse
+
+
+@dataclass
+class FakeOllamaSettings:
+    tokensPerSecond:float = 20.0
+    firstTokenDelay:float = 0.2
+    responseTokens:int = 40
+    token:str = "lorem "
+    # paid once per model by whichever request uses it first, like loading the weights
+    modelLoadDelay:float = 0.0
+
+
+class FakeOllamaServer:
+    """
+    Stand-in for the Ollama HTTP API that streams a canned answer at a fixed rate.
+    Speaks enough of /api/chat and /api/generate for ChatOllama, so chats and load
+    tests run offline.
+    """
+    def __init__(self, settings:FakeOllamaSettings|None=None) -> None:
+        self.settings = settings or FakeOllamaSettings()
+        self.server:asyncio.Server|None = None
+        self.requestCount = 0
+        self.activeRequests = 0
+        # streams the client closed before they were done, the tokens left are never generated
+        self.abortedRequests = 0
+        # the options of every request, like num_ctx and num_predict
+        self.requestOptions:list[dict[str,Any]] = []
+        self._modelLoads:dict[str, asyncio.Future[None]] = {}
+
+    async def start(self, host:str=CHAT_SERVER_HOST, port:int=FAKE_OLLAMA_PORT) -> str:
+        self.server = await startHttpServer(self.handleRequest, host, port)
+        boundPort = self.server.sockets[0].getsockname()[1]
+        return f"http://{host}:{boundPort}"
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            self.server.close_clients()
+            await self.server.wait_closed()
+
+    async def handleRequest(self, request:HttpRequest, writer:asyncio.StreamWriter) -> None:
+        if request.path in ("/", "/api/version"):
+            await writeResponse(writer, 200, {"version": "0.0.0-fake"})
+        elif request.path == "/api/tags":
+            await writeResponse(writer, 200, {"models": []})
+        elif request.path == "/api/chat" and request.method == "POST":
+            await self._respond(request, writer, isChat=True)
+        elif request.path == "/api/generate" and request.method == "POST":
+            await self._respond(request, writer, isChat=False)
+        else:
+            raise HttpError(404)
+
+    async def _respond(self, request:HttpRequest, writer:asyncio.StreamWriter, isChat:bool) -> None:
+        payload:dict[str,Any] = request.json()
+        modelName = str(payload.get("model", "fake"))
+        if isChat:
+            promptText = "".join(str(message.get("content", "")) for message in payload.get("messages", []))
+        else:
+            promptText = str(payload.get("prompt", ""))
+        # an empty generate request only loads the model, like the real server
+        tokenCount = self.settings.responseTokens if promptText else 0
+        options:dict[str,Any] = payload.get("options") or {}
+        self.requestOptions.append(options)
+        doneReason = "stop" if promptText else "load"
+        if options.get("num_predict") is not None and 0 <= int(options["num_predict"]) < tokenCount:
+            tokenCount = int(options["num_predict"])
+            doneReason = "length"
+
+        self.requestCount += 1
+        self.activeRequests += 1
+        startTime = time.perf_counter()
+        try:
+            await self._loadModel(modelName)
+            if payload.get("stream", True):
+                response = ChunkedResponse(writer)
+                await response.start(contentType="application/x-ndjson")
+                await asyncio.sleep(self.settings.firstTokenDelay)
+                try:
+                    for tokenIndex in range(tokenCount):
+                        if tokenIndex > 0:
+                            await asyncio.sleep(1 / self.settings.tokensPerSecond)
+                        await response.write(json.dumps(self._chunk(modelName, self.settings.token, isChat)) + "\n")
+                except ConnectionError:
+                    self.abortedRequests += 1
+                    raise
+                doneChunk = self._chunk(modelName, "", isChat)
+                doneChunk.update(self._doneFields(doneReason, promptText, tokenCount, startTime))
+                await response.write(json.dumps(doneChunk) + "\n")
+                await response.end()
+            else:
+                await asyncio.sleep(self.settings.firstTokenDelay + max(tokenCount - 1, 0) / self.settings.tokensPerSecond)
+                body = self._chunk(modelName, self.settings.token * tokenCount, isChat)
+                body.update(self._doneFields(doneReason, promptText, tokenCount, startTime))
+                await writeResponse(writer, 200, body)
+        finally:
+            self.activeRequests -= 1
+
+    async def _loadModel(self, modelName:str) -> None:
+        modelLoad = self._modelLoads.get(modelName)
+        if modelLoad is None:
+            modelLoad = self._modelLoads[modelName] = asyncio.ensure_future(asyncio.sleep(self.settings.modelLoadDelay))
+        await asyncio.shield(modelLoad)
+
+    @staticmethod
+    def _chunk(modelName:str, content:str, isChat:bool) -> dict[str,Any]:
+        chunk:dict[str,Any] = {"model": modelName, "created_at": datetime.now(timezone.utc).isoformat(), "done": False}
+        if isChat:
+            chunk["message"] = {"role": "assistant", "content": content}
+        else:
+            chunk["response"] = content
+        return chunk
+
+    @staticmethod
+    def _doneFields(doneReason:str, promptText:str, tokenCount:int, startTime:float) -> dict[str,Any]:
+        return {"done": True,
+                "done_reason": doneReason,
+                "total_duration": int((time.perf_counter() - startTime) * 1e9),
+                "load_duration": 0,
+                "prompt_eval_count": max(len(promptText) // 4, 1),
+                "prompt_eval_duration": 0,
+                "eval_count": tokenCount,
+                "eval_duration": 0}
+
+
+async def serveForever(settings:FakeOllamaSettings, host:str, port:int) -> None:
+    fakeServer = FakeOllamaServer(settings)
+    url = await fakeServer.start(host, port)
+    print(f"Fake Ollama listening on {url}")
+    assert fakeServer.server is not None
+    await fakeServer.server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama server streaming tokens at a fixed rate")
+    parser.add_argument("--host", default=CHAT_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=FAKE_OLLAMA_PORT)
+    parser.add_argument("--tokens-per-second", type=float, default=FakeOllamaSettings.tokensPerSecond)
+    parser.add_argument("--first-token-delay", type=float, default=FakeOllamaSettings.firstTokenDelay)
+    parser.add_argument("--response-tokens", type=int, default=FakeOllamaSettings.responseTokens)
+    parser.add_argument("--model-load-delay", type=float, default=FakeOllamaSettings.modelLoadDelay)
+    arguments = parser.parse_args()
+    asyncio.run(serveForever(FakeOllamaSettings(tokensPerSecond=arguments.tokens_per_second,
+                                                firstTokenDelay=arguments.first_token_delay,
+                                                responseTokens=arguments.response_tokens,
+                                                modelLoadDelay=arguments.model_load_delay),
+                             arguments.host, arguments.port))
@@ -0,0 +1,182 @@
+import re
+import threading
+from dataclasses import dataclass, replace
+from enum import StrEnum
+from typing import Any, AsyncIterator, Callable, Iterator, Sequence
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from pydantic import Field
+from constants import GENERATION_CONTEXT_SIZES, MODEL_KEEP_ALIVE
+from contextWindow import DEFAULT_CHARS_PER_TOKEN, MESSAGE_TOKEN_OVERHEAD, messageText
+from metrics import MetricsRegistry, metricsRegistry
+
+CODE_PATTERN = re.compile(
+    r"```|\b(code|function|class|method|script|program|compile|debug|bug|traceback|exception|regex|sql|python|"
+    r"javascript|typescript|java|rust|golang|c\+\+|bash|implement|refactor)\b|\w+\(\)|def \w+|import \w+",
+    re.IGNORECASE)
+LONG_FORM_PATTERN = re.compile(
+    r"\b(explain|describe|detail|detailed|essay|article|story|compare|contrast|summari[sz]e|overview|guide|"
+    r"tutorial|step by step|pros and cons|why|elaborate|write)\b",
+    re.IGNORECASE)
+# questions longer than this many words ask for more than a one-line answer
+LONG_QUESTION_WORDS = 40
+# answers are never capped below this many tokens to fit a prompt into the largest context
+MIN_NUM_PREDICT = 128
+
+
+class Intent(StrEnum):
+    SHORT = "short"
+    LONG_FORM = "longForm"
+    CODE = "code"
+
+
+def classifyIntent(text:str) -> Intent:
+    if CODE_PATTERN.search(text):
+        return Intent.CODE
+    if LONG_FORM_PATTERN.search(text) or len(text.split()) > LONG_QUESTION_WORDS:
+        return Intent.LONG_FORM
+    return Intent.SHORT
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    """Ollama options of one kind of request. numCtx is the smallest context the profile runs with."""
+    name:str
+    numCtx:int
+    numPredict:int
+    numThread:int|None = None
+    keepAlive:str = MODEL_KEEP_ALIVE
+
+    def modelArguments(self) -> dict[str, Any]:
+        return {"num_ctx": self.numCtx, "num_predict": self.numPredict, "num_thread": self.numThread,
+                "keep_alive": self.keepAlive}
+
+
+GENERATION_PROFILES:dict[Intent, GenerationProfile] = {
+    Intent.SHORT: GenerationProfile(Intent.SHORT, numCtx=GENERATION_CONTEXT_SIZES[0], numPredict=256),
+    Intent.LONG_FORM: GenerationProfile(Intent.LONG_FORM, numCtx=GENERATION_CONTEXT_SIZES[0], numPredict=2048),
+    Intent.CODE: GenerationProfile(Intent.CODE, numCtx=GENERATION_CONTEXT_SIZES[0], numPredict=1536),
+}
+
+
+class ProfileSelector:
+    """
+    Picks the profile of a request from the intent of its question and the size of its prompt.
+    The context grows along contextSizes until prompt and answer fit. Changing num_ctx
+    makes Ollama reload the model and lose its cached prompt, so the context of the
+    previous request is kept as long as the prompt still fits in it; only a prompt that
+    outgrows it moves to a larger one. One selector should serve every user of a model.
+    """
+    def __init__(self, profiles:dict[Intent, GenerationProfile]|None=None,
+                 contextSizes:Sequence[int]=GENERATION_CONTEXT_SIZES,
+                 metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.profiles = profiles or GENERATION_PROFILES
+        self.contextSizes = sorted(contextSizes)
+        self.metrics = metrics
+        self.lastNumCtx:int|None = None
+        self._lock = threading.Lock()
+
+    @property
+    def maxNumCtx(self) -> int:
+        return max(self.contextSizes[-1], *(profile.numCtx for profile in self.profiles.values()))
+
+    def profileFor(self, question:str) -> GenerationProfile:
+        """The profile of a question before it is sized to a prompt, select() does not change it."""
+        return self.profiles[classifyIntent(question)]
+
+    def select(self, promptTokens:int, question:str) -> GenerationProfile:
+        profile = self.profileFor(question)
+        with self._lock:
+            requiredTokens = promptTokens + profile.numPredict
+            if self.lastNumCtx is not None and profile.numCtx <= self.lastNumCtx and requiredTokens <= self.lastNumCtx:
+                numCtx = self.lastNumCtx
+            else:
+                numCtx = next((size for size in [*self.contextSizes, self.maxNumCtx]
+                               if size >= profile.numCtx and size >= requiredTokens), self.maxNumCtx)
+            self.lastNumCtx = numCtx
+        # a prompt too large for the largest context keeps what room is left for the answer, rounded down
+        # to whole steps so the models cached per set of options stay few
+        roomLeft = (numCtx - promptTokens) // MIN_NUM_PREDICT * MIN_NUM_PREDICT
+        numPredict = min(profile.numPredict, max(roomLeft, MIN_NUM_PREDICT))
+        self.metrics.incrementCounter("generation_profile_requests_total", profile=profile.name)
+        self.metrics.observe("generation_profile_num_ctx", numCtx)
+        return replace(profile, numCtx=numCtx, numPredict=numPredict)
+
+
+class ProfiledChatModel(BaseChatModel):
+    """
+    Runs every request of the wrapped Ollama chat model with the options of its profile.
+    A copy of the inner model is kept per set of options, so switching profiles
+    does not rebuild models. num_predict caps the profile's answer length, it is named
+    like ChatOllama's option so the scheduler's degraded mode caps profiled models too.
+    """
+    innerModel:BaseChatModel
+    selector:ProfileSelector = Field(default_factory=ProfileSelector)
+    # defaults to a fixed characters-per-token estimate
+    estimateTokens:Callable[[str], int]|None = None
+    num_predict:int|None = None
+    # shared by copies of this model, keyed by the options each inner model was copied with
+    profileModels:dict[tuple[Any, ...], BaseChatModel] = Field(default_factory=dict[tuple[Any, ...], BaseChatModel])
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return f"profiled-{self.innerModel._llm_type}" # pyright: ignore[reportPrivateUsage]
+
+    @property
+    def maxNumCtx(self) -> int:
+        return self.selector.maxNumCtx
+
+    def _estimateTokens(self, messages:list[BaseMessage]) -> int:
+        text = [messageText(message) for message in messages]
+        if self.estimateTokens is None:
+            return sum(int(len(part) / DEFAULT_CHARS_PER_TOKEN) + MESSAGE_TOKEN_OVERHEAD for part in text)
+        return sum(self.estimateTokens(part) + MESSAGE_TOKEN_OVERHEAD for part in text)
+
+    def selectProfile(self, messages:list[BaseMessage]) -> GenerationProfile:
+        question = next((message.text for message in reversed(messages) if isinstance(message, HumanMessage)), "")
+        profile = self.selector.select(self._estimateTokens(messages), question)
+        if self.num_predict is not None and self.num_predict < profile.numPredict:
+            profile = replace(profile, numPredict=self.num_predict)
+        return profile
+
+    def _modelFor(self, messages:list[BaseMessage]) -> BaseChatModel:
+        modelArguments = self.selectProfile(messages).modelArguments()
+        key = tuple(sorted(modelArguments.items()))
+        model = self.profileModels.get(key)
+        if model is None:
+            model = self.profileModels[key] = self.innerModel.model_copy(update=modelArguments)
+        return model
+
+    def _generate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                  run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        return self._modelFor(messages)._generate(messages, stop=stop, **kwargs) # pyright: ignore[reportPrivateUsage]
+
+    async def _agenerate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                         run_manager:AsyncCallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        return await self._modelFor(messages)._agenerate(messages, stop=stop, **kwargs) # pyright: ignore[reportPrivateUsage]
+
+    def _stream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> Iterator[ChatGenerationChunk]:
+        for chunk in self._modelFor(messages)._stream(messages, stop=stop, **kwargs): # pyright: ignore[reportPrivateUsage]
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                       run_manager:AsyncCallbackManagerForLLMRun|None=None,
+                       **kwargs:Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self._modelFor(messages)._astream(messages, stop=stop, **kwargs): # pyright: ignore[reportPrivateUsage]
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def bind_tools(self, tools:Sequence[dict[str, Any]|type|Callable[..., Any]|BaseTool],
+                   **kwargs:Any) -> Runnable[LanguageModelInput, AIMessage]:
+        toolBinding = self.innerModel.bind_tools(tools, **kwargs)
+        return self.bind(**getattr(toolBinding, "kwargs", {}))
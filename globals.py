@@ -1,14 +1,24 @@
 from functools import cached_property
-from typing import Self
-from DB import Database
+from typing import Callable, Self
+from DB import Database, DatabasePool
 import os,sys
 from pathlib import Path
-from constants import MODEL_NAME, userTableInfo,conversationTableInfo,MessagesTableInfo
-from langchain_ollama import ChatOllama
+from constants import MODEL_NAME, MODEL_KEEP_ALIVE, RESPONSE_NUM_PREDICT, GENERATION_PROFILES_ENABLED, EMBEDDING_MODEL_NAME, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_FILE_NAME, SUMMARY_MODEL_NAME, SUMMARY_TOKEN_RESERVE, SYSTEM_PROMPT, HISTORY_DB_ENV_VARIABLE, TOKEN_CALIBRATION_FILE_NAME, TRACE_FILE_NAME, CHECKPOINT_FILE_NAME, userTableInfo,conversationTableInfo,MessagesTableInfo,PartialResponsesTableInfo
+from providers import providerRegistry
+from langchain_core.language_models import BaseChatModel
+from scheduler import RequestPriority, ScheduledChatModel, requestScheduler
+from semanticMemory import SemanticMemoryIndex
+from responseCache import CachingChatModel, ResponseCache
+from generationProfiles import ProfiledChatModel
+from contextWindow import CalibratedTokenEstimator, CharRatioCalibrationStore
+from persistenceQueue import RowWrite
 from langchain_core.messages import SystemMessage
 from getpass import getuser
 from datetime import datetime
 from langchain_core.messages import HumanMessage,AIMessage
+from chatEngine import isTruncated
+
+TRUNCATED_COLUMN_TYPE = "INTEGER NOT NULL DEFAULT 0"
 
 
 class UserNotFoundError(Exception):...
@@ -16,11 +26,42 @@ class UserNotFoundError(Exception):...
 def getProjectWorkingFolder():
     pass
 
-def createConversationHistoryDb()->Database:
+def getConversationHistoryDbPath()->str:
+    dataBasePath = os.environ.get(HISTORY_DB_ENV_VARIABLE)
+    if dataBasePath:
+        return dataBasePath
     scriptFolder=os.path.dirname(os.path.abspath(sys.argv[0]))
-    dataBasePath=fr"{scriptFolder}\memory\conversation history.db"
-    database = Database(dataBasePath)
+    return fr"{scriptFolder}\memory\conversation history.db"
+
+def getTokenCalibrationPath()->str:
+    return str(Path(getConversationHistoryDbPath()).with_name(TOKEN_CALIBRATION_FILE_NAME))
+
+def getResponseCachePath()->str:
+    return str(Path(getConversationHistoryDbPath()).with_name(RESPONSE_CACHE_FILE_NAME))
+
+def getCheckpointPath()->str:
+    return str(Path(getConversationHistoryDbPath()).with_name(CHECKPOINT_FILE_NAME))
+
+def getTraceFilePath()->str:
+    return str(Path(getConversationHistoryDbPath()).with_name(TRACE_FILE_NAME))
+
+def openConversationHistoryDb(dataBasePath:str|None=None)->Database:
+    """Opens the history database, created or brought to the latest schema version first."""
+    database = Database(dataBasePath or getConversationHistoryDbPath())
+    database.migrate(HISTORY_MIGRATIONS)
+    return database
+
+def createConversationHistoryDb(dataBasePath:str|None=None)->Database:
+    return openConversationHistoryDb(dataBasePath)
 
+def openConversationHistoryPool(dataBasePath:str|None=None)->DatabasePool:
+    """Pooled connections to the history database, created or upgraded first."""
+    dataBasePath = dataBasePath or getConversationHistoryDbPath()
+    openConversationHistoryDb(dataBasePath).disconnect(True)
+    return DatabasePool(dataBasePath)
+
+def createHistoryTables(database:Database)->None:
+    # databases made before schema versions have the tables already
     userColumnNamesAndData={userTableInfo.columnUserId:"INTEGER PRIMARY KEY",
                             userTableInfo.columnUserName:"TEXT"
                             }
@@ -40,30 +81,80 @@ def createConversationHistoryDb()->Database:
         conversationTableInfo.columnConversationId:"INTEGER NOT NULL",
         MessagesTableInfo.columnSender:"TEXT",
         MessagesTableInfo.columnContent:"TEXT",
+        MessagesTableInfo.columnTruncated:TRUNCATED_COLUMN_TYPE,
 
         f"FOREIGN KEY ({conversationTableInfo.columnConversationId})":
                         f"REFERENCES {conversationTableInfo.tableName} ({conversationTableInfo.columnConversationId})"
 
     }
-    database.createTable(userTableInfo.tableName,userColumnNamesAndData)
-    database.createTable(conversationTableInfo.tableName,conversationColumnNamesAndData)
-    database.createTable(MessagesTableInfo.tableName,messagesColumnNamesAndData)
+    for tableName,columnNamesAndData in ((userTableInfo.tableName,userColumnNamesAndData),
+                                         (conversationTableInfo.tableName,conversationColumnNamesAndData),
+                                         (MessagesTableInfo.tableName,messagesColumnNamesAndData)):
+        if not database.isTableExists(tableName):
+            database.createTable(tableName,columnNamesAndData)
 
-    return database
+def addTruncatedColumn(database:Database)->None:
+    # databases created before responses could be cancelled have no truncated column
+    if not database.isColumnExists(MessagesTableInfo.tableName,MessagesTableInfo.columnTruncated):
+        database.insertColumn(MessagesTableInfo.tableName,MessagesTableInfo.columnTruncated,TRUNCATED_COLUMN_TYPE)
+
+def addPartialResponsesTable(database:Database)->None:
+    if database.isTableExists(PartialResponsesTableInfo.tableName):
+        return
+    database.createTable(PartialResponsesTableInfo.tableName,{
+        PartialResponsesTableInfo.columnConversationId:"INTEGER PRIMARY KEY",
+        PartialResponsesTableInfo.columnHumanContent:"TEXT NOT NULL",
+        PartialResponsesTableInfo.columnContent:"TEXT NOT NULL",
+        PartialResponsesTableInfo.columnUpdatedAt:"TEXT NOT NULL"})
+
+def mergeDuplicateUsers(database:Database)->None:
+    """Moves the conversations of users sharing a name to the first of them and deletes the others."""
+    firstUserIds = f"""SELECT MIN({userTableInfo.columnUserId}) FROM {userTableInfo.tableName}
+                       GROUP BY {userTableInfo.columnUserName}"""
+    database.cursor.execute(
+        f"""UPDATE {conversationTableInfo.tableName} SET {conversationTableInfo.columnUserId} =
+                (SELECT MIN(firstUser.{userTableInfo.columnUserId})
+                 FROM {userTableInfo.tableName} AS duplicate JOIN {userTableInfo.tableName} AS firstUser
+                   ON firstUser.{userTableInfo.columnUserName} = duplicate.{userTableInfo.columnUserName}
+                 WHERE duplicate.{userTableInfo.columnUserId} =
+                       {conversationTableInfo.tableName}.{conversationTableInfo.columnUserId})
+            WHERE {conversationTableInfo.columnUserId} IN
+                (SELECT {userTableInfo.columnUserId} FROM {userTableInfo.tableName}
+                 WHERE {userTableInfo.columnUserName} IS NOT NULL
+                   AND {userTableInfo.columnUserId} NOT IN ({firstUserIds}))""")
+    database.cursor.execute(
+        f"""DELETE FROM {userTableInfo.tableName}
+            WHERE {userTableInfo.columnUserName} IS NOT NULL AND {userTableInfo.columnUserId} NOT IN ({firstUserIds})""")
+
+def addHistoryIndexes(database:Database)->None:
+    # the joins of getPastMessages, and one user row per name
+    mergeDuplicateUsers(database)
+    database.createIndex(userTableInfo.tableName,userTableInfo.indexUserName,[userTableInfo.columnUserName],
+                         unique=True)
+    database.createIndex(conversationTableInfo.tableName,conversationTableInfo.indexUserId,
+                         [conversationTableInfo.columnUserId])
+    database.createIndex(MessagesTableInfo.tableName,MessagesTableInfo.indexConversationId,
+                         [MessagesTableInfo.columnConversationId])
+
+# HISTORY_MIGRATIONS[i] upgrades a history database at PRAGMA user_version i; only ever append to it
+HISTORY_MIGRATIONS:list[Callable[[Database],None]] = [createHistoryTables,addTruncatedColumn,addPartialResponsesTable,
+                                                      addHistoryIndexes]
 
 def getPastMessages(conversationDatabase:Database,userName:str,messagesCount:int=-1)->list[HumanMessage|AIMessage]:
-    queryString = f"""SELECT {MessagesTableInfo.columnSender},{MessagesTableInfo.columnContent} FROM
-    {MessagesTableInfo.tableName} LEFT JOIN {conversationTableInfo.tableName}
-    ON {MessagesTableInfo.tableName}.{MessagesTableInfo.columnConversationId} = 
-            {conversationTableInfo.tableName}.{conversationTableInfo.columnConversationId}
-    LEFT JOIN {userTableInfo.tableName} ON 
-    {userTableInfo.tableName}.{userTableInfo.columnUserId} =
-      {conversationTableInfo.tableName}.{conversationTableInfo.columnUserId}
+    # newest conversation first and newest message first within it: the user's row comes from the
+    # user_name index, and the indexes on user_id and conversation_id hand out their rows in that order,
+    # so LIMIT stops after messagesCount rows instead of sorting all of the user's messages
+    queryString = f"""SELECT {MessagesTableInfo.tableName}.{MessagesTableInfo.columnSender},
+           {MessagesTableInfo.tableName}.{MessagesTableInfo.columnContent}
+    FROM {userTableInfo.tableName} JOIN {conversationTableInfo.tableName}
+    ON {conversationTableInfo.tableName}.{conversationTableInfo.columnUserId} =
+            {userTableInfo.tableName}.{userTableInfo.columnUserId}
+    JOIN {MessagesTableInfo.tableName} ON
+    {MessagesTableInfo.tableName}.{MessagesTableInfo.columnConversationId} =
+      {conversationTableInfo.tableName}.{conversationTableInfo.columnConversationId}
     WHERE {userTableInfo.tableName}.{userTableInfo.columnUserName} = ?
-    ORDER BY {conversationTableInfo.tableName}.{conversationTableInfo.columnYear} DESC,
-    {conversationTableInfo.tableName}.{conversationTableInfo.columnMonth} DESC,
-    {conversationTableInfo.tableName}.{conversationTableInfo.columnDay} DESC,
-    {conversationTableInfo.tableName}.{conversationTableInfo.columnTime} DESC
+    ORDER BY {conversationTableInfo.tableName}.{conversationTableInfo.columnConversationId} DESC,
+    {MessagesTableInfo.tableName}.{MessagesTableInfo.columnMessageId} DESC
     """
     if messagesCount>=1:
         queryString +=  f"LIMIT {messagesCount}"
@@ -82,6 +173,90 @@ def getPastMessages(conversationDatabase:Database,userName:str,messagesCount:int
             outputMessagesList.append(AIMessage(rows[rowId-1][1]))
     return outputMessagesList
 
+def getOrCreateUserId(conversationDatabase:Database,userName:str)->int:
+    cursor = conversationDatabase.cursor
+    cursor.execute(
+        f"""SELECT {userTableInfo.columnUserId} FROM {userTableInfo.tableName}
+            WHERE {userTableInfo.columnUserName} = ? """,(userName,))
+    row = cursor.fetchone()
+    if row is not None:
+        return int(row[0])
+    userId = conversationDatabase.insertData(userTableInfo.tableName,{userTableInfo.columnUserName:userName},True)
+    if userId is None:
+        raise UserNotFoundError(f"User {userName} could not be created in database.")
+    return userId
+
+def createConversation(conversationDatabase:Database,userId:int,description:str="")->int:
+    now = datetime.now().astimezone()
+    conversationData:dict[str,int|str]= {
+        conversationTableInfo.columnUserId:userId,
+        conversationTableInfo.columnConversationDescription:description,
+        conversationTableInfo.columnMonth:now.month,
+        conversationTableInfo.columnDay:now.day,
+        conversationTableInfo.columnYear:now.year,
+        conversationTableInfo.columnTime:f"{now.strftime("%H:%M:%S")} {now.tzinfo}"}
+    conversationId = conversationDatabase.insertData(conversationTableInfo.tableName,conversationData,True)
+    if conversationId is None:
+        raise ValueError(f"Conversation for user id {userId} could not be created in database.")
+    return conversationId
+
+def getMessageRows(conversationId:int,userName:str,modelName:str,
+                   humanMessage:HumanMessage,aiMessage:AIMessage)->list[RowWrite]:
+    # both rows carry the same columns so the writer batches them into one statement
+    return [RowWrite(MessagesTableInfo.tableName,{MessagesTableInfo.columnConversationId:conversationId,
+                                                  MessagesTableInfo.columnSender:userName,
+                                                  MessagesTableInfo.columnContent:humanMessage.text,
+                                                  MessagesTableInfo.columnTruncated:0}),
+            RowWrite(MessagesTableInfo.tableName,{MessagesTableInfo.columnConversationId:conversationId,
+                                                  MessagesTableInfo.columnSender:modelName,
+                                                  MessagesTableInfo.columnContent:aiMessage.text,
+                                                  MessagesTableInfo.columnTruncated:int(isTruncated(aiMessage))})]
+
+def recordMessagesInDb(conversationDatabase:Database,conversationId:int,userName:str,modelName:str,
+                       humanMessage:HumanMessage,aiMessage:AIMessage)->tuple[int|None,int|None]:
+    """Inserts one exchange and returns the message ids of the human and the ai message."""
+    humanMessageId,aiMessageId = conversationDatabase.insertReturningIds(
+        MessagesTableInfo.tableName,
+        [row.columnAndValue for row in getMessageRows(conversationId,userName,modelName,humanMessage,aiMessage)],True)
+    return humanMessageId,aiMessageId
+
+def savePartialResponse(conversationDatabase:Database,conversationId:int,humanMessage:HumanMessage,
+                        content:str|None)->None:
+    """Keeps the answer being streamed in a conversation, None deletes it once the turn is recorded."""
+    if content is None:
+        conversationDatabase.cursor.execute(
+            f"""DELETE FROM {PartialResponsesTableInfo.tableName}
+                WHERE {PartialResponsesTableInfo.columnConversationId} = ?""",(conversationId,))
+    else:
+        conversationDatabase.cursor.execute(
+            f"""INSERT OR REPLACE INTO {PartialResponsesTableInfo.tableName}
+                ({PartialResponsesTableInfo.columnConversationId},{PartialResponsesTableInfo.columnHumanContent},
+                 {PartialResponsesTableInfo.columnContent},{PartialResponsesTableInfo.columnUpdatedAt})
+                VALUES (?,?,?,?)""",(conversationId,humanMessage.text,content,datetime.now().isoformat()))
+    conversationDatabase.commit()
+
+def getPartialResponse(conversationDatabase:Database,conversationId:int)->tuple[HumanMessage,str]|None:
+    """The question and the saved part of an answer that a session died streaming, None when there is none."""
+    conversationDatabase.cursor.execute(
+        f"""SELECT {PartialResponsesTableInfo.columnHumanContent},{PartialResponsesTableInfo.columnContent}
+            FROM {PartialResponsesTableInfo.tableName}
+            WHERE {PartialResponsesTableInfo.columnConversationId} = ?""",(conversationId,))
+    row = conversationDatabase.cursor.fetchone()
+    return None if row is None else (HumanMessage(str(row[0])),str(row[1]))
+
+def getConversationDescription(conversationDatabase:Database,conversationId:int)->str|None:
+    """The description of a conversation, None when there is no such conversation."""
+    conversationDatabase.cursor.execute(
+        f"""SELECT {conversationTableInfo.columnConversationDescription} FROM {conversationTableInfo.tableName}
+            WHERE {conversationTableInfo.columnConversationId} = ?""",(conversationId,))
+    row = conversationDatabase.cursor.fetchone()
+    return None if row is None else str(row[0] or "")
+
+def updateConversationDescription(conversationDatabase:Database,conversationId:int,description:str)->None:
+    conversationDatabase.updateData(conversationTableInfo.tableName,
+                                    {conversationTableInfo.columnConversationDescription:description},
+                                    conversationTableInfo.columnConversationId,conversationId,True)
+
 class GlobalVariables:
     _instance:Self|None = None
 
@@ -90,23 +265,43 @@ class GlobalVariables:
             cls._instance = super().__new__(cls)
         return cls._instance
     
-    def __init__(self)->None:
-        _=self.conversationHistoryDB
-
-    @property
-    def conversationHistoryDB(self)->Database:
-        scriptFolder=os.path.dirname(os.path.abspath(sys.argv[0]))
-        dataBasePath=fr"{scriptFolder}\memory\conversation history.db"
-        if Path(dataBasePath).exists()==True:
-            return Database(dataBasePath)
-        else:
-            return createConversationHistoryDb()
+    @cached_property
+    def historyPool(self)->DatabasePool:
+        # opened once for the whole session, every turn borrows its connections
+        return openConversationHistoryPool()
+
+    def closeHistoryPool(self)->None:
+        if "historyPool" in self.__dict__:
+            self.__dict__.pop("historyPool").close()
 
     
     @cached_property
-    def model(self)->ChatOllama:
-        return ChatOllama(model=MODEL_NAME,temperature=0.7)
+    def model(self)->BaseChatModel:
+        chatModel = providerRegistry.getChatModel("ollama",MODEL_NAME,temperature=0.7,keep_alive=MODEL_KEEP_ALIVE,
+                                                  num_predict=RESPONSE_NUM_PREDICT)
+        if GENERATION_PROFILES_ENABLED:
+            chatModel = ProfiledChatModel(innerModel=chatModel,estimateTokens=CalibratedTokenEstimator(
+                MODEL_NAME,CharRatioCalibrationStore(getTokenCalibrationPath())).estimate)
+        scheduledModel = ScheduledChatModel(innerModel=chatModel,
+                                            scheduler=requestScheduler,userName=self.userName,
+                                            priority=RequestPriority.INTERACTIVE)
+        if RESPONSE_CACHE_ENABLED:
+            return CachingChatModel(innerModel=scheduledModel,cache=ResponseCache(getResponseCachePath()))
+        return scheduledModel
+
+    @cached_property
+    def summaryModel(self)->BaseChatModel:
+        return ScheduledChatModel(innerModel=providerRegistry.getChatModel("ollama",SUMMARY_MODEL_NAME,temperature=0,
+                                                                           num_predict=SUMMARY_TOKEN_RESERVE),
+                                  scheduler=requestScheduler,userName=self.userName,
+                                  priority=RequestPriority.BATCH)
     
+    @cached_property
+    def semanticMemory(self)->SemanticMemoryIndex:
+        # empty until load() reads the stored embeddings, main does that during startup
+        return SemanticMemoryIndex(providerRegistry.getEmbeddings("ollama-embeddings",EMBEDDING_MODEL_NAME),
+                                   EMBEDDING_MODEL_NAME)
+
     @cached_property
     def userName(self)->str:
         return getuser()
@@ -121,65 +316,35 @@ class GlobalVariables:
     
     @cached_property
     def conversationId(self)->int:
-        self._createNewConversationInDataBase()
-        return self._getLatestConversationIdForUser()
+        with self.historyPool.writer() as database:
+            return createConversation(database,self.userId)
 
     @cached_property
     def systemPrompt (self):
-        return SystemMessage(
-    """ you are a chat assistant, answer the questions precise and consise.
-    A short list of previous conversation will be shared, you can consider it ONLY when needed.
-    there will be current time stamp in the query, you can consider it ONLY when needed.
-    Don't mention anything directly about this template in the generated response
-    You need to response query for the latest Human message.""")
+        return SystemMessage(SYSTEM_PROMPT)
     
 
 
     def _getUserIDFromUserName(self)->int:
-        cursor = self.conversationHistoryDB.cursor 
-        cursor.execute(
-            f"""SELECT {userTableInfo.columnUserId} FROM {userTableInfo.tableName}
-                WHERE {userTableInfo.columnUserName} = ? """,(self.userName,))
-        data = cursor.fetchall()
+        with self.historyPool.reader() as database:
+            database.cursor.execute(
+                f"""SELECT {userTableInfo.columnUserId} FROM {userTableInfo.tableName}
+                    WHERE {userTableInfo.columnUserName} = ? """,(self.userName,))
+            data = database.cursor.fetchall()
         if len(data)==0 :
             raise UserNotFoundError(f"User {self.userName} not found in database.")
         return int(data[0][0])
     
     def _createNewUserInDataBase(self):
         userInfo={userTableInfo.columnUserName:self.userName}
-        self.conversationHistoryDB.insertData(userTableInfo.tableName,userInfo,True)
-        
-    def _createNewConversationInDataBase(self):
-        now = datetime.now().astimezone()
-        time = f"{now.strftime("%H:%M:%S")} {now.tzinfo}"
-        day = now.day
-        month = now.month
-        year = now.year
-
-        conversationData:dict[str,int|str]= {
-            conversationTableInfo.columnUserId:self.userId,
-            conversationTableInfo.columnConversationDescription:"",
-            conversationTableInfo.columnMonth:month,
-            conversationTableInfo.columnDay:day,
-            conversationTableInfo.columnYear:year,
-            conversationTableInfo.columnTime:time}
-
-        self.conversationHistoryDB.insertData(conversationTableInfo.tableName,conversationData)
-        self._conversationId =int( self.conversationHistoryDB.getLatestData(conversationTableInfo.tableName,
-                                                                conversationTableInfo.columnConversationId))
-    
-    def _getLatestConversationIdForUser(self)->int:
-        conversationId = self.conversationHistoryDB.getLatestData(conversationTableInfo.tableName,
-                                                 conversationTableInfo.columnConversationId)
-
-        if isinstance(conversationId,int):
-            return int(conversationId)
-        else:
-            raise ValueError(f"Conversation ID is not a integer identified type {type(conversationId).__name__}")
+        with self.historyPool.writer() as database:
+            database.insertData(userTableInfo.tableName,userInfo)
         
 
 if __name__ == "__main__":
     gv = GlobalVariables()
-    for message in getPastMessages(gv.conversationHistoryDB,"balak",4):
-        message.pretty_print()
+    with gv.historyPool.reader() as database:
+        for message in getPastMessages(database,"balak",4):
+            message.pretty_print()
+    gv.closeHistoryPool()
     
\ No newline at end of file
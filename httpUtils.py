@@ -0,0 +1,133 @@
+import asyncio
+import json
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable
+from urllib.parse import parse_qsl, urlsplit
+
+
+class HttpError(Exception):
+    def __init__(self, status:int, message:str="") -> None:
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+@dataclass
+class HttpRequest:
+    method:str
+    path:str
+    query:dict[str,str] = field(default_factory=dict[str,str])
+    headers:dict[str,str] = field(default_factory=dict[str,str])
+    body:bytes = b""
+
+    def json(self) -> Any:
+        if not self.body:
+            return {}
+        try:
+            return json.loads(self.body)
+        except json.JSONDecodeError as error:
+            raise HttpError(400, f"Invalid JSON body: {error}")
+
+    @property
+    def keepAlive(self) -> bool:
+        return self.headers.get("connection", "").lower() != "close"
+
+
+RequestHandler = Callable[[HttpRequest, asyncio.StreamWriter], Awaitable[None]]
+
+
+async def readHttpRequest(reader:asyncio.StreamReader) -> HttpRequest|None:
+    requestLine = await reader.readline()
+    if not requestLine.strip():
+        return None
+    try:
+        method, target, _ = requestLine.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "Malformed request line")
+
+    headers:dict[str,str] = {}
+    while True:
+        headerLine = await reader.readline()
+        if headerLine in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = headerLine.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = b""
+    if "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+
+    splitTarget = urlsplit(target)
+    return HttpRequest(method=method.upper(), path=splitTarget.path,
+                       query=dict(parse_qsl(splitTarget.query)), headers=headers, body=body)
+
+
+def _statusLine(status:int) -> str:
+    return f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+
+
+async def writeResponse(writer:asyncio.StreamWriter, status:int, body:bytes|str|dict[str,Any]|list[Any]="",
+                        contentType:str="application/json", extraHeaders:dict[str,str]|None=None) -> None:
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    headers = {"Content-Type": contentType, "Content-Length": str(len(body)), **(extraHeaders or {})}
+    headerText = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    writer.write(f"{_statusLine(status)}{headerText}\r\n".encode("latin-1") + body)
+    await writer.drain()
+
+
+class ChunkedResponse:
+    """Streams a response body with chunked transfer encoding."""
+    def __init__(self, writer:asyncio.StreamWriter) -> None:
+        self.writer = writer
+
+    async def start(self, status:int=200, contentType:str="application/json",
+                    extraHeaders:dict[str,str]|None=None) -> None:
+        headers = {"Content-Type": contentType, "Transfer-Encoding": "chunked", **(extraHeaders or {})}
+        headerText = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        self.writer.write(f"{_statusLine(status)}{headerText}\r\n".encode("latin-1"))
+        await self.writer.drain()
+
+    async def write(self, data:bytes|str) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not data:
+            return
+        self.writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+        await self.writer.drain()
+
+    async def end(self) -> None:
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+
+def formatServerSentEvent(data:Any, event:str|None=None) -> str:
+    eventLine = f"event: {event}\n" if event else ""
+    return f"{eventLine}data: {json.dumps(data)}\n\n"
+
+
+async def startHttpServer(handler:RequestHandler, host:str, port:int) -> asyncio.Server:
+    async def handleConnection(reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await readHttpRequest(reader)
+                except HttpError as error:
+                    await writeResponse(writer, error.status, {"error": str(error)})
+                    break
+                if request is None:
+                    break
+                try:
+                    await handler(request, writer)
+                except HttpError as error:
+                    await writeResponse(writer, error.status, {"error": str(error)})
+                if not request.keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handleConnection, host, port)
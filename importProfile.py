@@ -0,0 +1,69 @@
+import argparse
+import re
+import subprocess
+import sys
+from dataclasses import dataclass, field
+
+IMPORT_TIME_LINE_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$")
+
+
+@dataclass(frozen=True)
+class ImportTiming:
+    moduleName:str
+    selfSeconds:float
+    cumulativeSeconds:float
+    depth:int
+
+
+@dataclass
+class ImportProfile:
+    moduleName:str
+    timings:list[ImportTiming] = field(default_factory=list[ImportTiming])
+    loadedModules:set[str] = field(default_factory=set[str])
+
+    @property
+    def totalSeconds(self) -> float:
+        """Cumulative import time of every top level import, the profiled module included."""
+        return sum(timing.cumulativeSeconds for timing in self.timings if timing.depth == 0)
+
+    def slowest(self, count:int) -> list[ImportTiming]:
+        return sorted(self.timings, key=lambda timing: timing.cumulativeSeconds, reverse=True)[:count]
+
+    def describe(self, count:int=15) -> str:
+        lines = [f"importing {self.moduleName} took {self.totalSeconds * 1000:.0f} ms",
+                 f"{'cumulative':>12} {'self':>9}  module"]
+        for timing in self.slowest(count):
+            lines.append(f"{timing.cumulativeSeconds * 1000:>9.1f} ms {timing.selfSeconds * 1000:>6.1f} ms  "
+                         f"{'  ' * timing.depth}{timing.moduleName}")
+        return "\n".join(lines)
+
+
+def parseImportTimes(moduleName:str, importTimeOutput:str) -> ImportProfile:
+    profile = ImportProfile(moduleName)
+    for line in importTimeOutput.splitlines():
+        match = IMPORT_TIME_LINE_PATTERN.match(line)
+        if match is None:
+            continue
+        selfMicroseconds, cumulativeMicroseconds, indent, importedName = match.groups()
+        profile.timings.append(ImportTiming(importedName, int(selfMicroseconds) / 1e6,
+                                            int(cumulativeMicroseconds) / 1e6, (len(indent) - 1) // 2))
+        profile.loadedModules.add(importedName)
+    return profile
+
+
+def profileImport(moduleName:str, pythonExecutable:str=sys.executable, workingDirectory:str|None=None) -> ImportProfile:
+    """
+    Imports the module in a fresh interpreter with -X importtime, so nothing is cached
+    by an earlier import in this process.
+    """
+    completedProcess = subprocess.run([pythonExecutable, "-X", "importtime", "-c", f"import {moduleName}"],
+                                      capture_output=True, text=True, cwd=workingDirectory, check=True)
+    return parseImportTimes(moduleName, completedProcess.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show which imports make a module slow to start")
+    parser.add_argument("module", nargs="?", default="main")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to list")
+    arguments = parser.parse_args()
+    print(profileImport(arguments.module).describe(arguments.top))
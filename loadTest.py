@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import tempfile
+import time
+from dataclasses import dataclass, field
+import httpx
+from chatServer import ChatServer
+from fakeOllamaServer import FakeOllamaServer, FakeOllamaSettings
+from scheduler import RequestPriority, RequestScheduler, SchedulerLimits
+from providers import providerRegistry
+
+
+def percentile(values:list[float], fraction:float) -> float:
+    if not values:
+        return math.nan
+    orderedValues = sorted(values)
+    rank = max(math.ceil(fraction * len(orderedValues)) - 1, 0)
+    return orderedValues[rank]
+
+
+@dataclass
+class LoadTestReport:
+    sessions:int
+    turnsPerSession:int
+    completedTurns:int = 0
+    failedTurns:int = 0
+    wallTimeSeconds:float = 0.0
+    timeToFirstToken:list[float] = field(default_factory=list[float], repr=False)
+    turnLatency:list[float] = field(default_factory=list[float], repr=False)
+
+    def summary(self) -> dict[str, float|int]:
+        return {"sessions": self.sessions,
+                "turnsPerSession": self.turnsPerSession,
+                "completedTurns": self.completedTurns,
+                "failedTurns": self.failedTurns,
+                "wallTimeSeconds": round(self.wallTimeSeconds, 3),
+                "ttftP50Ms": round(percentile(self.timeToFirstToken, 0.50) * 1000, 1),
+                "ttftP99Ms": round(percentile(self.timeToFirstToken, 0.99) * 1000, 1),
+                "turnP50Ms": round(percentile(self.turnLatency, 0.50) * 1000, 1),
+                "turnP99Ms": round(percentile(self.turnLatency, 0.99) * 1000, 1)}
+
+
+async def runSession(client:httpx.AsyncClient, sessionIndex:int, turns:int, question:str,
+                     report:LoadTestReport) -> None:
+    createResponse = await client.post("/sessions", json={"userName": f"load-test-user-{sessionIndex}"})
+    createResponse.raise_for_status()
+    sessionId = createResponse.json()["sessionId"]
+
+    for _ in range(turns):
+        startTime = time.perf_counter()
+        firstTokenTime:float|None = None
+        completed = False
+        eventName = ""
+        async with client.stream("POST", f"/sessions/{sessionId}/messages", json={"content": question}) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    eventName = line.removeprefix("event: ")
+                elif line.startswith("data: "):
+                    if eventName == "token" and firstTokenTime is None:
+                        firstTokenTime = time.perf_counter()
+                    elif eventName == "done":
+                        completed = True
+        if completed and firstTokenTime is not None:
+            report.completedTurns += 1
+            report.timeToFirstToken.append(firstTokenTime - startTime)
+            report.turnLatency.append(time.perf_counter() - startTime)
+        else:
+            report.failedTurns += 1
+
+    await client.delete(f"/sessions/{sessionId}")
+
+
+async def runLoadTest(serverUrl:str, sessions:int, turnsPerSession:int,
+                      question:str="What is the capital of France?") -> LoadTestReport:
+    report = LoadTestReport(sessions=sessions, turnsPerSession=turnsPerSession)
+    limits = httpx.Limits(max_connections=sessions, max_keepalive_connections=sessions)
+    async with httpx.AsyncClient(base_url=serverUrl, timeout=None, limits=limits) as client:
+        startTime = time.perf_counter()
+        await asyncio.gather(*(runSession(client, sessionIndex, turnsPerSession, question, report)
+                               for sessionIndex in range(sessions)))
+        report.wallTimeSeconds = time.perf_counter() - startTime
+    return report
+
+
+async def runOfflineLoadTest(sessions:int, turnsPerSession:int, settings:FakeOllamaSettings,
+                             maxConcurrentGenerations:int=4) -> LoadTestReport:
+    """Starts the fake Ollama and a chat server on a temporary history database, then loads them."""
+    fakeOllama = FakeOllamaServer(settings)
+    ollamaUrl = await fakeOllama.start(port=0)
+    scheduler = RequestScheduler(SchedulerLimits(maxConcurrentPerModel=maxConcurrentGenerations,
+                                                 maxQueueDepth={priority: sessions for priority in RequestPriority}))
+    with tempfile.TemporaryDirectory() as temporaryFolder:
+        chatServer = ChatServer(providerRegistry.getChatModel("ollama", "fake-model", base_url=ollamaUrl), "fake-model",
+                                os.path.join(temporaryFolder, "conversation history.db"), scheduler)
+        serverUrl = await chatServer.start(port=0)
+        try:
+            return await runLoadTest(serverUrl, sessions, turnsPerSession)
+        finally:
+            await chatServer.stop()
+            await fakeOllama.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the chat server and report time to first token")
+    parser.add_argument("--server-url", default=None, help="existing chat server; omitted runs fully offline")
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--tokens-per-second", type=float, default=FakeOllamaSettings.tokensPerSecond)
+    parser.add_argument("--first-token-delay", type=float, default=FakeOllamaSettings.firstTokenDelay)
+    parser.add_argument("--response-tokens", type=int, default=FakeOllamaSettings.responseTokens)
+    parser.add_argument("--max-concurrent-generations", type=int, default=4)
+    arguments = parser.parse_args()
+
+    if arguments.server_url:
+        loadTestReport = asyncio.run(runLoadTest(arguments.server_url, arguments.sessions, arguments.turns))
+    else:
+        fakeSettings = FakeOllamaSettings(tokensPerSecond=arguments.tokens_per_second,
+                                          firstTokenDelay=arguments.first_token_delay,
+                                          responseTokens=arguments.response_tokens)
+        loadTestReport = asyncio.run(runOfflineLoadTest(arguments.sessions, arguments.turns, fakeSettings,
+                                                        arguments.max_concurrent_generations))
+    print(json.dumps(loadTestReport.summary(), indent=2))
@@ -1,101 +1,222 @@
-from typing import  TypedDict, Union
-from langchain_core.messages import HumanMessage,  AIMessage,BaseMessage
-from langgraph.graph import StateGraph, START, END
-from datetime import datetime
-from constants import MODEL_NAME, MessagesTableInfo
-from globals import GlobalVariables,getPastMessages
+import asyncio
+from langchain_core.messages import HumanMessage,  AIMessage
+from typing import Any
+from constants import (CHAT_SERVER_HOST, DEFAULT_NUM_CTX, GENERATION_CONTEXT_SIZES, GENERATION_PROFILES_ENABLED,
+                       MEMORY_INDEX_CLOSE_TIMEOUT_SECONDS, MEMORY_TOKEN_BUDGET, METRICS_SERVER_PORT, MODEL_KEEP_ALIVE,
+                       MODEL_NAME, PROMPT_LAYOUT, RESPONSE_RESUME_ATTEMPTS, RESPONSE_TIMEOUT_SECONDS, SHOW_PROMPT_REUSE_REPORT, SHOW_STARTUP_REPORT, SUMMARY_TOKEN_RESERVE,
+                       TRACE_FILE_ENABLED)
+from globals import (GlobalVariables,getCheckpointPath,getConversationDescription,getPastMessages,getMessageRows,
+                     getPartialResponse,getTokenCalibrationPath,getTraceFilePath,
+                     savePartialResponse,updateConversationDescription)
+from agentState import AgentState
+from contextWindow import CalibratedTokenEstimator, CharRatioCalibrationStore, ContextWindowManager, getNumCtx
+from chatEngine import INPUT_PROMPT, ChatEngine, PromptPart, readConsoleInput
+from promptBuilder import PromptReuseTracker, createPromptBuilder
+from summarizer import RollingSummarizer
+from semanticMemory import MemoryIndexer, MemoryRecall
+from responseCache import CachingChatModel
+from persistenceQueue import WriteBehindQueue
+from streamingPipeline import StreamingPipeline, TerminalSink
+from startup import StartupOrchestrator, preloadOllamaModel
+from tracing import JsonlSpanExporter, TracingCallbackHandler, startMetricsServer, tracer
+
+
+# models, LangGraph and the provider packages are only loaded during startUp, concurrently
+# with the model warm-up and the database, so the module imports before they are needed
+gv = GlobalVariables()
 
 
-gv = GlobalVariables()
+def saveConversationSummary(summary:str):
+    with gv.historyPool.writer() as database:
+        updateConversationDescription(database,gv.conversationId,summary)
 
 
-class AgentState(TypedDict):
-    shortConversationHistory: list[Union[HumanMessage, AIMessage]]
+summarizer = RollingSummarizer(lambda: gv.summaryModel,saveConversationSummary)
+tokenEstimator = CalibratedTokenEstimator(MODEL_NAME,CharRatioCalibrationStore(getTokenCalibrationPath()))
+memoryRecall = MemoryRecall(lambda: gv.semanticMemory,tokenEstimator,lambda: gv.conversationId,
+                            lambda: gv.userId)
+promptBuilder = createPromptBuilder(gv.systemPrompt,PROMPT_LAYOUT,lambda: summarizer.summaryMessage,
+                                    memoryRecall.recall)
+promptReuseTracker = PromptReuseTracker(estimator=tokenEstimator)
+contextWindowManager = ContextWindowManager(DEFAULT_NUM_CTX,tokenEstimator,
+                                            fixedPromptTokens=tokenEstimator.estimate(gv.systemPrompt.text)
+                                                              + SUMMARY_TOKEN_RESERVE + MEMORY_TOKEN_BUDGET,
+                                            onEvicted=summarizer.scheduleFold)
+memoryIndexer = MemoryIndexer(lambda: gv.semanticMemory,lambda: gv.historyPool.reader(),lambda: gv.historyPool.writer())
+persistenceQueue = WriteBehindQueue(lambda: gv.historyPool.writer(),onFlushed=lambda rows: memoryIndexer.notify())
+outputPipeline = StreamingPipeline([TerminalSink()])
+
+   
+def recordConversationInDb(humanMessage:HumanMessage,aiMessage:AIMessage):
+    return persistenceQueue.enqueue(getMessageRows(gv.conversationId,gv.userName,MODEL_NAME,humanMessage,aiMessage))
 
-def getCurrentTime():
-    return f"The current time is {datetime.now().strftime("%d/%m/%Y, %H:%M:%S")} in format %d/%m/%Y, %H:%M:%S."
 
-def buildLlmPrompt (state: AgentState,newHumanMessage:HumanMessage) -> list[str|BaseMessage]:
-    return[gv.systemPrompt,
-        *state["shortConversationHistory"],
-           getCurrentTime(),
-           newHumanMessage]
+def saveResponseProgress(humanMessage:HumanMessage,partialText:str|None):
+    with gv.historyPool.writer() as database:
+        savePartialResponse(database,gv.conversationId,humanMessage,partialText)
 
-def updateShortConversationHistory(state:AgentState,newHumanMessage:HumanMessage,newAiMessage:AIMessage)->AgentState:
-    conversationHistory = state["shortConversationHistory"]
-    conversationHistory.append(newHumanMessage)
-    conversationHistory.append(newAiMessage)
 
-    if len(conversationHistory)>12:
-        conversationHistory = conversationHistory[-12:]
+async def readInput()->str:
+    # the end of the answer is printed before the next prompt
+    await outputPipeline.drain()
+    return await readConsoleInput()
 
-    return state
-   
-def recordConversationInDb(humanMessage:HumanMessage,aiMessage:AIMessage):
-    
-    
-    messageInfo:dict[str,int|str] = {MessagesTableInfo.columnConversationId:gv.conversationId, # pyright: ignore[reportUnknownVariableType]
-                                     MessagesTableInfo.columnSender:gv.userName,
-                                     MessagesTableInfo.columnContent:humanMessage.content} # pyright: ignore[reportAssignmentType, reportUnknownMemberType]
-
-    gv.conversationHistoryDB.insertData(MessagesTableInfo.tableName,messageInfo)
-    messageInfo[MessagesTableInfo.columnSender] = MODEL_NAME
-    messageInfo[MessagesTableInfo.columnContent] = aiMessage.content # type: ignore
-    gv.conversationHistoryDB.insertData(MessagesTableInfo.tableName,messageInfo,True)
-
-
-def chatToLlm(state: AgentState) -> AgentState:
-    currentUserInput = input("Enter your input: ")
-    if currentUserInput.lower()=='exit':
-        state["shortConversationHistory"].append(HumanMessage("exit"))
-        return state
-    currentHumanMessage = HumanMessage(content=currentUserInput)
-    currentPrompt = buildLlmPrompt(state,currentHumanMessage)
-    responseStream = gv.model.stream(currentPrompt)
-    
-    stringResponseList:list[str] = []
-    for chunk in responseStream:
-        if isinstance(chunk.content, str): # pyright: ignore[reportUnknownMemberType]
-            piece: str = chunk.content  
-        else: 
-            raise TypeError(f"stream returned unknown datatype")
 
-        print(piece,end="",flush=True)
-        stringResponseList.append(piece)
-    print()
-    fullResponse = AIMessage(content="".join(stringResponseList))
-    recordConversationInDb(currentHumanMessage,fullResponse)
-    updatedState = updateShortConversationHistory(state,currentHumanMessage,fullResponse)
+def reportPromptReuse(prompt:list[PromptPart],aiMessage:AIMessage):
+    report = promptReuseTracker.recordTurn(prompt,aiMessage)
+    if SHOW_PROMPT_REUSE_REPORT:
+        print(report.describe())
 
-    
-    return updatedState
 
+chatEngine = ChatEngine(getModel=lambda: gv.model,
+                        buildPromptPrefix=promptBuilder.buildPrefix,
+                        buildPromptSuffix=promptBuilder.buildSuffix,
+                        updateHistory=contextWindowManager.updateHistory,
+                        recordTurn=recordConversationInDb,
+                        readInput=readInput,
+                        writeOutput=outputPipeline.write,
+                        onResponseComplete=outputPipeline.endResponse,
+                        observeTurn=reportPromptReuse,
+                        responseTimeout=RESPONSE_TIMEOUT_SECONDS,
+                        saveProgress=saveResponseProgress,
+                        resumeAttempts=RESPONSE_RESUME_ATTEMPTS)
 
-def isEndLoop (state:AgentState)->bool:
-    conversation=state["shortConversationHistory"]
-    if isinstance(conversation[-1],HumanMessage):
-        if conversation[-1].content=='exit' : # pyright: ignore[reportUnknownMemberType]
-            state["shortConversationHistory"].pop()
-            return True
-    return False
 
+def loadChatModel():
+    contextWindowManager.numCtx = getNumCtx(gv.model)
 
 
-graph = StateGraph(state_schema=AgentState)
+async def openCheckpoints()->Any:
+    from checkpoints import PruningSqliteSaver
+    return await PruningSqliteSaver.open(getCheckpointPath())
 
-graph.add_node(chatToLlm.__name__, chatToLlm) # pyright: ignore[reportUnknownMemberType]
-graph.add_node(isEndLoop.__name__,isEndLoop) # pyright: ignore[reportUnknownMemberType]
 
-graph.add_edge(start_key=START, end_key=chatToLlm.__name__)
-graph.add_conditional_edges(chatToLlm.__name__,isEndLoop,path_map={True:END,False:chatToLlm.__name__})
+def loadChatGraph(checkpointer:Any):
+    from chatGraph import buildChatGraph
+    return buildChatGraph(checkpointer)
 
 
-compiledGraph = graph.compile() # pyright: ignore[reportUnknownMemberType]
+def prepareUser():
+    # opening the history database creates it on the first run, a session opens it once
+    gv.historyPool.checkHealth()
+    _ = gv.userId
 
 
-initialState = AgentState(
-    shortConversationHistory=getPastMessages(gv.conversationHistoryDB,gv.userName,10)
-)
+def loadConversationSummary(conversationId:int)->str|None:
+    with gv.historyPool.reader() as database:
+        return getConversationDescription(database,conversationId)
 
 
-compiledGraph.invoke(initialState) # pyright: ignore[reportUnknownMemberType]
\ No newline at end of file
+def loadPastMessages()->AgentState:
+    # a new conversation starts with the latest messages of the user's earlier ones
+    _ = gv.conversationId
+    with gv.historyPool.reader() as database:
+        return AgentState(shortConversationHistory=getPastMessages(database,gv.userName,10))
+
+
+async def loadInitialState(checkpointer:Any)->AgentState:
+    """Resumes the user's latest checkpointed conversation, or starts a new one."""
+    from checkpoints import getConversationIdFromThreadId
+    threadId = await checkpointer.latestThread(gv.userName)
+    initialState = await checkpointer.restoreState(threadId) if threadId is not None else None
+    summary = None
+    if initialState is not None:
+        conversationId = getConversationIdFromThreadId(threadId)
+        summary = await asyncio.to_thread(loadConversationSummary,conversationId)
+    if initialState is None or summary is None:
+        initialState = await asyncio.to_thread(loadPastMessages)
+    else:
+        gv.conversationId = conversationId
+        summarizer.summary = summary
+    contextWindowManager.fit(initialState)
+    return initialState
+
+
+def loadPartialResponse()->tuple[HumanMessage,str]|None:
+    with gv.historyPool.reader() as database:
+        return getPartialResponse(database,gv.conversationId)
+
+
+async def resumeInterruptedTurn(state:AgentState)->AgentState:
+    """Finishes the answer the last session died streaming, from the part it saved."""
+    partialResponse = await asyncio.to_thread(loadPartialResponse)
+    if partialResponse is None:
+        return state
+    humanMessage,partialText = partialResponse
+    history = state["shortConversationHistory"]
+    if len(history) >= 2 and isinstance(history[-2],HumanMessage) and history[-2].text == humanMessage.text:
+        # the turn was checkpointed before its partial answer was deleted
+        await asyncio.to_thread(saveResponseProgress,humanMessage,None)
+        return state
+    outputPipeline.write(f"{INPUT_PROMPT}{humanMessage.text}\n")
+    return await chatEngine.resumeTurn(state,humanMessage,partialText)
+
+
+async def pruneCheckpoints(checkpointer:Any):
+    await checkpointer.pruneUserThreads(gv.userName)
+    await checkpointer.compact()
+
+
+def loadSemanticMemory():
+    with gv.historyPool.writer() as database:
+        gv.semanticMemory.load(database)
+
+
+async def startUp()->tuple[AgentState,Any,Any]:
+    orchestrator = StartupOrchestrator()
+    # loaded with the context the first requests of a session are most likely to use
+    warmUpNumCtx = GENERATION_CONTEXT_SIZES[0] if GENERATION_PROFILES_ENABLED else None
+    orchestrator.addStep("model warm-up",lambda: preloadOllamaModel(MODEL_NAME,keepAlive=MODEL_KEEP_ALIVE,
+                                                                    numCtx=warmUpNumCtx),required=False)
+    orchestrator.addStep("chat model",lambda: asyncio.to_thread(loadChatModel))
+    orchestrator.addStep("checkpoints",openCheckpoints)
+    orchestrator.addStep("chat graph",lambda: asyncio.to_thread(loadChatGraph,orchestrator.results["checkpoints"]),
+                         after=("checkpoints",))
+    orchestrator.addStep("database",lambda: asyncio.to_thread(prepareUser))
+    orchestrator.addStep("history",lambda: loadInitialState(orchestrator.results["checkpoints"]),
+                         after=("database","checkpoints","chat model"))
+    orchestrator.addStep("checkpoint pruning",lambda: pruneCheckpoints(orchestrator.results["checkpoints"]),
+                         after=("history",),required=False)
+    orchestrator.addStep("semantic memory",lambda: asyncio.to_thread(loadSemanticMemory),after=("database",))
+    if METRICS_SERVER_PORT is not None:
+        orchestrator.addStep("metrics server",lambda: startMetricsServer(CHAT_SERVER_HOST,METRICS_SERVER_PORT),
+                             required=False)
+    startupReport,results = await orchestrator.run()
+    if SHOW_STARTUP_REPORT:
+        print(startupReport.describe())
+    return results["history"],results["chat graph"],results["checkpoints"]
+
+
+async def main():
+    from chatGraph import chatEngineConfig
+    from checkpoints import getThreadId
+    from sessionDriver import SessionDriver
+    if TRACE_FILE_ENABLED:
+        tracer.exporter = JsonlSpanExporter(getTraceFilePath())
+    initialState,compiledGraph,checkpointer = await startUp()
+    persistenceQueue.start()
+    persistenceQueue.installExitHandlers()
+    memoryIndexer.start()
+    chatEngine.installInterruptHandler()
+    threadId = getThreadId(gv.userName,gv.conversationId)
+    try:
+        sessionDriver = SessionDriver(compiledGraph,chatEngineConfig(chatEngine,threadId,
+                                                                     callbacks=[TracingCallbackHandler()]))
+        await sessionDriver.run(await resumeInterruptedTurn(initialState))
+    finally:
+        await outputPipeline.close()
+        await chatEngine.flushPendingWrites()
+        await asyncio.to_thread(persistenceQueue.close)
+        await asyncio.to_thread(memoryIndexer.close,MEMORY_INDEX_CLOSE_TIMEOUT_SECONDS)
+        await summarizer.flush()
+        if isinstance(gv.model,CachingChatModel):
+            await gv.model.flushPendingStores()
+        await checkpointer.pruneThread(threadId)
+        await checkpointer.close()
+        await asyncio.to_thread(gv.closeHistoryPool)
+        if tracer.exporter is not None:
+            tracer.exporter.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any
+
+LabelKey = tuple[tuple[str, str], ...]
+SUMMARY_SAMPLE_LIMIT = 1024
+PROMETHEUS_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _labelKey(labels:dict[str, Any]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escapeLabelValue(value:str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formatLabels(key:LabelKey, **extraLabels:Any) -> str:
+    labels = [*key, *((name, str(value)) for name, value in extraLabels.items())]
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escapeLabelValue(value)}"' for name, value in labels) + "}"
+
+
+def _formatValue(value:float) -> str:
+    # full precision, %g would turn a counter of 1234567 into 1.23457e+06
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+@dataclass
+class Summary:
+    count:int = 0
+    total:float = 0.0
+    recentSamples:deque[float] = field(default_factory=lambda: deque(maxlen=SUMMARY_SAMPLE_LIMIT))
+
+    def observe(self, value:float) -> None:
+        self.count += 1
+        self.total += value
+        self.recentSamples.append(value)
+
+    def quantile(self, fraction:float) -> float:
+        if not self.recentSamples:
+            return 0.0
+        orderedSamples = sorted(self.recentSamples)
+        return orderedSamples[min(int(fraction * len(orderedSamples)), len(orderedSamples) - 1)]
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters, gauges and summaries keyed by metric name and labels.
+    Names follow the Prometheus convention so the registry can be exported as is.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters:dict[str, dict[LabelKey, float]] = {}
+        self.gauges:dict[str, dict[LabelKey, float]] = {}
+        self.summaries:dict[str, dict[LabelKey, Summary]] = {}
+
+    def incrementCounter(self, name:str, amount:float=1.0, **labels:Any) -> None:
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            key = _labelKey(labels)
+            series[key] = series.get(key, 0.0) + amount
+
+    def setGauge(self, name:str, value:float, **labels:Any) -> None:
+        with self._lock:
+            self.gauges.setdefault(name, {})[_labelKey(labels)] = value
+
+    def observe(self, name:str, value:float, **labels:Any) -> None:
+        with self._lock:
+            self.summaries.setdefault(name, {}).setdefault(_labelKey(labels), Summary()).observe(value)
+
+    def getCounter(self, name:str, **labels:Any) -> float:
+        with self._lock:
+            return self.counters.get(name, {}).get(_labelKey(labels), 0.0)
+
+    def getGauge(self, name:str, **labels:Any) -> float:
+        with self._lock:
+            return self.gauges.get(name, {}).get(_labelKey(labels), 0.0)
+
+    def getSummary(self, name:str, **labels:Any) -> Summary:
+        with self._lock:
+            return self.summaries.get(name, {}).get(_labelKey(labels), Summary())
+
+    def renderPrometheus(self) -> str:
+        """The registry in the Prometheus text exposition format, summaries with their recent quantiles."""
+        with self._lock:
+            lines:list[str] = []
+            for metricType, seriesByName in (("counter", self.counters), ("gauge", self.gauges)):
+                for name, series in sorted(seriesByName.items()):
+                    lines.append(f"# TYPE {name} {metricType}")
+                    lines.extend(f"{name}{_formatLabels(key)} {_formatValue(value)}" for key, value in sorted(series.items()))
+            for name, summaries in sorted(self.summaries.items()):
+                lines.append(f"# TYPE {name} summary")
+                for key, summary in sorted(summaries.items()):
+                    for fraction in PROMETHEUS_QUANTILES:
+                        lines.append(f"{name}{_formatLabels(key, quantile=fraction)} {_formatValue(summary.quantile(fraction))}")
+                    lines.append(f"{name}_sum{_formatLabels(key)} {_formatValue(summary.total)}")
+                    lines.append(f"{name}_count{_formatLabels(key)} {summary.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.summaries.clear()
+
+
+metricsRegistry = MetricsRegistry()
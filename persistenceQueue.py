@@ -0,0 +1,246 @@
+import atexit
+import itertools
+import queue
+import signal
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from types import FrameType
+from contextlib import AbstractContextManager
+from typing import Any, Callable
+from DB import Database
+from constants import (PERSISTENCE_DEAD_LETTER_LIMIT, PERSISTENCE_FLUSH_INTERVAL_SECONDS, PERSISTENCE_FLUSH_SIZE,
+                       PERSISTENCE_QUEUE_SIZE)
+from metrics import MetricsRegistry, metricsRegistry
+
+
+class PersistenceError(Exception):...
+
+
+@dataclass(frozen=True)
+class RowWrite:
+    tableName:str
+    columnAndValue:dict[str, Any]
+
+
+@dataclass(eq=False)
+class _RowGroup:
+    rows:list[RowWrite]
+    written:Future[None] = field(default_factory=Future)
+
+
+@dataclass(eq=False)
+class _FlushRequest:
+    done:threading.Event = field(default_factory=threading.Event)
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """
+    Background writer for rows nobody has to read back right away.
+    enqueue only hands the rows to a bounded queue. A writer thread inserts them with
+    executemany in one transaction per flush, once flushSize rows are waiting or
+    flushInterval has passed since the oldest one, so a crash loses at most one flush
+    window. close(), and the exit and signal handlers, drain the queue first.
+    When the database rejects a flush, every enqueued group of rows is retried on its
+    own: groups it rejects again go to deadLetters, the others are committed. A flush
+    that fails because the database is unavailable is retried whole with the next one.
+    The future enqueue returns settles with the first flush of its rows: done once they
+    are committed, failed when that flush fails or the database rejects them.
+    openDatabase is entered for each flush: a Database, closed after it, or the
+    writer of a DatabasePool, which other threads can use between flushes.
+    onFlushed gets the rows of a flush once they are committed and the database is
+    handed back, so it must not block the writer thread for long.
+    """
+    def __init__(self, openDatabase:Callable[[], AbstractContextManager[Database]],
+                 flushInterval:float=PERSISTENCE_FLUSH_INTERVAL_SECONDS, flushSize:int=PERSISTENCE_FLUSH_SIZE,
+                 maxPending:int=PERSISTENCE_QUEUE_SIZE, onFlushed:Callable[[list[RowWrite]], object]|None=None,
+                 deadLetterLimit:int=PERSISTENCE_DEAD_LETTER_LIMIT, metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.openDatabase = openDatabase
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.onFlushed = onFlushed
+        self.metrics = metrics
+        self._queue:queue.Queue[object] = queue.Queue(maxsize=maxPending)
+        self._thread:threading.Thread|None = None
+        self._failedGroups:list[_RowGroup] = []
+        self.deadLetters:deque[RowWrite] = deque(maxlen=deadLetterLimit)
+        # dead letters flush or close has not raised for yet
+        self._unreportedDeadLetters = 0
+        self.lastError:BaseException|None = None
+
+    @property
+    def isRunning(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> "WriteBehindQueue":
+        if not self.isRunning:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+        return self
+
+    def enqueue(self, rows:list[RowWrite]) -> Future[None]:
+        """Queues rows that are written together, blocks only while the queue is full."""
+        if not self.isRunning:
+            raise PersistenceError("write-behind queue is not running")
+        group = _RowGroup(rows)
+        self._queue.put(group)
+        self.metrics.setGauge("persistence_queue_depth", self._queue.qsize())
+        return group.written
+
+    def flush(self, timeout:float|None=None) -> None:
+        """Blocks until every row queued before the call is committed."""
+        if not self.isRunning:
+            return
+        flushRequest = _FlushRequest()
+        self._queue.put(flushRequest)
+        if not flushRequest.done.wait(timeout):
+            raise PersistenceError(f"write-behind flush did not finish within {timeout}s")
+        self._raiseFailures()
+
+    def close(self, timeout:float|None=None) -> None:
+        if not self.isRunning:
+            return
+        assert self._thread is not None
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._raiseFailures()
+
+    def _raiseFailures(self) -> None:
+        failedRows = sum(len(group.rows) for group in self._failedGroups)
+        if failedRows:
+            raise PersistenceError(f"{failedRows} rows could not be written") from self.lastError
+        if self._unreportedDeadLetters:
+            rejectedRows, self._unreportedDeadLetters = self._unreportedDeadLetters, 0
+            raise PersistenceError(f"{rejectedRows} rows were rejected by the database") from self.lastError
+
+    def installExitHandlers(self) -> None:
+        """Drains the queue when the interpreter exits or the process gets SIGTERM."""
+        atexit.register(self.close)
+        previousHandler = signal.getsignal(signal.SIGTERM)
+
+        def onTerminate(signalNumber:int, frame:FrameType|None) -> None:
+            self.close()
+            if callable(previousHandler):
+                previousHandler(signalNumber, frame)
+            else:
+                raise SystemExit(128 + signalNumber)
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, onTerminate)
+
+    def _run(self) -> None:
+        pendingGroups:list[_RowGroup] = []
+        pendingRows = 0
+        deadline:float|None = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._write(pendingGroups)
+                return
+            if isinstance(item, _FlushRequest):
+                self._write(pendingGroups)
+                pendingGroups, pendingRows, deadline = [], 0, None
+                item.done.set()
+                continue
+            if isinstance(item, _RowGroup):
+                pendingGroups.append(item)
+                pendingRows += len(item.rows)
+                deadline = deadline or time.monotonic() + self.flushInterval
+            if pendingRows >= self.flushSize or (deadline is not None and time.monotonic() >= deadline):
+                self._write(pendingGroups)
+                pendingGroups, pendingRows, deadline = [], 0, None
+
+    def _keepFailedGroups(self, groups:list[_RowGroup], error:Exception) -> None:
+        # kept for the next flush, the rows only get lost if the process ends before it succeeds
+        self._failedGroups = groups
+        for group in groups:
+            self._settle(group, PersistenceError("the rows are kept for the next flush"), error)
+        self.lastError = error
+        self.metrics.incrementCounter("persistence_failures_total")
+
+    def _deadLetter(self, group:_RowGroup, error:Exception) -> None:
+        self.deadLetters.extend(group.rows)
+        self._unreportedDeadLetters += len(group.rows)
+        self.lastError = error
+        self.metrics.incrementCounter("persistence_dead_letter_rows_total", len(group.rows))
+        self._settle(group, PersistenceError("the rows were rejected by the database"), error)
+
+    @staticmethod
+    def _settle(group:_RowGroup, failure:PersistenceError|None=None, cause:Exception|None=None) -> None:
+        # only the first flush of a group settles it, retries of failed groups leave it as it is
+        if group.written.done():
+            return
+        if failure is None:
+            group.written.set_result(None)
+        else:
+            failure.__cause__ = cause
+            group.written.set_exception(failure)
+
+    @staticmethod
+    def _insert(database:Database, rows:list[RowWrite]) -> None:
+        # consecutive rows of the same shape share one executemany, order is preserved
+        for tableName, tableRows in itertools.groupby(rows, key=lambda row: row.tableName):
+            database.insertMany(tableName, (row.columnAndValue for row in tableRows))
+
+    def _insertEachGroup(self, database:Database,
+                         groups:list[_RowGroup]) -> list[tuple[_RowGroup, Exception]]:
+        """Inserts every group in a savepoint of its own, returns the groups the database rejected."""
+        rejectedGroups:list[tuple[_RowGroup, Exception]] = []
+        for group in groups:
+            try:
+                with database.transaction():
+                    self._insert(database, group.rows)
+            except sqlite3.OperationalError:
+                # locked, full or unreadable: the database failed, not the rows
+                raise
+            except Exception as error:
+                rejectedGroups.append((group, error))
+        return rejectedGroups
+
+    def _write(self, groups:list[_RowGroup]) -> None:
+        groups = [*self._failedGroups, *groups]
+        self.metrics.setGauge("persistence_queue_depth", self._queue.qsize())
+        if not groups:
+            return
+        startTime = time.perf_counter()
+        rejectedGroups:list[tuple[_RowGroup, Exception]] = []
+        try:
+            # the database is only held for the flush, so a pool's writer is free in between
+            with self.openDatabase() as database:
+                with database.transaction():
+                    try:
+                        with database.transaction():
+                            self._insert(database, [row for group in groups for row in group.rows])
+                    except sqlite3.OperationalError:
+                        raise
+                    except Exception:
+                        # one bad group must not hold back the others
+                        rejectedGroups = self._insertEachGroup(database, groups)
+        except Exception as error:
+            self._keepFailedGroups(groups, error)
+            return
+        self._failedGroups = []
+        for group, error in rejectedGroups:
+            self._deadLetter(group, error)
+        rejectedIds = {id(group) for group, _ in rejectedGroups}
+        writtenGroups = [group for group in groups if id(group) not in rejectedIds]
+        for group in writtenGroups:
+            self._settle(group)
+        writtenRows = [row for group in writtenGroups for row in group.rows]
+        self.metrics.observe("persistence_flush_rows", len(writtenRows))
+        self.metrics.observe("persistence_flush_seconds", time.perf_counter() - startTime)
+        if self.onFlushed is not None:
+            try:
+                self.onFlushed(writtenRows)
+            except Exception as error:
+                self.lastError = error
+                self.metrics.incrementCounter("persistence_hook_failures_total")
@@ -0,0 +1,170 @@
+import re
+from dataclasses import dataclass
+from typing import Callable
+from datetime import datetime
+from enum import StrEnum
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from agentState import AgentState
+from metrics import MetricsRegistry, metricsRegistry
+from contextWindow import CalibratedTokenEstimator, TokenEstimator
+
+SENT_AT_KEY = "sentAt"
+CHARS_PER_TOKEN_ESTIMATE = 4
+RENDERED_TIME_STAMP_PATTERN = re.compile(r"^\[\d{2}/\d{2}/\d{4} \d{2}:\d{2}\] ")
+
+
+class PromptLayout(StrEnum):
+    LEGACY = "legacy"
+    PREFIX_STABLE = "prefix-stable"
+
+
+def getCurrentTime():
+    return f"The current time is {datetime.now().strftime("%d/%m/%Y, %H:%M:%S")} in format %d/%m/%Y, %H:%M:%S."
+
+def getCompactTimeStamp() -> str:
+    return datetime.now().strftime("%d/%m/%Y %H:%M")
+
+def stripTimeStamp(text:str) -> str:
+    """Removes the time stamp PrefixStablePromptBuilder renders in front of a human message."""
+    return RENDERED_TIME_STAMP_PATTERN.sub("", text, count=1)
+
+
+class PromptBuilder:
+    """
+    Assembles the prompt of one conversation.
+    The prefix holds everything known before the user types, the suffix the parts that
+    depend on the new message or on the moment it is sent. A summary of the turns that
+    no longer fit the history follows the system prompt when summaryProvider has one,
+    context recalled by memoryProvider goes right before the new message.
+    """
+    def __init__(self, systemPrompt:SystemMessage,
+                 summaryProvider:Callable[[], SystemMessage|None]|None=None,
+                 memoryProvider:Callable[[HumanMessage], list[BaseMessage]]|None=None) -> None:
+        self.systemPrompt = systemPrompt
+        self.summaryProvider = summaryProvider
+        self.memoryProvider = memoryProvider
+
+    def buildHeader(self) -> list[str|BaseMessage]:
+        summaryMessage = self.summaryProvider() if self.summaryProvider is not None else None
+        return [self.systemPrompt] if summaryMessage is None else [self.systemPrompt, summaryMessage]
+
+    def recall(self, newHumanMessage:HumanMessage) -> list[BaseMessage]:
+        return self.memoryProvider(newHumanMessage) if self.memoryProvider is not None else []
+
+    def buildPrefix(self, state:AgentState) -> list[str|BaseMessage]:
+        return [*self.buildHeader(),
+                *state["shortConversationHistory"]]
+
+    def buildSuffix(self, newHumanMessage:HumanMessage) -> list[str|BaseMessage]:
+        return [getCurrentTime(),
+                *self.recall(newHumanMessage),
+                newHumanMessage]
+
+    def build(self, state:AgentState, newHumanMessage:HumanMessage) -> list[str|BaseMessage]:
+        return [*self.buildPrefix(state),
+                *self.buildSuffix(newHumanMessage)]
+
+
+class PrefixStablePromptBuilder(PromptBuilder):
+    """
+    Lays the prompt out so each turn only appends to the previous one.
+    The time stamp is stored on the human message when it is sent and rendered in the
+    same compact form every later turn, so system prompt and history stay byte-identical
+    and Ollama can reuse the KV cache of the previous request and its answer.
+    """
+    def buildPrefix(self, state:AgentState) -> list[str|BaseMessage]:
+        return [*self.buildHeader(),
+                *(self.renderMessage(message) for message in state["shortConversationHistory"])]
+
+    def buildSuffix(self, newHumanMessage:HumanMessage) -> list[str|BaseMessage]:
+        newHumanMessage.additional_kwargs.setdefault(SENT_AT_KEY, getCompactTimeStamp())
+        return [*self.recall(newHumanMessage),
+                self.renderMessage(newHumanMessage)]
+
+    @staticmethod
+    def renderMessage(message:HumanMessage|AIMessage) -> HumanMessage|AIMessage:
+        sentAt = message.additional_kwargs.get(SENT_AT_KEY)
+        if not isinstance(message, HumanMessage) or sentAt is None:
+            return message
+        return HumanMessage(content=f"[{sentAt}] {message.content}")
+
+
+def createPromptBuilder(systemPrompt:SystemMessage, layout:PromptLayout|str,
+                        summaryProvider:Callable[[], SystemMessage|None]|None=None,
+                        memoryProvider:Callable[[HumanMessage], list[BaseMessage]]|None=None) -> PromptBuilder:
+    if PromptLayout(layout) == PromptLayout.PREFIX_STABLE:
+        return PrefixStablePromptBuilder(systemPrompt, summaryProvider, memoryProvider)
+    return PromptBuilder(systemPrompt, summaryProvider, memoryProvider)
+
+
+def estimateTokens(text:str) -> int:
+    return max(len(text) // CHARS_PER_TOKEN_ESTIMATE, 1) if text else 0
+
+def _messageText(message:str|BaseMessage) -> str:
+    return message if isinstance(message, str) else f"{message.type}:{message.text}"
+
+
+@dataclass(frozen=True)
+class PromptReuseReport:
+    turn:int
+    promptMessages:int
+    stablePrefixMessages:int
+    promptCharacters:int
+    estimatedPromptTokens:int
+    promptEvalCount:int|None
+
+    @property
+    def reusedTokens(self) -> int|None:
+        if self.promptEvalCount is None:
+            return None
+        return max(self.estimatedPromptTokens - self.promptEvalCount, 0)
+
+    def describe(self) -> str:
+        if self.promptEvalCount is None:
+            return f"[prompt] turn {self.turn}: ~{self.estimatedPromptTokens} tokens, no prompt_eval_count reported"
+        return (f"[prompt] turn {self.turn}: re-evaluated {self.promptEvalCount} of ~{self.estimatedPromptTokens} "
+                f"tokens, reused ~{self.reusedTokens}, "
+                f"{self.stablePrefixMessages}/{self.promptMessages} messages unchanged")
+
+
+class PromptReuseTracker:
+    """
+    Reports per turn how much of the prompt Ollama had to prefill.
+    prompt_eval_count only counts the tokens that were evaluated, so the rest of the
+    estimated prompt size was served from the KV cache. A prompt with nothing in common
+    with the previous one was evaluated in full and calibrates the estimator.
+    """
+    def __init__(self, metrics:MetricsRegistry=metricsRegistry, estimator:TokenEstimator|None=None) -> None:
+        self.metrics = metrics
+        self.estimator = estimator
+        self.turn = 0
+        self.reports:list[PromptReuseReport] = []
+        self._previousContext:list[str] = []
+
+    def recordTurn(self, prompt:list[str|BaseMessage], response:AIMessage) -> PromptReuseReport:
+        self.turn += 1
+        promptTexts = [_messageText(message) for message in prompt]
+        stablePrefixMessages = 0
+        for previousText, currentText in zip(self._previousContext, promptTexts):
+            if previousText != currentText:
+                break
+            stablePrefixMessages += 1
+        self._previousContext = [*promptTexts, _messageText(response)]
+
+        promptEvalCount = response.response_metadata.get("prompt_eval_count")
+        promptCharacters = sum(len(text) for text in promptTexts)
+        if stablePrefixMessages == 0 and promptEvalCount and isinstance(self.estimator, CalibratedTokenEstimator):
+            self.estimator.calibrate(promptCharacters, int(promptEvalCount))
+        estimate = estimateTokens if self.estimator is None else self.estimator.estimate
+        report = PromptReuseReport(turn=self.turn,
+                                   promptMessages=len(promptTexts),
+                                   stablePrefixMessages=stablePrefixMessages,
+                                   promptCharacters=promptCharacters,
+                                   estimatedPromptTokens=sum(estimate(text) for text in promptTexts),
+                                   promptEvalCount=int(promptEvalCount) if promptEvalCount is not None else None)
+        self.reports.append(report)
+        self.metrics.observe("prompt_tokens_sent", report.estimatedPromptTokens)
+        if report.promptEvalCount is not None:
+            self.metrics.incrementCounter("prompt_tokens_evaluated_total", report.promptEvalCount)
+            self.metrics.incrementCounter("prompt_tokens_reused_total", report.reusedTokens or 0)
+        return report
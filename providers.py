@@ -0,0 +1,74 @@
+import importlib
+import os
+import sys
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.language_models import BaseChatModel
+
+
+class ProviderNotFoundError(Exception):...
+
+
+@dataclass(frozen=True)
+class ProviderSpec:
+    moduleName:str
+    className:str
+    # keyword arguments resolved when the model is created, e.g. API keys from the environment
+    defaultArguments:Callable[[], dict[str, Any]] = field(default=lambda: {})
+
+
+class ProviderRegistry:
+    """
+    Creates chat and embedding models by provider name.
+    A provider's package is only imported when its first model is created, so
+    importing a module that may use Gemini or Ollama costs nothing until it does.
+    Models are cached per provider, model name and arguments.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._providers:dict[str, ProviderSpec] = {}
+        self._instances:dict[tuple[str, str, str], Any] = {}
+
+    def register(self, providerName:str, spec:ProviderSpec) -> None:
+        self._providers[providerName] = spec
+
+    @property
+    def providerNames(self) -> list[str]:
+        return list(self._providers)
+
+    def isImported(self, providerName:str) -> bool:
+        return self._spec(providerName).moduleName in sys.modules
+
+    def _spec(self, providerName:str) -> ProviderSpec:
+        try:
+            return self._providers[providerName]
+        except KeyError:
+            raise ProviderNotFoundError(f"Provider {providerName} is not registered, "
+                                        f"known providers: {', '.join(self._providers)}")
+
+    def create(self, providerName:str, modelName:str, **modelArguments:Any) -> Any:
+        spec = self._spec(providerName)
+        cacheKey = (providerName, modelName, repr(sorted(modelArguments.items())))
+        with self._lock:
+            if cacheKey not in self._instances:
+                providerClass = getattr(importlib.import_module(spec.moduleName), spec.className)
+                self._instances[cacheKey] = providerClass(model=modelName,
+                                                          **{**spec.defaultArguments(), **modelArguments})
+            return self._instances[cacheKey]
+
+    def getChatModel(self, providerName:str, modelName:str, **modelArguments:Any) -> "BaseChatModel":
+        return self.create(providerName, modelName, **modelArguments)
+
+    def getEmbeddings(self, providerName:str, modelName:str, **modelArguments:Any) -> "Embeddings":
+        return self.create(providerName, modelName, **modelArguments)
+
+
+providerRegistry = ProviderRegistry()
+providerRegistry.register("ollama", ProviderSpec("langchain_ollama", "ChatOllama"))
+providerRegistry.register("ollama-embeddings", ProviderSpec("langchain_ollama", "OllamaEmbeddings"))
+providerRegistry.register("gemini", ProviderSpec("langchain_google_genai", "ChatGoogleGenerativeAI",
+                                                 lambda: {"google_api_key": os.getenv("GOOGLE_API_KEY")}))
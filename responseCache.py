@@ -0,0 +1,318 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+from dataclasses import dataclass, field, replace
+from typing import Any, AsyncIterator, Callable, Iterator
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+from DB import Database
+from generationProfiles import ProfiledChatModel
+from constants import (RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_SIMILARITY_THRESHOLD, RESPONSE_CACHE_TTL_SECONDS,
+                       ResponseCacheTableInfo)
+from metrics import MetricsRegistry, metricsRegistry
+from promptBuilder import stripTimeStamp
+from scheduler import innermostModel
+
+GENERATION_PARAMETER_NAMES = ("model", "temperature", "num_predict", "num_ctx", "top_k", "top_p", "repeat_penalty",
+                              "repeat_last_n", "seed", "mirostat", "mirostat_eta", "mirostat_tau", "tfs_z", "stop",
+                              "format", "reasoning")
+# questions whose answer changes with the moment they are asked are never cached
+TIME_SENSITIVE_PATTERN = re.compile(
+    r"\b(time|date|day|today|tonight|now|yesterday|tomorrow|current|currently|latest|recent|week|month|year|clock)\b",
+    re.IGNORECASE)
+# questions that lean on the conversation or on who asks them, e.g. "why?" or "what is my name", are never cached
+CONTEXT_DEPENDENT_PATTERN = re.compile(
+    r"^\s*(and|but|so|or|then|what about|how about)\b|\b(it|its|this|that|these|those|they|them|their|he|him|his|"
+    r"she|her|there|continue|more|again|else|also|another|other|same|above|previous|earlier|last|before|"
+    r"i|me|my|mine|we|us|our|ours)\b",
+    re.IGNORECASE)
+# shorter questions, such as "really?" or "go on", only make sense after an answer
+STANDALONE_MIN_WORDS = 3
+REPLAY_PIECE_PATTERN = re.compile(r"\s*\S+\s*|\s+")
+CACHED_METADATA_KEY = "cached"
+
+
+def normalizeQuestion(text:str) -> str:
+    return " ".join(stripTimeStamp(text).casefold().split()).rstrip("?!. ")
+
+def isStandaloneQuestion(text:str) -> bool:
+    """Whether a question means the same whoever asks it and whatever was said before."""
+    question = normalizeQuestion(text)
+    return len(question.split()) >= STANDALONE_MIN_WORDS and not CONTEXT_DEPENDENT_PATTERN.search(question)
+
+def _profiledModel(model:BaseChatModel) -> ProfiledChatModel|None:
+    while not isinstance(model, ProfiledChatModel):
+        innerModel = getattr(model, "innerModel", None)
+        if not isinstance(innerModel, BaseChatModel):
+            return None
+        model = innerModel
+    return model
+
+def _hash(*parts:str) -> str:
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    content:str
+    responseMetadata:dict[str, Any] = field(default_factory=dict[str, Any])
+
+
+class ResponseCache:
+    """
+    SQLite store of answers keyed by model, generation parameters, prompt context and question.
+    Entries expire after ttlSeconds and the least recently used ones are evicted beyond
+    maxEntries. With an embedding model, a miss falls back to the most similar cached
+    question of the same context if it clears similarityThreshold.
+    """
+    def __init__(self, dataBasePath:str, ttlSeconds:float=RESPONSE_CACHE_TTL_SECONDS,
+                 maxEntries:int=RESPONSE_CACHE_MAX_ENTRIES, embeddings:Embeddings|None=None,
+                 similarityThreshold:float=RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+                 metrics:MetricsRegistry=metricsRegistry, clock:Callable[[], float]=time.time) -> None:
+        self.dataBasePath = dataBasePath
+        self.ttlSeconds = ttlSeconds
+        self.maxEntries = maxEntries
+        self.embeddings = embeddings
+        self.similarityThreshold = similarityThreshold
+        self.metrics = metrics
+        self.clock = clock
+        database = self._open()
+        if not database.isTableExists(ResponseCacheTableInfo.tableName):
+            database.createTable(ResponseCacheTableInfo.tableName, {
+                ResponseCacheTableInfo.columnCacheKey:"TEXT PRIMARY KEY",
+                ResponseCacheTableInfo.columnContextKey:"TEXT NOT NULL",
+                ResponseCacheTableInfo.columnQuestion:"TEXT NOT NULL",
+                ResponseCacheTableInfo.columnResponse:"TEXT NOT NULL",
+                ResponseCacheTableInfo.columnResponseMetadata:"TEXT",
+                ResponseCacheTableInfo.columnEmbedding:"BLOB",
+                ResponseCacheTableInfo.columnCreatedAt:"REAL NOT NULL",
+                ResponseCacheTableInfo.columnLastUsedAt:"REAL NOT NULL",
+                ResponseCacheTableInfo.columnHitCount:"INTEGER NOT NULL DEFAULT 0"})
+        database.disconnect(True)
+
+    def _open(self) -> Database:
+        # one short-lived connection per call, lookups and stores come from different threads
+        return Database(self.dataBasePath)
+
+    def _expire(self, database:Database) -> None:
+        database.cursor.execute(f"DELETE FROM {ResponseCacheTableInfo.tableName} "
+                                f"WHERE {ResponseCacheTableInfo.columnCreatedAt} < ?",
+                                (self.clock() - self.ttlSeconds,))
+        if database.cursor.rowcount > 0:
+            self.metrics.incrementCounter("response_cache_evictions_total", database.cursor.rowcount, reason="ttl")
+
+    def _findSimilar(self, database:Database, contextKey:str, question:str) -> str|None:
+        if self.embeddings is None:
+            return None
+        database.cursor.execute(f"""SELECT {ResponseCacheTableInfo.columnCacheKey}, {ResponseCacheTableInfo.columnEmbedding}
+                                    FROM {ResponseCacheTableInfo.tableName}
+                                    WHERE {ResponseCacheTableInfo.columnContextKey} = ?
+                                      AND {ResponseCacheTableInfo.columnEmbedding} IS NOT NULL""", (contextKey,))
+        rows = database.cursor.fetchall()
+        if not rows:
+            return None
+        queryVector = self._embed(question)
+        scores = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) @ queryVector
+        bestIndex = int(np.argmax(scores))
+        return str(rows[bestIndex][0]) if scores[bestIndex] >= self.similarityThreshold else None
+
+    def _embed(self, question:str) -> np.ndarray[Any, np.dtype[np.float32]]:
+        assert self.embeddings is not None
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), float(np.finfo(np.float32).tiny))
+
+    def lookup(self, contextKey:str, question:str) -> CachedResponse|None:
+        question = normalizeQuestion(question)
+        cacheKey = _hash(contextKey, question)
+        database = self._open()
+        try:
+            self._expire(database)
+            matchKind = "exact"
+            database.cursor.execute(f"""SELECT {ResponseCacheTableInfo.columnResponse}, {ResponseCacheTableInfo.columnResponseMetadata}
+                                        FROM {ResponseCacheTableInfo.tableName}
+                                        WHERE {ResponseCacheTableInfo.columnCacheKey} = ?""", (cacheKey,))
+            row = database.cursor.fetchone()
+            if row is None and (similarKey := self._findSimilar(database, contextKey, question)) is not None:
+                matchKind, cacheKey = "similar", similarKey
+                database.cursor.execute(f"""SELECT {ResponseCacheTableInfo.columnResponse}, {ResponseCacheTableInfo.columnResponseMetadata}
+                                            FROM {ResponseCacheTableInfo.tableName}
+                                            WHERE {ResponseCacheTableInfo.columnCacheKey} = ?""", (cacheKey,))
+                row = database.cursor.fetchone()
+            if row is None:
+                self.metrics.incrementCounter("response_cache_misses_total")
+                database.connection.commit()
+                return None
+            database.cursor.execute(f"""UPDATE {ResponseCacheTableInfo.tableName}
+                                        SET {ResponseCacheTableInfo.columnLastUsedAt} = ?,
+                                            {ResponseCacheTableInfo.columnHitCount} = {ResponseCacheTableInfo.columnHitCount} + 1
+                                        WHERE {ResponseCacheTableInfo.columnCacheKey} = ?""", (self.clock(), cacheKey))
+            database.connection.commit()
+        finally:
+            database.disconnect(False)
+        self.metrics.incrementCounter("response_cache_hits_total", match=matchKind)
+        return CachedResponse(str(row[0]), json.loads(row[1]) if row[1] else {})
+
+    def store(self, contextKey:str, question:str, response:CachedResponse) -> None:
+        question = normalizeQuestion(question)
+        embedding = self._embed(question).tobytes() if self.embeddings is not None else None
+        now = self.clock()
+        database = self._open()
+        try:
+            database.cursor.execute(f"""INSERT OR REPLACE INTO {ResponseCacheTableInfo.tableName}
+                                        ({ResponseCacheTableInfo.columnCacheKey}, {ResponseCacheTableInfo.columnContextKey},
+                                         {ResponseCacheTableInfo.columnQuestion}, {ResponseCacheTableInfo.columnResponse},
+                                         {ResponseCacheTableInfo.columnResponseMetadata}, {ResponseCacheTableInfo.columnEmbedding},
+                                         {ResponseCacheTableInfo.columnCreatedAt}, {ResponseCacheTableInfo.columnLastUsedAt})
+                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                                    (_hash(contextKey, question), contextKey, question, response.content,
+                                     json.dumps(response.responseMetadata, default=str), embedding, now, now))
+            database.cursor.execute(f"""DELETE FROM {ResponseCacheTableInfo.tableName}
+                                        WHERE {ResponseCacheTableInfo.columnCacheKey} IN (
+                                            SELECT {ResponseCacheTableInfo.columnCacheKey} FROM {ResponseCacheTableInfo.tableName}
+                                            ORDER BY {ResponseCacheTableInfo.columnLastUsedAt} DESC
+                                            LIMIT -1 OFFSET ?)""", (self.maxEntries,))
+            if database.cursor.rowcount > 0:
+                self.metrics.incrementCounter("response_cache_evictions_total", database.cursor.rowcount, reason="lru")
+            database.connection.commit()
+            database.cursor.execute(f"SELECT COUNT(*) FROM {ResponseCacheTableInfo.tableName}")
+            self.metrics.setGauge("response_cache_entries", int(database.cursor.fetchone()[0]))
+        finally:
+            database.disconnect(False)
+
+
+class CachingChatModel(BaseChatModel):
+    """
+    Answers repeated standalone questions from a ResponseCache.
+    The key covers the generation parameters, the system prompt and the latest human
+    message, not the history, so follow-ups and questions about the user, time-sensitive
+    questions and calls with tools always reach the model. With a ProfiledChatModel
+    inside, the parameters are those of the question's profile; the context size and
+    answer cap it is later sized to are left out, since only answers that ended on their
+    own are stored. Hits are replayed as a stream of chunks, so callers can't tell them apart.
+    """
+    innerModel:BaseChatModel
+    cache:ResponseCache
+    _pendingStores:set[asyncio.Task[None]] = PrivateAttr(default_factory=set[asyncio.Task[None]])
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cached-{self.innerModel._llm_type}" # pyright: ignore[reportPrivateUsage]
+
+    def _cacheRequest(self, messages:list[BaseMessage], stop:list[str]|None,
+                      kwargs:dict[str, Any]) -> tuple[str, str]|None:
+        """Returns the context key and question of a cacheable call, None when it must bypass the cache."""
+        if stop or kwargs or not messages or not isinstance(messages[-1], HumanMessage):
+            self.metrics.incrementCounter("response_cache_bypassed_total", reason="call")
+            return None
+        question = stripTimeStamp(messages[-1].text)
+        if TIME_SENSITIVE_PATTERN.search(question):
+            self.metrics.incrementCounter("response_cache_bypassed_total", reason="time")
+            return None
+        if not isStandaloneQuestion(question):
+            self.metrics.incrementCounter("response_cache_bypassed_total", reason="followUp")
+            return None
+        generationModel = innermostModel(self.innerModel)
+        parameters = {name: getattr(generationModel, name) for name in GENERATION_PARAMETER_NAMES
+                      if getattr(generationModel, name, None) is not None}
+        if (profiledModel := _profiledModel(self.innerModel)) is not None:
+            profile = profiledModel.selector.profileFor(question)
+            if profiledModel.num_predict is not None and profiledModel.num_predict < profile.numPredict:
+                profile = replace(profile, numPredict=profiledModel.num_predict)
+            parameters.update({name: value for name, value in profile.modelArguments().items() if value is not None})
+        systemPrompt = next((message.text for message in messages if isinstance(message, SystemMessage)), "")
+        return _hash(generationModel._llm_type, json.dumps(parameters, sort_keys=True, default=str), # pyright: ignore[reportPrivateUsage]
+                     systemPrompt), question
+
+    @property
+    def metrics(self) -> MetricsRegistry:
+        return self.cache.metrics
+
+    @staticmethod
+    def _replay(cachedResponse:CachedResponse) -> Iterator[ChatGenerationChunk]:
+        pieces = REPLAY_PIECE_PATTERN.findall(cachedResponse.content) or [""]
+        for index, piece in enumerate(pieces):
+            isLast = index == len(pieces) - 1
+            metadata = {**cachedResponse.responseMetadata, CACHED_METADATA_KEY: True} if isLast else {}
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece, response_metadata=metadata))
+
+    @staticmethod
+    def _cacheableResponse(message:AIMessage|AIMessageChunk) -> CachedResponse|None:
+        # answers cut off by num_predict or carrying tool calls are not worth replaying
+        if message.response_metadata.get("done_reason") not in (None, "stop") or message.tool_calls \
+                or not isinstance(message.content, str) or message.content == "":
+            return None
+        metadata = {key: value for key, value in message.response_metadata.items()
+                    if key in ("model", "model_name", "done_reason")}
+        return CachedResponse(message.content, metadata)
+
+    def _generate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                  run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        cacheRequest = self._cacheRequest(messages, stop, kwargs)
+        if cacheRequest is not None and (cachedResponse := self.cache.lookup(*cacheRequest)) is not None:
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(
+                content=cachedResponse.content,
+                response_metadata={**cachedResponse.responseMetadata, CACHED_METADATA_KEY: True}))])
+        result = self.innerModel._generate(messages, stop=stop, **kwargs) # pyright: ignore[reportPrivateUsage]
+        message = result.generations[0].message
+        if cacheRequest is not None and isinstance(message, AIMessage) \
+                and (response := self._cacheableResponse(message)) is not None:
+            self.cache.store(*cacheRequest, response)
+        return result
+
+    async def _agenerate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                         run_manager:AsyncCallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        return await asyncio.to_thread(self._generate, messages, stop, None, **kwargs)
+
+    def _stream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> Iterator[ChatGenerationChunk]:
+        cacheRequest = self._cacheRequest(messages, stop, kwargs)
+        cachedResponse = self.cache.lookup(*cacheRequest) if cacheRequest is not None else None
+        chunks = self._replay(cachedResponse) if cachedResponse is not None \
+            else self.innerModel._stream(messages, stop=stop, **kwargs) # pyright: ignore[reportPrivateUsage]
+        aggregatedMessage:AIMessageChunk|None = None
+        for chunk in chunks:
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            if cachedResponse is None and cacheRequest is not None and isinstance(chunk.message, AIMessageChunk):
+                aggregatedMessage = chunk.message if aggregatedMessage is None else aggregatedMessage + chunk.message
+            yield chunk
+        if cacheRequest is not None and aggregatedMessage is not None \
+                and (response := self._cacheableResponse(aggregatedMessage)) is not None:
+            self.cache.store(*cacheRequest, response)
+
+    async def _astream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                       run_manager:AsyncCallbackManagerForLLMRun|None=None,
+                       **kwargs:Any) -> AsyncIterator[ChatGenerationChunk]:
+        cacheRequest = self._cacheRequest(messages, stop, kwargs)
+        cachedResponse = await asyncio.to_thread(self.cache.lookup, *cacheRequest) if cacheRequest is not None else None
+        if cachedResponse is not None:
+            for chunk in self._replay(cachedResponse):
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            return
+        aggregatedMessage:AIMessageChunk|None = None
+        async for chunk in self.innerModel._astream(messages, stop=stop, **kwargs): # pyright: ignore[reportPrivateUsage]
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            if cacheRequest is not None and isinstance(chunk.message, AIMessageChunk):
+                aggregatedMessage = chunk.message if aggregatedMessage is None else aggregatedMessage + chunk.message
+            yield chunk
+        if cacheRequest is not None and aggregatedMessage is not None \
+                and (response := self._cacheableResponse(aggregatedMessage)) is not None:
+            # stored in the background so the stream ends as soon as the model is done
+            storeTask = asyncio.create_task(asyncio.to_thread(self.cache.store, *cacheRequest, response))
+            self._pendingStores.add(storeTask)
+            storeTask.add_done_callback(self._pendingStores.discard)
+
+    async def flushPendingStores(self) -> None:
+        await asyncio.gather(*self._pendingStores)
@@ -0,0 +1,222 @@
+import asyncio
+import itertools
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Iterator, Sequence
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from pydantic import Field
+from constants import ROUTING_EXPECTED_RESPONSE_TOKENS, ROUTING_HEDGE_DELAY_SECONDS, ROUTING_STATISTICS_WINDOW
+from metrics import MetricsRegistry, metricsRegistry
+
+
+class ProviderLatency:
+    """Rolling time to first token and generation speed of one provider."""
+    def __init__(self, window:int=ROUTING_STATISTICS_WINDOW) -> None:
+        self.firstTokenSeconds:deque[float] = deque(maxlen=window)
+        self.tokensPerSecond:deque[float] = deque(maxlen=window)
+
+    @property
+    def isMeasured(self) -> bool:
+        return len(self.firstTokenSeconds) > 0
+
+    def expectedSeconds(self, responseTokens:int) -> float:
+        """Median time to first token plus the time to stream a typical response."""
+        if not self.isMeasured:
+            return float("inf")
+        expectedSeconds = statistics.median(self.firstTokenSeconds)
+        if self.tokensPerSecond:
+            expectedSeconds += responseTokens / max(statistics.median(self.tokensPerSecond), 1e-9)
+        return expectedSeconds
+
+
+class ProviderStatistics:
+    """Latency of every provider a RoutingChatModel has streamed from, shareable between instances."""
+    def __init__(self, window:int=ROUTING_STATISTICS_WINDOW, metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.window = window
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._providers:dict[str, ProviderLatency] = {}
+
+    def latency(self, providerName:str) -> ProviderLatency:
+        with self._lock:
+            return self._providers.setdefault(providerName, ProviderLatency(self.window))
+
+    def recordFirstToken(self, providerName:str, seconds:float) -> None:
+        with self._lock:
+            self._providers.setdefault(providerName, ProviderLatency(self.window)).firstTokenSeconds.append(seconds)
+        self.metrics.observe("routing_time_to_first_token_seconds", seconds, provider=providerName)
+
+    def recordGeneration(self, providerName:str, tokenCount:int, seconds:float) -> None:
+        if tokenCount < 2 or seconds <= 0:
+            return
+        tokensPerSecond = (tokenCount - 1) / seconds
+        with self._lock:
+            self._providers.setdefault(providerName, ProviderLatency(self.window)).tokensPerSecond.append(tokensPerSecond)
+        self.metrics.observe("routing_tokens_per_second", tokensPerSecond, provider=providerName)
+
+    def rank(self, providerNames:Sequence[str], responseTokens:int=ROUTING_EXPECTED_RESPONSE_TOKENS) -> list[str]:
+        """Fastest expected provider first, providers without measurements keep their configured order after them."""
+        return sorted(providerNames, key=lambda providerName: (self.latency(providerName).expectedSeconds(responseTokens),
+                                                               providerNames.index(providerName)))
+
+
+def countTokens(chunk:ChatGenerationChunk) -> int:
+    usage = getattr(chunk.message, "usage_metadata", None)
+    return int(usage["output_tokens"]) if usage and usage.get("output_tokens") else 0
+
+
+class RoutingChatModel(BaseChatModel):
+    """
+    Streams each request from the provider with the best rolling latency.
+    When the chosen provider has not produced a first token after hedgeDelay seconds,
+    or fails before it does, the next provider is asked as well. The first one to
+    produce a token wins and the other request is cancelled, so at most two providers
+    run per request and only until one of them answers.
+    """
+    providers:dict[str, BaseChatModel]
+    hedgeDelay:float = ROUTING_HEDGE_DELAY_SECONDS
+    statistics:ProviderStatistics = Field(default_factory=ProviderStatistics)
+    # per provider keyword arguments, e.g. tools bound in each provider's own format
+    providerArguments:dict[str, dict[str, Any]] = Field(default_factory=dict[str, dict[str, Any]])
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return "routing"
+
+    @property
+    def metrics(self) -> MetricsRegistry:
+        return self.statistics.metrics
+
+    def rankedProviders(self) -> list[str]:
+        return self.statistics.rank(list(self.providers))
+
+    def _argumentsFor(self, providerName:str, kwargs:dict[str, Any]) -> dict[str, Any]:
+        return {**kwargs, **self.providerArguments.get(providerName, {})}
+
+    def _stream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> Iterator[ChatGenerationChunk]:
+        # blocking callers cannot race two streams, they fall back to the next provider on failure instead
+        rankedProviders = self.rankedProviders()
+        for position, providerName in enumerate(rankedProviders):
+            self.metrics.incrementCounter("routing_requests_total", provider=providerName)
+            startTime = time.perf_counter()
+            chunks = self.providers[providerName]._stream(messages, stop=stop, # pyright: ignore[reportPrivateUsage]
+                                                          **self._argumentsFor(providerName, kwargs))
+            try:
+                firstChunk = next(chunks)
+            except StopIteration:
+                return
+            except Exception:
+                self.metrics.incrementCounter("routing_failures_total", provider=providerName)
+                if position == len(rankedProviders) - 1:
+                    raise
+                continue
+            firstTokenTime = time.perf_counter()
+            self.statistics.recordFirstToken(providerName, firstTokenTime - startTime)
+            chunkCount, tokenCount = 0, 0
+            for chunk in itertools.chain([firstChunk], chunks):
+                chunkCount += 1
+                tokenCount = max(tokenCount, countTokens(chunk))
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            self.statistics.recordGeneration(providerName, tokenCount or chunkCount, time.perf_counter() - firstTokenTime)
+            return
+
+    async def _astream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                       run_manager:AsyncCallbackManagerForLLMRun|None=None,
+                       **kwargs:Any) -> AsyncIterator[ChatGenerationChunk]:
+        waitingProviders = self.rankedProviders()
+        # each running provider waits for its first chunk in a task, keyed to its name, stream and start time
+        streams:dict[asyncio.Future[ChatGenerationChunk], tuple[str, AsyncGenerator[ChatGenerationChunk, None], float]] = {}
+
+        def startNext() -> None:
+            providerName = waitingProviders.pop(0)
+            self.metrics.incrementCounter("routing_requests_total", provider=providerName)
+            chunks = self.providers[providerName]._astream(messages, stop=stop, # pyright: ignore[reportPrivateUsage]
+                                                           **self._argumentsFor(providerName, kwargs))
+            streams[asyncio.ensure_future(anext(chunks))] = (providerName, chunks, time.perf_counter()) # pyright: ignore[reportArgumentType]
+
+        async def closeStream(firstChunk:asyncio.Future[ChatGenerationChunk]) -> None:
+            _, chunks, _ = streams.pop(firstChunk)
+            firstChunk.cancel()
+            await asyncio.gather(firstChunk, return_exceptions=True)
+            await chunks.aclose()
+
+        def hasAnswered(firstChunk:asyncio.Future[ChatGenerationChunk]) -> bool:
+            return firstChunk.exception() is None or isinstance(firstChunk.exception(), StopAsyncIteration)
+
+        startNext()
+        winner:asyncio.Future[ChatGenerationChunk]|None = None
+        try:
+            while winner is None:
+                hedgeTimeout = self.hedgeDelay if waitingProviders and len(streams) == 1 else None
+                finished, _ = await asyncio.wait(streams, timeout=hedgeTimeout, return_when=asyncio.FIRST_COMPLETED)
+                if not finished:
+                    self.metrics.incrementCounter("routing_hedges_total")
+                    startNext()
+                    continue
+                winner = next((firstChunk for firstChunk in finished if hasAnswered(firstChunk)), None)
+                for failed in [firstChunk for firstChunk in finished if not hasAnswered(firstChunk)]:
+                    self.metrics.incrementCounter("routing_failures_total", provider=streams[failed][0])
+                    error = failed.exception()
+                    await closeStream(failed)
+                    if winner is None and not streams:
+                        if not waitingProviders:
+                            raise error # pyright: ignore[reportGeneralTypeIssues]
+                        startNext()
+            for loser in [firstChunk for firstChunk in streams if firstChunk is not winner]:
+                self.metrics.incrementCounter("routing_cancelled_total", provider=streams[loser][0])
+                await closeStream(loser)
+        except BaseException:
+            for firstChunk in list(streams):
+                await closeStream(firstChunk)
+            raise
+
+        providerName, chunks, startTime = streams.pop(winner)
+        if isinstance(winner.exception(), StopAsyncIteration):
+            return
+        firstTokenTime = time.perf_counter()
+        self.statistics.recordFirstToken(providerName, firstTokenTime - startTime)
+        self.metrics.incrementCounter("routing_wins_total", provider=providerName)
+        chunkCount, tokenCount = 0, 0
+        chunk = winner.result()
+        try:
+            while True:
+                chunkCount += 1
+                tokenCount = max(tokenCount, countTokens(chunk))
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+                try:
+                    chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    break
+        finally:
+            await chunks.aclose()
+        self.statistics.recordGeneration(providerName, tokenCount or chunkCount, time.perf_counter() - firstTokenTime)
+
+    def _generate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                  run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    async def _agenerate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                         run_manager:AsyncCallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def bind_tools(self, tools:Sequence[dict[str, Any]|type|Callable[..., Any]|BaseTool],
+                   **kwargs:Any) -> Runnable[LanguageModelInput, AIMessage]:
+        # every provider converts the tools to its own format, the router passes each its own arguments
+        providerArguments = {providerName: getattr(provider.bind_tools(tools, **kwargs), "kwargs", {})
+                             for providerName, provider in self.providers.items()}
+        return self.model_copy(update={"providerArguments": providerArguments})
@@ -0,0 +1,275 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, AsyncIterator, Callable, Iterator, Sequence
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from metrics import MetricsRegistry, metricsRegistry
+
+
+class RequestPriority(IntEnum):
+    INTERACTIVE = 0
+    AGENT = 1
+    BATCH = 2
+
+
+class SchedulerOverloadedError(Exception):...
+class AdmissionTimeoutError(SchedulerOverloadedError):...
+
+
+@dataclass(frozen=True)
+class SchedulerLimits:
+    maxConcurrentPerModel:int = 1
+    maxQueueDepth:dict[RequestPriority, int] = field(default_factory=lambda: {
+        RequestPriority.INTERACTIVE: 64, RequestPriority.AGENT: 16, RequestPriority.BATCH: 8})
+    maxWaitSeconds:dict[RequestPriority, float|None] = field(default_factory=lambda: {
+        RequestPriority.INTERACTIVE: None, RequestPriority.AGENT: 300.0, RequestPriority.BATCH: 600.0})
+    # requests admitted while this many others are queued run in degraded mode
+    degradeQueueDepth:int = 4
+
+
+@dataclass(eq=False)
+class _Ticket:
+    modelName:str
+    userName:str
+    priority:RequestPriority
+    enqueuedAt:float
+    onGranted:Callable[[], None]
+    granted:bool = False
+    degraded:bool = False
+
+
+@dataclass
+class _ModelQueue:
+    activeCount:int = 0
+    # per priority, users in round-robin order each with their own FIFO of tickets
+    waiting:dict[RequestPriority, OrderedDict[str, deque[_Ticket]]] = field(
+        default_factory=lambda: {priority: OrderedDict() for priority in RequestPriority})
+
+    def depth(self, priority:RequestPriority|None=None) -> int:
+        priorities = RequestPriority if priority is None else [priority]
+        return sum(len(tickets) for eachPriority in priorities for tickets in self.waiting[eachPriority].values())
+
+    def popNext(self) -> _Ticket|None:
+        for priority in RequestPriority:
+            usersQueue = self.waiting[priority]
+            if not usersQueue:
+                continue
+            userName, tickets = usersQueue.popitem(last=False)
+            ticket = tickets.popleft()
+            if tickets:
+                usersQueue[userName] = tickets
+            return ticket
+        return None
+
+    def remove(self, ticket:_Ticket) -> None:
+        tickets = self.waiting[ticket.priority].get(ticket.userName)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del self.waiting[ticket.priority][ticket.userName]
+
+
+class RequestScheduler:
+    """
+    Admission control in front of the chat models.
+    Limits concurrent requests per model, serves interactive work before agent and
+    batch work, rotates between users inside a priority class and sheds requests
+    when a queue is full or a request waits too long.
+    """
+    def __init__(self, limits:SchedulerLimits|None=None, metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.limits = limits or SchedulerLimits()
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._modelQueues:dict[str, _ModelQueue] = {}
+
+    def queueDepth(self, modelName:str, priority:RequestPriority|None=None) -> int:
+        with self._lock:
+            return self._modelQueues.get(modelName, _ModelQueue()).depth(priority)
+
+    def activeRequests(self, modelName:str) -> int:
+        with self._lock:
+            return self._modelQueues.get(modelName, _ModelQueue()).activeCount
+
+    def _admit(self, ticket:_Ticket) -> None:
+        with self._lock:
+            modelQueue = self._modelQueues.setdefault(ticket.modelName, _ModelQueue())
+            ticket.degraded = modelQueue.depth() >= self.limits.degradeQueueDepth
+            if modelQueue.activeCount < self.limits.maxConcurrentPerModel and modelQueue.depth() == 0:
+                modelQueue.activeCount += 1
+                ticket.granted = True
+            elif modelQueue.depth(ticket.priority) >= self.limits.maxQueueDepth[ticket.priority]:
+                self.metrics.incrementCounter("scheduler_rejected_total", model=ticket.modelName,
+                                              priority=ticket.priority.name.lower())
+                raise SchedulerOverloadedError(
+                    f"{ticket.priority.name.lower()} queue for {ticket.modelName} is full")
+            else:
+                modelQueue.waiting[ticket.priority].setdefault(ticket.userName, deque()).append(ticket)
+            self._publishQueueMetrics(ticket.modelName, modelQueue)
+        if ticket.degraded:
+            self.metrics.incrementCounter("scheduler_degraded_total", model=ticket.modelName,
+                                          priority=ticket.priority.name.lower())
+
+    def _withdraw(self, ticket:_Ticket) -> bool:
+        """Removes a ticket that stopped waiting, returns True if it had been granted meanwhile."""
+        with self._lock:
+            if ticket.granted:
+                return True
+            modelQueue = self._modelQueues[ticket.modelName]
+            modelQueue.remove(ticket)
+            self._publishQueueMetrics(ticket.modelName, modelQueue)
+            return False
+
+    def _release(self, modelName:str) -> None:
+        with self._lock:
+            modelQueue = self._modelQueues[modelName]
+            nextTicket = modelQueue.popNext()
+            if nextTicket is None:
+                modelQueue.activeCount -= 1
+            else:
+                nextTicket.granted = True
+                nextTicket.onGranted()
+            self._publishQueueMetrics(modelName, modelQueue)
+
+    def _publishQueueMetrics(self, modelName:str, modelQueue:_ModelQueue) -> None:
+        for priority in RequestPriority:
+            self.metrics.setGauge("scheduler_queue_depth", modelQueue.depth(priority),
+                                  model=modelName, priority=priority.name.lower())
+        self.metrics.setGauge("scheduler_active_requests", modelQueue.activeCount, model=modelName)
+
+    def _recordWait(self, ticket:_Ticket) -> None:
+        self.metrics.observe("scheduler_wait_seconds", time.monotonic() - ticket.enqueuedAt,
+                             model=ticket.modelName, priority=ticket.priority.name.lower())
+
+    def _timeoutError(self, ticket:_Ticket) -> AdmissionTimeoutError:
+        self.metrics.incrementCounter("scheduler_timeouts_total", model=ticket.modelName,
+                                      priority=ticket.priority.name.lower())
+        return AdmissionTimeoutError(f"{ticket.priority.name.lower()} request for {ticket.modelName} "
+                                     f"waited longer than {self.limits.maxWaitSeconds[ticket.priority]}s")
+
+    @contextmanager
+    def slot(self, modelName:str, userName:str, priority:RequestPriority) -> Iterator[bool]:
+        """Blocks until the request may run, yields whether it was admitted in degraded mode."""
+        grantedEvent = threading.Event()
+        ticket = _Ticket(modelName, userName, priority, time.monotonic(), grantedEvent.set)
+        self._admit(ticket)
+        if not ticket.granted:
+            try:
+                grantedEvent.wait(self.limits.maxWaitSeconds[priority])
+            except BaseException:
+                if self._withdraw(ticket):
+                    self._release(modelName)
+                raise
+            if not self._withdraw(ticket):
+                raise self._timeoutError(ticket)
+        self._recordWait(ticket)
+        try:
+            yield ticket.degraded
+        finally:
+            self._release(modelName)
+
+    @asynccontextmanager
+    async def aslot(self, modelName:str, userName:str, priority:RequestPriority) -> AsyncIterator[bool]:
+        loop = asyncio.get_running_loop()
+        grantedFuture:asyncio.Future[None] = loop.create_future()
+
+        def onGranted() -> None:
+            loop.call_soon_threadsafe(lambda: grantedFuture.done() or grantedFuture.set_result(None))
+
+        ticket = _Ticket(modelName, userName, priority, time.monotonic(), onGranted)
+        self._admit(ticket)
+        if not ticket.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(grantedFuture), self.limits.maxWaitSeconds[priority])
+            except TimeoutError:
+                pass
+            except BaseException:
+                if self._withdraw(ticket):
+                    self._release(modelName)
+                raise
+            if not self._withdraw(ticket):
+                raise self._timeoutError(ticket)
+        self._recordWait(ticket)
+        try:
+            yield ticket.degraded
+        finally:
+            self._release(modelName)
+
+
+requestScheduler = RequestScheduler()
+
+
+def innermostModel(model:BaseChatModel) -> BaseChatModel:
+    """Unwraps chat models that delegate to an innerModel."""
+    while isinstance(innerModel := getattr(model, "innerModel", None), BaseChatModel):
+        model = innerModel
+    return model
+
+
+class ScheduledChatModel(BaseChatModel):
+    """
+    Runs every call of the wrapped chat model inside a scheduler slot.
+    The slot is held until the last chunk of a stream has been read. Requests
+    admitted in degraded mode are capped to degradedNumPredict tokens.
+    """
+    innerModel:BaseChatModel
+    scheduler:RequestScheduler
+    userName:str
+    priority:RequestPriority = RequestPriority.INTERACTIVE
+    degradedNumPredict:int|None = 256
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self.innerModel._llm_type}" # pyright: ignore[reportPrivateUsage]
+
+    @property
+    def modelName(self) -> str:
+        return str(getattr(self.innerModel, "model", self.innerModel._llm_type)) # pyright: ignore[reportPrivateUsage]
+
+    def _modelFor(self, degraded:bool) -> BaseChatModel:
+        if degraded and self.degradedNumPredict is not None and "num_predict" in type(self.innerModel).model_fields:
+            return self.innerModel.model_copy(update={"num_predict": self.degradedNumPredict})
+        return self.innerModel
+
+    def _generate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                  run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        with self.scheduler.slot(self.modelName, self.userName, self.priority) as degraded:
+            return self._modelFor(degraded)._generate(messages, stop=stop, **kwargs) # pyright: ignore[reportPrivateUsage]
+
+    async def _agenerate(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                         run_manager:AsyncCallbackManagerForLLMRun|None=None, **kwargs:Any) -> ChatResult:
+        async with self.scheduler.aslot(self.modelName, self.userName, self.priority) as degraded:
+            return await self._modelFor(degraded)._agenerate(messages, stop=stop, **kwargs) # pyright: ignore[reportPrivateUsage]
+
+    def _stream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                run_manager:CallbackManagerForLLMRun|None=None, **kwargs:Any) -> Iterator[ChatGenerationChunk]:
+        with self.scheduler.slot(self.modelName, self.userName, self.priority) as degraded:
+            for chunk in self._modelFor(degraded)._stream(messages, stop=stop, **kwargs): # pyright: ignore[reportPrivateUsage]
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+
+    async def _astream(self, messages:list[BaseMessage], stop:list[str]|None=None,
+                       run_manager:AsyncCallbackManagerForLLMRun|None=None,
+                       **kwargs:Any) -> AsyncIterator[ChatGenerationChunk]:
+        async with self.scheduler.aslot(self.modelName, self.userName, self.priority) as degraded:
+            async for chunk in self._modelFor(degraded)._astream(messages, stop=stop, **kwargs): # pyright: ignore[reportPrivateUsage]
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+
+    def bind_tools(self, tools:Sequence[dict[str, Any]|type|Callable[..., Any]|BaseTool],
+                   **kwargs:Any) -> Runnable[LanguageModelInput, AIMessage]:
+        toolBinding = self.innerModel.bind_tools(tools, **kwargs)
+        return self.bind(**getattr(toolBinding, "kwargs", {}))
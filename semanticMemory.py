@@ -0,0 +1,392 @@
+import argparse
+import threading
+import time
+from contextlib import AbstractContextManager
+from dataclasses import dataclass
+from typing import Callable
+import numpy as np
+import numpy.typing as npt
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from DB import Database
+from constants import (EMBEDDING_MODEL_NAME, MEMORY_INDEX_BATCH_SIZE, MEMORY_INDEX_MAX_RETRY_SECONDS,
+                       MEMORY_INDEX_RETRY_SECONDS, MEMORY_MIN_SIMILARITY, MEMORY_TOKEN_BUDGET, MEMORY_TOP_K,
+                       MessageEmbeddingsTableInfo, MessagesTableInfo, conversationTableInfo)
+from contextWindow import MESSAGE_TOKEN_OVERHEAD, TokenEstimator
+from metrics import MetricsRegistry, metricsRegistry
+
+MEMORY_HEADER = "Relevant exchanges from earlier conversations:"
+INITIAL_CAPACITY = 256
+
+
+def formatExchange(humanText:str, aiText:str) -> str:
+    return f"User: {humanText}\nAssistant: {aiText}"
+
+def normalizeRows(vectors:npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+@dataclass(frozen=True)
+class MemoryHit:
+    score:float
+    conversationId:int
+    humanText:str
+    aiText:str
+
+    @property
+    def text(self) -> str:
+        return formatExchange(self.humanText, self.aiText)
+
+
+class SemanticMemoryIndex:
+    """
+    Embedding index over the exchanges stored in the messages table.
+    Every exchange is embedded once, stored as a float32 BLOB keyed by its human message
+    and kept in memory as one matrix of unit vectors, so a query is a single
+    matrix-vector product followed by a top-k partition. The history database is shared
+    by every user, so each row keeps the user whose conversation it came from.
+    """
+    def __init__(self, embeddings:Embeddings, modelName:str=EMBEDDING_MODEL_NAME,
+                 metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.embeddings = embeddings
+        self.modelName = modelName
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._matrix:npt.NDArray[np.float32] = np.empty((0, 0), dtype=np.float32)
+        self._conversationIds:npt.NDArray[np.int64] = np.empty(0, dtype=np.int64)
+        self._userIds:npt.NDArray[np.int64] = np.empty(0, dtype=np.int64)
+        self._exchanges:list[tuple[str, str]] = []
+        self._indexedMessageIds:set[int] = set()
+        self._scannedMessageId = 0
+
+    def __len__(self) -> int:
+        return len(self._exchanges)
+
+    @staticmethod
+    def ensureTable(database:Database) -> None:
+        if database.isTableExists(MessageEmbeddingsTableInfo.tableName):
+            return
+        database.createTable(MessageEmbeddingsTableInfo.tableName, {
+            MessageEmbeddingsTableInfo.columnMessageId:"INTEGER NOT NULL",
+            MessageEmbeddingsTableInfo.columnReplyMessageId:"INTEGER NOT NULL",
+            MessageEmbeddingsTableInfo.columnConversationId:"INTEGER NOT NULL",
+            MessageEmbeddingsTableInfo.columnModel:"TEXT NOT NULL",
+            MessageEmbeddingsTableInfo.columnEmbedding:"BLOB NOT NULL",
+            f"PRIMARY KEY ({MessageEmbeddingsTableInfo.columnMessageId}, {MessageEmbeddingsTableInfo.columnModel})":"",
+            f"FOREIGN KEY ({MessageEmbeddingsTableInfo.columnMessageId})":
+                f"REFERENCES {MessagesTableInfo.tableName} ({MessagesTableInfo.columnMessageId})"})
+        database.commit()
+
+    def load(self, database:Database) -> None:
+        """Reads the stored embeddings of this index's model into memory and marks the history as scanned."""
+        self.ensureTable(database)
+        database.cursor.execute(
+            f"""SELECT embedding.{MessageEmbeddingsTableInfo.columnMessageId},
+                       embedding.{MessageEmbeddingsTableInfo.columnConversationId},
+                       conversation.{conversationTableInfo.columnUserId},
+                       embedding.{MessageEmbeddingsTableInfo.columnEmbedding},
+                       human.{MessagesTableInfo.columnContent}, ai.{MessagesTableInfo.columnContent}
+                FROM {MessageEmbeddingsTableInfo.tableName} AS embedding
+                JOIN {conversationTableInfo.tableName} AS conversation
+                  ON conversation.{conversationTableInfo.columnConversationId} =
+                     embedding.{MessageEmbeddingsTableInfo.columnConversationId}
+                JOIN {MessagesTableInfo.tableName} AS human
+                  ON human.{MessagesTableInfo.columnMessageId} = embedding.{MessageEmbeddingsTableInfo.columnMessageId}
+                JOIN {MessagesTableInfo.tableName} AS ai
+                  ON ai.{MessagesTableInfo.columnMessageId} = embedding.{MessageEmbeddingsTableInfo.columnReplyMessageId}
+                WHERE embedding.{MessageEmbeddingsTableInfo.columnModel} = ?""", (self.modelName,))
+        rows = database.cursor.fetchall()
+        database.cursor.execute(f"SELECT MAX({MessagesTableInfo.columnMessageId}) FROM {MessagesTableInfo.tableName}")
+        # older unindexed history is left to the backfill command
+        self._scannedMessageId = int(database.cursor.fetchone()[0] or 0)
+        if not rows:
+            return
+        vectors = np.stack([np.frombuffer(row[3], dtype=np.float32) for row in rows])
+        self._append(vectors, [(int(row[0]), int(row[1]), int(row[2]), str(row[4]), str(row[5])) for row in rows])
+
+    def _append(self, unitVectors:npt.NDArray[np.float32], rows:list[tuple[int, int, int, str, str]]) -> None:
+        """Adds rows of (messageId, conversationId, userId, humanText, aiText) with their unit vectors."""
+        with self._lock:
+            usedRows = len(self._exchanges)
+            neededRows = usedRows + len(rows)
+            if self._matrix.shape[1] != unitVectors.shape[1]:
+                if usedRows:
+                    raise ValueError(f"embedding size changed from {self._matrix.shape[1]} to {unitVectors.shape[1]}")
+                self._matrix = np.empty((0, unitVectors.shape[1]), dtype=np.float32)
+            if neededRows > self._matrix.shape[0]:
+                # grow geometrically so incremental appends stay amortized O(1)
+                capacity = max(INITIAL_CAPACITY, neededRows, 2 * self._matrix.shape[0])
+                grownMatrix = np.empty((capacity, unitVectors.shape[1]), dtype=np.float32)
+                grownMatrix[:usedRows] = self._matrix[:usedRows]
+                self._matrix = grownMatrix
+                self._conversationIds = np.resize(self._conversationIds, capacity)
+                self._userIds = np.resize(self._userIds, capacity)
+            self._matrix[usedRows:neededRows] = unitVectors
+            self._conversationIds[usedRows:neededRows] = [row[1] for row in rows]
+            self._userIds[usedRows:neededRows] = [row[2] for row in rows]
+            self._exchanges.extend((row[3], row[4]) for row in rows)
+            self._indexedMessageIds.update(row[0] for row in rows)
+
+    def storeExchanges(self, database:Database, unitVectors:npt.NDArray[np.float32],
+                       exchanges:list[tuple[int, int, int, str, str]]) -> None:
+        for vector, (messageId, replyMessageId, conversationId, _, _) in zip(unitVectors, exchanges):
+            database.insertData(MessageEmbeddingsTableInfo.tableName, {
+                MessageEmbeddingsTableInfo.columnMessageId:messageId,
+                MessageEmbeddingsTableInfo.columnReplyMessageId:replyMessageId,
+                MessageEmbeddingsTableInfo.columnConversationId:conversationId,
+                MessageEmbeddingsTableInfo.columnModel:self.modelName,
+                MessageEmbeddingsTableInfo.columnEmbedding:vector.tobytes()})
+        database.commit()
+        userIds = self._conversationUserIds(database, {exchange[2] for exchange in exchanges})
+        self._append(unitVectors, [(messageId, conversationId, userIds[conversationId], humanText, aiText)
+                                   for messageId, _, conversationId, humanText, aiText in exchanges])
+        self.metrics.setGauge("memory_indexed_exchanges", len(self))
+
+    @staticmethod
+    def _conversationUserIds(database:Database, conversationIds:set[int]) -> dict[int, int]:
+        database.cursor.execute(
+            f"""SELECT {conversationTableInfo.columnConversationId}, {conversationTableInfo.columnUserId}
+                FROM {conversationTableInfo.tableName}
+                WHERE {conversationTableInfo.columnConversationId} IN ({", ".join("?" for _ in conversationIds)})""",
+            tuple(conversationIds))
+        return {int(conversationId): int(userId) for conversationId, userId in database.cursor.fetchall()}
+
+    def embedExchanges(self, exchanges:list[tuple[int, int, int, str, str]]) -> npt.NDArray[np.float32]|None:
+        """Unit vectors of the exchanges, None when the embedding model fails."""
+        startTime = time.perf_counter()
+        try:
+            vectors = self.embeddings.embed_documents([formatExchange(exchange[3], exchange[4])
+                                                       for exchange in exchanges])
+        except Exception:
+            self.metrics.incrementCounter("memory_index_failures_total")
+            return None
+        self.metrics.observe("memory_embed_seconds", time.perf_counter() - startTime)
+        return normalizeRows(np.asarray(vectors, dtype=np.float32))
+
+    def addExchanges(self, database:Database, exchanges:list[tuple[int, int, int, str, str]]) -> int:
+        """
+        Embeds and stores exchanges given as (messageId, replyMessageId, conversationId, humanText, aiText).
+        Returns how many were indexed; when the embedding model fails nothing is stored
+        and the exchanges are picked up by the next backfill.
+        """
+        exchanges = [exchange for exchange in exchanges if exchange[0] not in self._indexedMessageIds]
+        if not exchanges:
+            return 0
+        unitVectors = self.embedExchanges(exchanges)
+        if unitVectors is None:
+            return 0
+        self.storeExchanges(database, unitVectors, exchanges)
+        return len(exchanges)
+
+    def _storedExchanges(self, database:Database, afterMessageId:int) -> tuple[list[tuple[int, int, int, str, str]], int]:
+        """Pairs every stored message after afterMessageId with the next one, returns the pairs and the last id."""
+        self.ensureTable(database)
+        database.cursor.execute(
+            f"""SELECT {MessagesTableInfo.columnMessageId}, {MessagesTableInfo.columnConversationId},
+                       {MessagesTableInfo.columnContent}
+                FROM {MessagesTableInfo.tableName}
+                WHERE {MessagesTableInfo.columnMessageId} > ?
+                ORDER BY {MessagesTableInfo.columnConversationId}, {MessagesTableInfo.columnMessageId}""",
+            (afterMessageId,))
+        rows = database.cursor.fetchall()
+        exchanges:list[tuple[int, int, int, str, str]] = []
+        rowIndex = 0
+        while rowIndex + 1 < len(rows):
+            humanRow, aiRow = rows[rowIndex], rows[rowIndex + 1]
+            if humanRow[1] != aiRow[1]:
+                rowIndex += 1
+                continue
+            exchanges.append((int(humanRow[0]), int(aiRow[0]), int(humanRow[1]), str(humanRow[2]), str(aiRow[2])))
+            rowIndex += 2
+        return exchanges, max((int(row[0]) for row in rows), default=afterMessageId)
+
+    def backfill(self, database:Database, batchSize:int=32, afterMessageId:int=0) -> int:
+        """Indexes stored exchanges that have no embedding yet."""
+        exchanges, _ = self._storedExchanges(database, afterMessageId)
+        indexedCount = 0
+        for batchStart in range(0, len(exchanges), batchSize):
+            indexedCount += self.addExchanges(database, exchanges[batchStart:batchStart + batchSize])
+        return indexedCount
+
+    def unindexedExchanges(self, database:Database) -> tuple[list[tuple[int, int, int, str, str]], int]:
+        """The exchanges written since the scanned message that have no embedding yet, and the last message id read."""
+        exchanges, lastMessageId = self._storedExchanges(database, self._scannedMessageId)
+        return [exchange for exchange in exchanges if exchange[0] not in self._indexedMessageIds], lastMessageId
+
+    def markScanned(self, messageId:int) -> None:
+        self._scannedMessageId = max(self._scannedMessageId, messageId)
+
+    def indexNewExchanges(self, database:Database) -> int:
+        """Indexes the exchanges written since the last successful call."""
+        exchanges, lastMessageId = self.unindexedExchanges(database)
+        indexedCount = self.addExchanges(database, exchanges)
+        if indexedCount == len(exchanges):
+            self.markScanned(lastMessageId)
+        return indexedCount
+
+    def search(self, queryText:str, k:int=MEMORY_TOP_K, excludeConversationId:int|None=None,
+               userId:int|None=None, minScore:float=MEMORY_MIN_SIMILARITY) -> list[MemoryHit]:
+        """The exchanges closest to queryText; with a userId, only those of that user's conversations."""
+        with self._lock:
+            rowCount = len(self._exchanges)
+            matrix = self._matrix[:rowCount]
+            conversationIds = self._conversationIds[:rowCount]
+            userIds = self._userIds[:rowCount]
+            exchanges = self._exchanges[:rowCount]
+        if rowCount == 0 or k <= 0:
+            return []
+        startTime = time.perf_counter()
+        queryVector = normalizeRows(np.asarray([self.embeddings.embed_query(queryText)], dtype=np.float32))[0]
+        scores = matrix @ queryVector
+        if excludeConversationId is not None:
+            scores = np.where(conversationIds == excludeConversationId, -np.inf, scores)
+        if userId is not None:
+            scores = np.where(userIds == userId, scores, -np.inf)
+        topCount = min(k, rowCount)
+        topIndexes = np.argpartition(-scores, topCount - 1)[:topCount]
+        topIndexes = topIndexes[np.argsort(-scores[topIndexes])]
+        self.metrics.observe("memory_search_seconds", time.perf_counter() - startTime)
+        return [MemoryHit(float(scores[index]), int(conversationIds[index]), *exchanges[index])
+                for index in topIndexes if scores[index] >= minScore]
+
+
+class MemoryIndexer:
+    """
+    Indexes new exchanges on a thread of its own once the writes that stored them are
+    committed. notify() only wakes the thread, so a slow embedding model never holds up
+    the writer that called it. New exchanges are read through openReader, embedded
+    batchSize at a time without a database handle and stored through openWriter.
+    After a failed pass the next one waits retryDelay, doubled with every failure up
+    to maxRetryDelay; exchanges already indexed are never embedded again.
+    """
+    def __init__(self, getIndex:Callable[[], SemanticMemoryIndex],
+                 openReader:Callable[[], AbstractContextManager[Database]],
+                 openWriter:Callable[[], AbstractContextManager[Database]], batchSize:int=MEMORY_INDEX_BATCH_SIZE,
+                 retryDelay:float=MEMORY_INDEX_RETRY_SECONDS, maxRetryDelay:float=MEMORY_INDEX_MAX_RETRY_SECONDS,
+                 metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.getIndex = getIndex
+        self.openReader = openReader
+        self.openWriter = openWriter
+        self.batchSize = batchSize
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.metrics = metrics
+        self.lastError:BaseException|None = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread:threading.Thread|None = None
+
+    @property
+    def isRunning(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> "MemoryIndexer":
+        """Starts the thread; the index has to be loaded first, it sets where the scan starts."""
+        if not self.isRunning:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="memory-indexer", daemon=True)
+            self._thread.start()
+        return self
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def close(self, timeout:float|None=None) -> None:
+        """Stops the thread after one last pass over the exchanges written so far."""
+        if not self.isRunning:
+            return
+        assert self._thread is not None
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _indexPass(self) -> bool:
+        """Indexes what was written since the last pass, False when something failed."""
+        index = self.getIndex()
+        with self.openReader() as database:
+            exchanges, lastMessageId = index.unindexedExchanges(database)
+        for batchStart in range(0, len(exchanges), self.batchSize):
+            batch = exchanges[batchStart:batchStart + self.batchSize]
+            unitVectors = index.embedExchanges(batch)
+            if unitVectors is None:
+                return False
+            with self.openWriter() as database:
+                index.storeExchanges(database, unitVectors, batch)
+        index.markScanned(lastMessageId)
+        return True
+
+    def _run(self) -> None:
+        failures = 0
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                succeeded = self._indexPass()
+            except Exception as error:
+                self.lastError = error
+                self.metrics.incrementCounter("memory_index_failures_total")
+                succeeded = False
+            if self._stopping.is_set():
+                return
+            if succeeded:
+                failures = 0
+                continue
+            failures += 1
+            # the model may be missing or still loading, the flushes in between don't retry it
+            if self._stopping.wait(min(self.retryDelay * 2 ** (failures - 1), self.maxRetryDelay)):
+                return
+            self._wake.set()
+
+
+class MemoryRecall:
+    """
+    Picks the past exchanges most relevant to a new message for the prompt.
+    Hits are added best first while they fit the token budget and sent as one system
+    message in front of the new human message. Only the exchanges of the user's own
+    conversations are recalled. A failing embedding model only costs the recalled
+    context, never the turn.
+    """
+    def __init__(self, getIndex:Callable[[], SemanticMemoryIndex], estimator:TokenEstimator,
+                 getConversationId:Callable[[], int|None], getUserId:Callable[[], int], k:int=MEMORY_TOP_K,
+                 tokenBudget:int=MEMORY_TOKEN_BUDGET) -> None:
+        self.getIndex = getIndex
+        self.estimator = estimator
+        self.getConversationId = getConversationId
+        self.getUserId = getUserId
+        self.k = k
+        self.tokenBudget = tokenBudget
+
+    def recall(self, newHumanMessage:HumanMessage) -> list[BaseMessage]:
+        index = self.getIndex()
+        try:
+            hits = index.search(newHumanMessage.text, self.k, self.getConversationId(), self.getUserId())
+        except Exception:
+            index.metrics.incrementCounter("memory_search_failures_total")
+            return []
+        usedTokens = self.estimator.estimate(MEMORY_HEADER) + MESSAGE_TOKEN_OVERHEAD
+        recalledTexts:list[str] = []
+        for hit in hits:
+            hitTokens = self.estimator.estimate(hit.text)
+            if usedTokens + hitTokens > self.tokenBudget:
+                continue
+            usedTokens += hitTokens
+            recalledTexts.append(hit.text)
+        index.metrics.incrementCounter("memory_recalled_exchanges_total", len(recalledTexts))
+        if not recalledTexts:
+            return []
+        return [SystemMessage("\n\n".join([MEMORY_HEADER, *recalledTexts]))]
+
+
+if __name__ == "__main__":
+    from globals import openConversationHistoryDb
+    from providers import providerRegistry
+    parser = argparse.ArgumentParser(description="Embed stored exchanges that are not in the semantic memory yet")
+    parser.add_argument("--db", default=None, help="history database path")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    arguments = parser.parse_args()
+    historyDatabase = openConversationHistoryDb(arguments.db)
+    memoryIndex = SemanticMemoryIndex(providerRegistry.getEmbeddings("ollama-embeddings", arguments.model), arguments.model)
+    memoryIndex.load(historyDatabase)
+    print(f"indexed {memoryIndex.backfill(historyDatabase)} exchanges, {len(memoryIndex)} in total")
+    historyDatabase.disconnect(True)
@@ -0,0 +1,39 @@
+import time
+from typing import Any
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph.state import CompiledStateGraph
+from agentState import AgentState
+from chatGraph import isEndLoop
+from metrics import MetricsRegistry, metricsRegistry
+
+
+class SessionDriver:
+    """
+    Runs a chat session as one graph invocation per turn.
+    A session that loops inside a single invocation hits LangGraph's recursion limit
+    after a few dozen turns and keeps every step of the run alive; invoking the
+    one-turn graph in a loop lets sessions run for any number of turns in constant
+    memory. Each invocation starts from the state the previous one returned, and a
+    checkpointer in the graph saves the state after every turn.
+    """
+    def __init__(self, compiledGraph:CompiledStateGraph, config:RunnableConfig, # pyright: ignore[reportMissingTypeArgument]
+                 metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.compiledGraph = compiledGraph
+        self.config = config
+        self.metrics = metrics
+        self.turns = 0
+
+    async def runTurn(self, state:AgentState) -> AgentState:
+        startTime = time.perf_counter()
+        newState:dict[str, Any] = await self.compiledGraph.ainvoke(state, self.config) # pyright: ignore[reportUnknownMemberType]
+        self.turns += 1
+        self.metrics.observe("session_turn_seconds", time.perf_counter() - startTime)
+        return AgentState(shortConversationHistory=newState["shortConversationHistory"])
+
+    async def run(self, initialState:AgentState) -> AgentState:
+        """Invokes the graph until the user exits, returns the final state without the exit command."""
+        state = initialState
+        while True:
+            state = await self.runTurn(state)
+            if isEndLoop(state):
+                return state
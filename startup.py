@@ -0,0 +1,121 @@
+import asyncio
+import json
+import os
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+from langchain_core.language_models import BaseChatModel
+from constants import MODEL_KEEP_ALIVE, MODEL_PRELOAD_TIMEOUT_SECONDS
+from metrics import MetricsRegistry, metricsRegistry
+from scheduler import innermostModel
+
+
+def getOllamaUrl(baseUrl:str|None=None) -> str:
+    """The server the ollama client would talk to, OLLAMA_HOST or the local default."""
+    url = baseUrl or os.getenv("OLLAMA_HOST") or "127.0.0.1:11434"
+    return (url if "://" in url else f"http://{url}").rstrip("/")
+
+
+async def preloadOllamaModel(modelName:str, baseUrl:str|None=None, keepAlive:str|float=MODEL_KEEP_ALIVE,
+                             numCtx:int|None=None, timeout:float=MODEL_PRELOAD_TIMEOUT_SECONDS) -> bool:
+    """
+    Loads an Ollama model with an empty generate request and keeps it resident.
+    Only the standard library is used, so the model can load while langchain is still being imported.
+    num_ctx is sent along because Ollama reloads a model whose context size changes.
+    A server that does not answer within timeout seconds raises, so a hung warm-up can't hold up startup.
+    """
+    body:dict[str, Any] = {"model": modelName, "prompt": "", "stream": False, "keep_alive": keepAlive}
+    if numCtx is not None:
+        body["options"] = {"num_ctx": numCtx}
+    request = urllib.request.Request(f"{getOllamaUrl(baseUrl)}/api/generate", data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+
+    def send() -> None:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+
+    await asyncio.to_thread(send)
+    return True
+
+
+async def preloadModel(model:BaseChatModel, keepAlive:str|float=MODEL_KEEP_ALIVE,
+                       timeout:float=MODEL_PRELOAD_TIMEOUT_SECONDS) -> bool:
+    """Preloads the Ollama model behind any wrappers, returns False for models that are not served by Ollama."""
+    ollamaModel:Any = innermostModel(model)
+    if ollamaModel._llm_type != "chat-ollama": # pyright: ignore[reportPrivateUsage]
+        return False
+    return await preloadOllamaModel(ollamaModel.model, ollamaModel.base_url, ollamaModel.keep_alive or keepAlive,
+                                    ollamaModel.num_ctx, timeout)
+
+
+@dataclass(frozen=True)
+class StartupStep:
+    name:str
+    startedAt:float
+    seconds:float
+    error:BaseException|None = None
+
+
+@dataclass
+class StartupReport:
+    wallSeconds:float = 0.0
+    steps:list[StartupStep] = field(default_factory=list[StartupStep])
+
+    def describe(self) -> str:
+        stepDescriptions = ", ".join(f"{step.name} {step.seconds * 1000:.0f} ms"
+                                     + (f" (failed: {step.error!r})" if step.error is not None else "")
+                                     for step in self.steps)
+        return f"[startup] ready in {self.wallSeconds * 1000:.0f} ms: {stepDescriptions}"
+
+
+class StartupOrchestrator:
+    """
+    Runs the startup steps concurrently and times each of them.
+    A step only waits for the steps named in its dependencies. Failing optional steps,
+    like warming up a model that is not pulled yet, are reported and startup carries on.
+    """
+    def __init__(self, metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.metrics = metrics
+        self._steps:dict[str, tuple[Callable[[], Awaitable[Any]], tuple[str, ...], bool]] = {}
+        # results of the finished steps, a step can read the results of the steps it runs after
+        self.results:dict[str, Any] = {}
+
+    def addStep(self, name:str, runStep:Callable[[], Awaitable[Any]], after:tuple[str, ...]=(),
+                required:bool=True) -> None:
+        unknownSteps = [dependency for dependency in after if dependency not in self._steps]
+        if unknownSteps:
+            raise ValueError(f"step {name} depends on unknown steps {unknownSteps}")
+        self._steps[name] = (runStep, after, required)
+
+    async def run(self) -> tuple[StartupReport, dict[str, Any]]:
+        """Returns the timing report and the result of every step that succeeded."""
+        report = StartupReport()
+        results = self.results = {}
+        tasks:dict[str, asyncio.Task[Any]] = {}
+        startTime = time.perf_counter()
+
+        async def runStep(name:str) -> Any:
+            stepFunction, dependencies, _ = self._steps[name]
+            await asyncio.gather(*(tasks[dependency] for dependency in dependencies))
+            stepStart = time.perf_counter()
+            try:
+                results[name] = await stepFunction()
+            except Exception as error:
+                report.steps.append(StartupStep(name, stepStart - startTime, time.perf_counter() - stepStart, error))
+                self.metrics.incrementCounter("startup_step_failures_total", step=name)
+                raise
+            report.steps.append(StartupStep(name, stepStart - startTime, time.perf_counter() - stepStart))
+            self.metrics.observe("startup_step_seconds", time.perf_counter() - stepStart, step=name)
+            return results[name]
+
+        for name in self._steps:
+            tasks[name] = asyncio.create_task(runStep(name))
+        outcomes = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        report.wallSeconds = time.perf_counter() - startTime
+        report.steps.sort(key=lambda step: step.startedAt)
+        self.metrics.observe("startup_seconds", report.wallSeconds)
+        for (name, (_, _, required)), outcome in zip(self._steps.items(), outcomes):
+            if required and isinstance(outcome, BaseException):
+                raise outcome
+        return report, results
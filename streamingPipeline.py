@@ -0,0 +1,202 @@
+import asyncio
+import inspect
+import sys
+from collections import deque
+from typing import Callable, TextIO
+from langchain_core.messages import AIMessage
+from chatEngine import STOP_REASON_METADATA_KEY, isTruncated
+from constants import STREAM_SINK_QUEUE_SIZE, TERMINAL_FLUSH_BYTES, TERMINAL_FLUSH_INTERVAL_SECONDS
+from metrics import MetricsRegistry, metricsRegistry
+
+StreamItem = str | AIMessage
+
+
+class StreamSink:
+    """Destination of streamed responses, fed in order by its own task."""
+    name = "sink"
+
+    async def write(self, piece:str) -> None:
+        pass
+
+    async def endResponse(self, response:AIMessage) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+class TerminalSink(StreamSink):
+    """
+    Prints responses to the console. Pieces are buffered and written together once
+    flushBytes are waiting or flushInterval has passed since the first of them, so a
+    fast model costs a few writes per second instead of one per token.
+    """
+    name = "terminal"
+
+    def __init__(self, output:TextIO|None=None, flushInterval:float=TERMINAL_FLUSH_INTERVAL_SECONDS,
+                 flushBytes:int=TERMINAL_FLUSH_BYTES) -> None:
+        # None writes to whatever sys.stdout is at the time
+        self.output = output
+        self.flushInterval = flushInterval
+        self.flushBytes = flushBytes
+        self._buffer:list[str] = []
+        self._bufferedBytes = 0
+        self._flushHandle:asyncio.TimerHandle|None = None
+
+    async def write(self, piece:str) -> None:
+        self._buffer.append(piece)
+        self._bufferedBytes += len(piece.encode())
+        if self._bufferedBytes >= self.flushBytes:
+            self._flushBuffer()
+        elif self._flushHandle is None:
+            self._flushHandle = asyncio.get_running_loop().call_later(self.flushInterval, self._flushBuffer)
+
+    async def endResponse(self, response:AIMessage) -> None:
+        self._buffer.append(f" [stopped: {response.response_metadata[STOP_REASON_METADATA_KEY]}]\n"
+                            if isTruncated(response) else "\n")
+        self._flushBuffer()
+
+    async def flush(self) -> None:
+        self._flushBuffer()
+
+    def _flushBuffer(self) -> None:
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        if not self._buffer:
+            return
+        output = self.output or sys.stdout
+        output.write("".join(self._buffer))
+        output.flush()
+        self._buffer.clear()
+        self._bufferedBytes = 0
+
+
+class CallbackSink(StreamSink):
+    """Hands pieces and finished responses to callables, awaiting those that return awaitables."""
+    def __init__(self, name:str, onPiece:Callable[[str], object],
+                 onResponse:Callable[[AIMessage], object]|None=None) -> None:
+        self.name = name
+        self.onPiece = onPiece
+        self.onResponse = onResponse
+
+    async def write(self, piece:str) -> None:
+        result = self.onPiece(piece)
+        if inspect.isawaitable(result):
+            await result
+
+    async def endResponse(self, response:AIMessage) -> None:
+        result = self.onResponse(response) if self.onResponse is not None else None
+        if inspect.isawaitable(result):
+            await result
+
+
+class _SinkChannel:
+    def __init__(self, sink:StreamSink, maxPending:int, metrics:MetricsRegistry) -> None:
+        self.sink = sink
+        self.metrics = metrics
+        self.queue:asyncio.Queue[StreamItem] = asyncio.Queue(maxPending)
+        # items that found the queue full; consecutive pieces are kept as one list and joined on the way in
+        self.overflow:deque[list[str]|AIMessage] = deque()
+        self.error:BaseException|None = None
+        self.task = asyncio.create_task(self._run(), name=f"stream sink {sink.name}")
+
+    def offer(self, item:StreamItem) -> None:
+        if self.error is not None:
+            return
+        if not self.overflow:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except asyncio.QueueFull:
+                pass
+        if isinstance(item, AIMessage):
+            self.overflow.append(item)
+        elif self.overflow and isinstance(pieces := self.overflow[-1], list):
+            pieces.append(item)
+            self.metrics.incrementCounter("stream_pieces_coalesced_total", sink=self.sink.name)
+        else:
+            self.overflow.append([item])
+
+    def _refill(self) -> None:
+        while self.overflow and not self.queue.full():
+            item = self.overflow.popleft()
+            self.queue.put_nowait("".join(item) if isinstance(item, list) else item)
+
+    async def _run(self) -> None:
+        while True:
+            item = await self.queue.get()
+            try:
+                if self.error is None:
+                    if isinstance(item, str):
+                        await self.sink.write(item)
+                    else:
+                        await self.sink.endResponse(item)
+            except Exception as error:
+                self.error = error
+                self.overflow.clear()
+                self.metrics.incrementCounter("stream_sink_errors_total", sink=self.sink.name)
+            finally:
+                # the overflow goes in before task_done, so drain also waits for it
+                self._refill()
+                self.queue.task_done()
+
+
+class StreamingPipeline:
+    """
+    Fans one model stream out to several sinks.
+    write and endResponse never block the model reader: every sink has a queue of
+    maxPending items drained by its own task, and the pieces that arrive while a sink's
+    queue is full are merged into one, so a slow sink costs the memory of the text it
+    has not taken yet rather than time. drain waits until every sink has caught up and
+    re-raises the error of a sink that failed; a failed sink gets nothing more.
+    """
+    def __init__(self, sinks:list[StreamSink], maxPending:int=STREAM_SINK_QUEUE_SIZE,
+                 metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.sinks = sinks
+        self.maxPending = maxPending
+        self.metrics = metrics
+        self._channels:list[_SinkChannel] = []
+        self._loop:asyncio.AbstractEventLoop|None = None
+
+    def _openChannels(self) -> list[_SinkChannel]:
+        # channels belong to the event loop of the first write, a new loop gets new ones
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._channels = [_SinkChannel(sink, self.maxPending, self.metrics) for sink in self.sinks]
+        return self._channels
+
+    def write(self, piece:str) -> None:
+        if piece:
+            for channel in self._openChannels():
+                channel.offer(piece)
+
+    def endResponse(self, response:AIMessage) -> None:
+        for channel in self._openChannels():
+            channel.offer(response)
+
+    async def drain(self) -> None:
+        for channel in self._openChannels():
+            await channel.queue.join()
+            if channel.error is None:
+                await channel.sink.flush()
+        for channel in self._channels:
+            if channel.error is not None:
+                self._channels.remove(channel)
+                channel.task.cancel()
+                raise channel.error
+
+    async def close(self) -> None:
+        try:
+            await self.drain()
+        finally:
+            for channel in self._channels:
+                channel.task.cancel()
+                await asyncio.gather(channel.task, return_exceptions=True)
+                await channel.sink.close()
+            self._channels = []
+            self._loop = None
@@ -0,0 +1,116 @@
+import asyncio
+import time
+from typing import Callable
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from constants import SUMMARY_MAX_CONSECUTIVE_FAILURES, SUMMARY_MAX_PENDING_MESSAGES, SUMMARY_MAX_WORDS
+from metrics import MetricsRegistry, metricsRegistry
+
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+FOLD_INSTRUCTIONS = """You maintain the running summary of a conversation between a user and an assistant.
+    Merge the new exchanges into the existing summary. Keep names, facts, decisions and open questions
+    the user may refer back to, drop small talk. Reply with the updated summary only, in at most {maxWords} words."""
+
+
+def formatExchanges(messages:list[HumanMessage|AIMessage]) -> str:
+    return "\n".join(f"{'User' if isinstance(message, HumanMessage) else 'Assistant'}: {message.text}"
+                     for message in messages)
+
+
+class RollingSummarizer:
+    """
+    Folds turns evicted from the context window into one running summary.
+    Folding runs as a background task on a small model so the turn that caused the
+    eviction is not delayed. Folds are serialized, and messages of a failed fold are
+    kept for the next one, at most maxPendingMessages of the latest. After
+    maxConsecutiveFailures failed folds in a row folding stops and evicted messages are
+    dropped. Every new summary is handed to persistSummary.
+    """
+    def __init__(self, getModel:Callable[[], BaseChatModel], persistSummary:Callable[[str], None]|None=None, summary:str="",
+                 maxWords:int=SUMMARY_MAX_WORDS, maxPendingMessages:int=SUMMARY_MAX_PENDING_MESSAGES,
+                 maxConsecutiveFailures:int=SUMMARY_MAX_CONSECUTIVE_FAILURES,
+                 metrics:MetricsRegistry=metricsRegistry) -> None:
+        self.getModel = getModel
+        self.persistSummary = persistSummary
+        self.summary = summary
+        self.maxWords = maxWords
+        self.maxPendingMessages = maxPendingMessages
+        self.maxConsecutiveFailures = maxConsecutiveFailures
+        self.metrics = metrics
+        self._pendingMessages:list[HumanMessage|AIMessage] = []
+        self._consecutiveFailures = 0
+        self._foldLock = asyncio.Lock()
+        self._foldTasks:set[asyncio.Task[None]] = set()
+
+    @property
+    def summaryMessage(self) -> SystemMessage|None:
+        if self.summary == "":
+            return None
+        return SystemMessage(f"{SUMMARY_HEADER}\n{self.summary}")
+
+    @property
+    def isDisabled(self) -> bool:
+        return self._consecutiveFailures >= self.maxConsecutiveFailures
+
+    def buildFoldPrompt(self, messages:list[HumanMessage|AIMessage]) -> list[BaseMessage]:
+        return [SystemMessage(FOLD_INSTRUCTIONS.format(maxWords=self.maxWords)),
+                HumanMessage(f"Existing summary:\n{self.summary or '(none yet)'}\n\n"
+                             f"New exchanges:\n{formatExchanges(messages)}")]
+
+    def scheduleFold(self, evictedMessages:list[HumanMessage|AIMessage]) -> None:
+        """Queues evicted messages and starts a fold when called inside a running event loop."""
+        if not evictedMessages:
+            return
+        if self.isDisabled:
+            self._drop(len(evictedMessages))
+            return
+        self._pendingMessages.extend(evictedMessages)
+        self._trimPendingMessages()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        foldTask = loop.create_task(self._fold())
+        self._foldTasks.add(foldTask)
+        foldTask.add_done_callback(self._foldTasks.discard)
+
+    async def _fold(self) -> None:
+        async with self._foldLock:
+            if not self._pendingMessages or self.isDisabled:
+                return
+            messages, self._pendingMessages = self._pendingMessages, []
+            startTime = time.perf_counter()
+            try:
+                response = await self.getModel().ainvoke(self.buildFoldPrompt(messages))
+            except Exception:
+                self._pendingMessages[:0] = messages
+                self._trimPendingMessages()
+                self._consecutiveFailures += 1
+                self.metrics.incrementCounter("summary_failures_total")
+                if self.isDisabled:
+                    self._drop(len(self._pendingMessages))
+                    self._pendingMessages = []
+                    self.metrics.incrementCounter("summary_disabled_total")
+                return
+            self._consecutiveFailures = 0
+            self.summary = response.text.strip()
+            self.metrics.incrementCounter("summary_folds_total")
+            self.metrics.observe("summary_fold_seconds", time.perf_counter() - startTime)
+            self.metrics.setGauge("summary_characters", len(self.summary))
+            if self.persistSummary is not None:
+                await asyncio.to_thread(self.persistSummary, self.summary)
+
+    def _trimPendingMessages(self) -> None:
+        # the oldest messages go first, they matter least to the turns still ahead
+        overflow = len(self._pendingMessages) - self.maxPendingMessages
+        if overflow > 0:
+            del self._pendingMessages[:overflow]
+            self._drop(overflow)
+
+    def _drop(self, messageCount:int) -> None:
+        self.metrics.incrementCounter("summary_dropped_messages_total", messageCount)
+
+    async def flush(self) -> None:
+        """Waits for running folds and folds whatever is still pending."""
+        await asyncio.gather(*self._foldTasks)
+        await self._fold()
@@ -0,0 +1,217 @@
+from DB import ColumnNotFoundError, Database, DatabasePool, SchemaVersionError, TableNotFoundError
+from metrics import MetricsRegistry
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pytest
+import sqlite3
+
+
+def test_insertRunsOnlyItsOwnStatement(tmp_path:Path)->None:
+    database = Database(str(tmp_path / "test.db"))
+    database.createTable("notes", {"id": "INTEGER PRIMARY KEY", "text": "TEXT"})
+    statements:list[str] = []
+    database.connection.set_trace_callback(statements.append)
+
+    database.insertData("notes", {"text": "first"})
+    database.insertData(tableName="notes", columnAndValue={"text": "second"}, saveChanges=True)
+    assert database.getLatestData("notes", "text") == "second"
+
+    # sqlite3 opens the transaction itself, the checks run no statements
+    assert [statement.split()[0] for statement in statements if statement != "BEGIN "] == ["INSERT", "INSERT", "COMMIT",
+                                                                                           "SELECT"]
+    database.disconnect(False)
+
+
+def test_schemaChangesReachTheCatalog(tmp_path:Path)->None:
+    path = str(tmp_path / "test.db")
+    database = Database(path)
+    database.createTable("notes", {"id": "INTEGER PRIMARY KEY", "text": "TEXT"})
+    with pytest.raises(ColumnNotFoundError):
+        database.insertData("notes", {"author": "me"})
+    database.insertColumn("notes", "author", "TEXT")
+    database.insertData("notes", {"text": "hi", "author": "me"}, True)
+
+    # another connection changes the schema behind the catalog's back
+    otherConnection = sqlite3.connect(path)
+    otherConnection.execute("ALTER TABLE notes ADD COLUMN pinned INTEGER")
+    otherConnection.execute("CREATE TABLE tags (name TEXT)")
+    otherConnection.commit()
+    otherConnection.close()
+
+    assert database.isColumnExists("notes", "pinned")
+    database.insertData("tags", {"name": "todo"})
+    assert database.getColumns("notes") == ["id", "text", "author", "pinned"]
+    with pytest.raises(TableNotFoundError):
+        database.getAllData("missing")
+    with pytest.raises(ColumnNotFoundError):
+        database.updateData("notes", {"text": "bye"}, "missing", 1)
+    database.disconnect(False)
+
+
+def test_bulkWritesAndUpserts(tmp_path:Path)->None:
+    database = Database(str(tmp_path / "test.db"))
+    database.createTable("notes", {"id": "INTEGER PRIMARY KEY", "slug": "TEXT UNIQUE", "text": "TEXT"})
+
+    rows = ({"slug": f"note-{index}", "text": "bulk"} if index % 2 else {"text": "no slug"} for index in range(5000))
+    assert database.insertMany("notes", rows, chunkSize=300, saveChanges=True) == 5000
+    assert database.insertReturningIds("notes", [{"text": "a"}, {"text": "b"}, {"text": "c"}]) == [5001, 5002, 5003]
+
+    # the id of the row written comes back for updates as well as inserts
+    assert database.upsertData("notes", {"slug": "note-1", "text": "edited"}, ["slug"]) == 2
+    assert database.upsertData("notes", {"slug": "new", "text": "fresh"}, ["slug"]) == 5004
+    assert database.upsertData("notes", {"slug": "new", "text": "ignored"}, ["slug"], updateColumns=[]) is None
+    assert database.upsertMany("notes", [{"slug": "note-3", "text": "edited"}, {"slug": "newer", "text": "x"}],
+                               ["slug"]) == 2
+    database.cursor.execute("SELECT COUNT(*), SUM(text = 'edited') FROM notes")
+    assert database.cursor.fetchone() == (5005, 2)
+    with pytest.raises(ColumnNotFoundError):
+        database.insertMany("notes", [{"text": "fine"}, {"missing": 1}])
+    database.cursor.execute("SELECT COUNT(*) FROM notes WHERE text = 'fine'")
+    assert database.cursor.fetchone() == (0,)
+    database.disconnect(True)
+
+
+def test_nestedTransactionsUndoOnlyTheFailedBlock(tmp_path:Path)->None:
+    path = str(tmp_path / "test.db")
+    database = Database(path)
+    database.createTable("notes", {"id": "INTEGER PRIMARY KEY", "text": "TEXT"})
+    database.connection.commit()
+    reader = sqlite3.connect(path)
+
+    with database.transaction():
+        database.insertData("notes", {"text": "outer"}, saveChanges=True)
+        with pytest.raises(RuntimeError):
+            with database.transaction():
+                database.insertMany("notes", [{"text": "inner"}] * 3)
+                raise RuntimeError("undo the inner block")
+        # saveChanges inside a transaction waits for the outermost block
+        assert reader.execute("SELECT COUNT(*) FROM notes").fetchone() == (0,)
+
+    assert reader.execute("SELECT text FROM notes").fetchall() == [("outer",)]
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            database.insertData("notes", {"text": "lost"})
+            raise RuntimeError("undo everything")
+    assert database.getAllData("notes") == [(1, "outer")]
+    reader.close()
+    database.disconnect(False)
+
+
+def test_poolReadsWhileAWriteIsInFlight(tmp_path:Path)->None:
+    pool = DatabasePool(str(tmp_path / "test.db"), readerCount=2, busyTimeout=1.0)
+    with pool.writer() as database:
+        database.createTable("notes", {"id": "INTEGER PRIMARY KEY", "text": "TEXT"})
+        database.insertData("notes", {"text": "committed"})
+
+    with pool.writer() as writer:
+        writer.insertData("notes", {"text": "in flight"})
+        # WAL readers see the last commit instead of waiting for the writer
+        with pool.reader() as reader:
+            assert reader.getAllData("notes") == [(1, "committed")]
+            assert reader.cursor.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+            with pytest.raises(sqlite3.OperationalError):
+                reader.insertData("notes", {"text": "readers can't write"})
+    with pool.reader() as reader:
+        assert len(reader.getAllData("notes")) == 2
+
+    with pytest.raises(RuntimeError):
+        with pool.writer() as writer:
+            writer.insertData("notes", {"text": "undone"})
+            raise RuntimeError("the block failed")
+
+    def writeAndRead(index:int)->int:
+        with pool.writer() as writer:
+            writer.insertMany("notes", [{"text": f"thread {index}"}] * 10)
+        with pool.reader() as reader:
+            return len(reader.getAllData("notes"))
+
+    with ThreadPoolExecutor(8) as executor:
+        counts = list(executor.map(writeAndRead, range(40)))
+    assert max(counts) == 402
+    with pool.writer() as writer:
+        # every thread gets its own cursor on the shared writer connection
+        assert ThreadPoolExecutor(1).submit(lambda: writer.cursor).result() is not writer.cursor
+    pool.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        with pool.reader():
+            pass
+
+
+def test_poolReusesItsConnectionsAndReplacesDeadOnes(tmp_path:Path)->None:
+    metrics = MetricsRegistry()
+    pool = DatabasePool(str(tmp_path / "test.db"), readerCount=2, metrics=metrics)
+    with pool.writer() as database:
+        database.createTable("notes", {"id": "INTEGER PRIMARY KEY", "text": "TEXT"})
+    with pool.reader() as reader:
+        reader.getAllData("notes")
+
+    def opened(role:str)->float:
+        return metrics.getCounter("database_connections_opened_total", role=role)
+
+    assert (opened("writer"), opened("reader")) == (1, 1)
+    for turn in range(20):
+        with pool.writer() as writer:
+            writer.insertData("notes", {"text": f"turn {turn}"})
+        with pool.reader() as reader:
+            assert len(reader.getAllData("notes")) == turn + 1
+    assert pool.checkHealth()
+    assert (opened("writer"), opened("reader")) == (1, 1)
+
+    with pool.writer() as writer, pool.reader() as reader:
+        deadConnections = [writer.connection, reader.connection]
+    for connection in deadConnections:
+        connection.close()
+    assert not pool.checkHealth()
+    assert metrics.getCounter("database_connections_replaced_total", role="writer") == 1
+    assert metrics.getCounter("database_connections_replaced_total", role="reader") == 1
+    with pool.writer() as writer:
+        writer.insertData("notes", {"text": "after the reconnect"})
+    with pool.reader() as reader:
+        assert len(reader.getAllData("notes")) == 21
+    assert pool.checkHealth()
+    pool.close()
+
+
+def test_migrationsRunOnceAndAFailedOneIsUndone(tmp_path:Path)->None:
+    path = str(tmp_path / "test.db")
+    database = Database(path)
+    migrations = [lambda database: database.createTable("notes", {"id": "INTEGER PRIMARY KEY", "text": "TEXT"}),
+                  lambda database: database.createIndex("notes", "notes_text", ["text"])]
+    assert database.migrate(migrations) == 2
+    assert database.migrate(migrations) == 0
+    with pytest.raises(ColumnNotFoundError):
+        database.createIndex("notes", "notes_missing", ["missing"])
+
+    def failingMigration(database:Database)->None:
+        database.insertColumn("notes", "pinned", "INTEGER")
+        raise RuntimeError("the migration failed")
+
+    with pytest.raises(RuntimeError):
+        database.migrate([*migrations, failingMigration])
+    assert database.userVersion == 2
+    assert not database.isColumnExists("notes", "pinned")
+    database.disconnect(False)
+
+    # a database written by newer code isn't touched
+    with pytest.raises(SchemaVersionError):
+        Database(path).migrate(migrations[:1])
+
+
+def test_failedWriterBlockReleasesTheLock(tmp_path:Path)->None:
+    path = str(tmp_path / "test.db")
+    pool = DatabasePool(path, busyTimeout=0.1)
+    with pool.writer() as writer:
+        writer.createTable("notes", {"id": "INTEGER PRIMARY KEY", "text": "TEXT NOT NULL"})
+
+    with pytest.raises(sqlite3.IntegrityError):
+        with pool.writer() as writer:
+            writer.insertData("notes", {"text": "undone"})
+            writer.insertData("notes", {"text": None})
+    assert not writer.connection.in_transaction
+    other = sqlite3.connect(path, timeout=0.1)
+    other.execute("INSERT INTO notes (text) VALUES ('other connection')")
+    other.commit()
+    other.close()
+    with pool.reader() as reader:
+        assert reader.getAllData("notes") == [(1, "other connection")]
+    pool.close()
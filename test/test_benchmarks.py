@@ -0,0 +1,34 @@
+from benchmarks.report import SessionTimings, compareReports
+from pathlib import Path
+import json
+import subprocess
+import sys
+
+PROJECT_DIRECTORY = str(Path(__file__).resolve().parent.parent)
+
+
+def test_benchmarksWriteComparableJsonReports(tmp_path:Path)->None:
+    reportPath = tmp_path / "report.json"
+    benchmarkCommand = [sys.executable, "-m", "benchmarks", "--turns", "4", "--first-token-delay", "0",
+                        "--tokens-per-second", "100000", "--response-tokens", "3", "--output", str(reportPath)]
+    subprocess.run(benchmarkCommand, cwd=PROJECT_DIRECTORY, check=True, capture_output=True)
+
+    report = json.loads(reportPath.read_text(encoding="utf-8"))
+    assert set(report["results"]) == {"chat", "agent"}
+    assert report["results"]["chat"]["turns"] == 4
+    assert report["results"]["chat"]["dbWrites"] >= 1
+    # the turns reuse the connections opened at startup
+    assert report["results"]["chat"]["dbConnectionsOpened"] == 0
+    assert report["results"]["agent"]["ttftP50Ms"] > 0
+
+    comparison = subprocess.run([*benchmarkCommand[:-2], "agent", "--baseline", str(reportPath)],
+                                cwd=PROJECT_DIRECTORY, check=True, capture_output=True, text=True).stdout
+    assert "agent.turnP50Ms" in comparison and "chat." not in comparison
+
+
+def test_summarySubtractsModelTime()->None:
+    timings = SessionTimings("chat", turnLatency=[0.05, 0.07], modelSeconds=[0.04, 0.04], timeToFirstToken=[0.01, 0.01])
+    summary = timings.summary()
+    assert summary["overheadP50Ms"] == 10.0 and summary["overheadP99Ms"] == 30.0
+    assert compareReports({"results": {"chat": {"turnP50Ms": 25.0}}},
+                          {"results": {"chat": summary}}).splitlines()[1] == "chat.turnP50Ms: 25.0 -> 50.0 (+100.0%)"
@@ -0,0 +1,295 @@
+from chatEngine import ChatEngine, EXIT_COMMAND, STOP_REASON_METADATA_KEY, isTruncated
+from agentState import AgentState
+from fakeOllamaServer import FakeOllamaServer, FakeOllamaSettings
+from globals import (HISTORY_MIGRATIONS, addTruncatedColumn, createConversation, createConversationHistoryDb, getMessageRows,
+                     getOrCreateUserId, getPartialResponse, openConversationHistoryDb, savePartialResponse)
+from metrics import MetricsRegistry
+from persistenceQueue import WriteBehindQueue
+from tracing import Tracer
+from constants import MessagesTableInfo
+from langchain_ollama import ChatOllama
+from pathlib import Path
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from typing import Any, AsyncIterator
+import asyncio
+import pytest
+import time
+
+
+class DroppedConnectionModel(BaseChatModel):
+    """Streams the first piece of every answer then drops the connection, the second request finishes."""
+    pieces:list[str]
+    requests:list[list[BaseMessage]] = []
+
+    @property
+    def _llm_type(self)->str:
+        return "dropped-connection"
+
+    def _generate(self, messages:list[BaseMessage], stop:list[str]|None=None, run_manager:Any=None,
+                  **kwargs:Any)->ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage("".join(self.pieces)))])
+
+    async def _astream(self, messages:list[BaseMessage], stop:list[str]|None=None, run_manager:Any=None,
+                       **kwargs:Any)->AsyncIterator[ChatGenerationChunk]:
+        self.requests.append(messages)
+        if len(self.requests) == 1:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=self.pieces[0]))
+            raise ConnectionError("connection reset")
+        for piece in self.pieces[1:]:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+
+
+def buildEngine(userInputs:list[str], responses:list[str], recordedTurns:list[tuple[str,str]],
+                outputPieces:list[str], recordDelay:float=0.0)->ChatEngine:
+    model = GenericFakeChatModel(messages=iter([AIMessage(response) for response in responses]))
+    inputs = iter(userInputs)
+
+    async def readInput()->str:
+        return next(inputs)
+
+    def recordTurn(humanMessage:HumanMessage, aiMessage:AIMessage)->None:
+        time.sleep(recordDelay)
+        recordedTurns.append((str(humanMessage.content), str(aiMessage.content)))
+
+    def updateHistory(state:AgentState, humanMessage:HumanMessage, aiMessage:AIMessage)->AgentState:
+        state["shortConversationHistory"].extend([humanMessage, aiMessage])
+        return state
+
+    return ChatEngine(getModel=lambda: model,
+                      buildPromptPrefix=lambda state: ["system", *state["shortConversationHistory"]],
+                      buildPromptSuffix=lambda humanMessage: [humanMessage],
+                      updateHistory=updateHistory,
+                      recordTurn=recordTurn,
+                      readInput=readInput,
+                      writeOutput=outputPieces.append,
+                      onResponseComplete=lambda response: None)
+
+
+def test_runTurnStreamsAndPersists()->None:
+    recordedTurns:list[tuple[str,str]] = []
+    outputPieces:list[str] = []
+    engine = buildEngine(["hi", EXIT_COMMAND], ["hello there"], recordedTurns, outputPieces)
+    state = AgentState(shortConversationHistory=[])
+
+    async def session()->AgentState:
+        await engine.runTurn(state)
+        return await engine.runTurn(state)
+
+    finalState = asyncio.run(session())
+    history:list[BaseMessage] = list(finalState["shortConversationHistory"])
+    assert "".join(outputPieces) == "hello there"
+    assert [message.content for message in history] == ["hi", "hello there", EXIT_COMMAND]
+    assert recordedTurns == [("hi", "hello there")]
+
+
+def test_runTurnDoesNotWaitForPersistence()->None:
+    recordedTurns:list[tuple[str,str]] = []
+    engine = buildEngine(["one", "two"], ["first", "second"], recordedTurns, [], recordDelay=0.3)
+    state = AgentState(shortConversationHistory=[])
+
+    async def session()->float:
+        startTime = time.perf_counter()
+        await engine.runTurn(state)
+        await engine.runTurn(state)
+        elapsed = time.perf_counter() - startTime
+        await engine.flushPendingWrites()
+        return elapsed
+
+    elapsed = asyncio.run(session())
+    assert elapsed < 0.3
+    assert recordedTurns == [("one", "first"), ("two", "second")]
+
+
+async def streamFromFakeOllama(settings:FakeOllamaSettings, cancelAfter:float|None=None,
+                               responseTimeout:float|None=None, numPredict:int|None=None,
+                               metrics:MetricsRegistry|None=None)->tuple[AIMessage, FakeOllamaServer]:
+    fakeOllama = FakeOllamaServer(settings)
+    model = ChatOllama(model="fake-model", base_url=await fakeOllama.start(port=0), num_predict=numPredict)
+    engine = ChatEngine(getModel=lambda: model, buildPromptPrefix=lambda state: [], buildPromptSuffix=lambda message: [],
+                        updateHistory=lambda state, humanMessage, aiMessage: state,
+                        recordTurn=lambda humanMessage, aiMessage: None, writeOutput=lambda piece: None,
+                        onResponseComplete=lambda response: None, tracer=Tracer(metrics or MetricsRegistry()),
+                        responseTimeout=responseTimeout)
+    try:
+        responseTask = asyncio.create_task(engine.streamResponse(["hello"]))
+        if cancelAfter is not None:
+            await asyncio.sleep(cancelAfter)
+            assert engine.isResponding
+            assert engine.cancelResponse()
+        response = await responseTask
+        assert not engine.isResponding and not engine.cancelResponse()
+        # the server notices the closed connection on its next write
+        await asyncio.sleep(2 / settings.tokensPerSecond)
+        return response, fakeOllama
+    finally:
+        await fakeOllama.stop()
+
+
+def test_cancelledResponseStopsOllamaAndKeepsThePartialAnswer()->None:
+    metrics = MetricsRegistry()
+    settings = FakeOllamaSettings(tokensPerSecond=50, firstTokenDelay=0.01, responseTokens=500, token="x ")
+    response, fakeOllama = asyncio.run(streamFromFakeOllama(settings, cancelAfter=0.2, metrics=metrics))
+
+    assert isTruncated(response)
+    assert response.response_metadata[STOP_REASON_METADATA_KEY] == "cancelled"
+    assert 0 < len(str(response.content)) < 500 * len("x ")
+    assert fakeOllama.abortedRequests == 1
+    assert metrics.getCounter("responses_truncated_total", reason="cancelled") == 1
+
+
+def test_responseCapsMarkTheAnswerTruncated()->None:
+    settings = FakeOllamaSettings(tokensPerSecond=50, firstTokenDelay=0.01, responseTokens=500, token="x ")
+    timedOut, fakeOllama = asyncio.run(streamFromFakeOllama(settings, responseTimeout=0.2))
+    assert timedOut.response_metadata[STOP_REASON_METADATA_KEY] == "timeout"
+    assert fakeOllama.abortedRequests == 1
+
+    cutOff, _ = asyncio.run(streamFromFakeOllama(settings, numPredict=3))
+    assert cutOff.content == "x x x "
+    assert cutOff.response_metadata[STOP_REASON_METADATA_KEY] == "length"
+
+    finished, _ = asyncio.run(streamFromFakeOllama(FakeOllamaSettings(firstTokenDelay=0.01, responseTokens=3)))
+    assert not isTruncated(finished)
+
+
+def test_truncatedFlagIsPersisted(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+    database = createConversationHistoryDb(dataBasePath)
+    conversationId = createConversation(database, getOrCreateUserId(database, "user"))
+    # a database from before responses could be truncated gets the column when it is opened
+    database.cursor.execute(f"ALTER TABLE {MessagesTableInfo.tableName} DROP COLUMN {MessagesTableInfo.columnTruncated}")
+    database.cursor.execute(f"PRAGMA user_version={HISTORY_MIGRATIONS.index(addTruncatedColumn)}")
+    database.disconnect(True)
+    writer = WriteBehindQueue(lambda: openConversationHistoryDb(dataBasePath)).start()
+    truncatedResponse = AIMessage("partial", response_metadata={"truncated": True, STOP_REASON_METADATA_KEY: "cancelled"})
+    writer.enqueue(getMessageRows(conversationId, "user", "model", HumanMessage("q1"), AIMessage("complete")))
+    writer.enqueue(getMessageRows(conversationId, "user", "model", HumanMessage("q2"), truncatedResponse))
+    writer.close(timeout=5)
+
+    database = openConversationHistoryDb(dataBasePath)
+    database.cursor.execute(f"SELECT {MessagesTableInfo.columnContent}, {MessagesTableInfo.columnTruncated} "
+                            f"FROM {MessagesTableInfo.tableName} ORDER BY {MessagesTableInfo.columnMessageId}")
+    assert database.cursor.fetchall() == [("q1", 0), ("complete", 0), ("q2", 0), ("partial", 1)]
+    database.disconnect(False)
+
+
+def test_failedStreamContinuesFromThePartialAnswer()->None:
+    metrics = MetricsRegistry()
+    model = DroppedConnectionModel(pieces=["The answer ", "goes ", "on."], requests=[])
+    savedProgress:list[str|None] = []
+    recordedTurns:list[tuple[str,str]] = []
+    engine = ChatEngine(getModel=lambda: model, buildPromptPrefix=lambda state: ["system"],
+                        buildPromptSuffix=lambda humanMessage: [humanMessage],
+                        updateHistory=lambda state, humanMessage, aiMessage: state,
+                        recordTurn=lambda humanMessage, aiMessage: recordedTurns.append((humanMessage.text, aiMessage.text)),
+                        readInput=lambda: asyncio.sleep(0, "question"), writeOutput=lambda piece: None,
+                        onResponseComplete=lambda response: None, tracer=Tracer(metrics),
+                        saveProgress=lambda humanMessage, partialText: savedProgress.append(partialText),
+                        progressInterval=0.0, resumeAttempts=1, resumeDelay=0.0)
+
+    async def session()->None:
+        await engine.runTurn(AgentState(shortConversationHistory=[]))
+        await engine.flushPendingWrites()
+
+    asyncio.run(session())
+    assert recordedTurns == [("question", "The answer goes on.")]
+    # the second request asks the model to continue the part it already streamed
+    assert [message.content for message in model.requests[1][-2:]] == ["question", "The answer "]
+    assert isinstance(model.requests[1][-1], AIMessage)
+    assert savedProgress[0] == "The answer " and savedProgress[-1] is None
+    assert metrics.getCounter("responses_resumed_total") == 1
+
+    failingModel = DroppedConnectionModel(pieces=["The answer ", "goes ", "on."], requests=[])
+    engine.getModel = lambda: failingModel
+    engine.resumeAttempts = 0
+    with pytest.raises(ConnectionError):
+        asyncio.run(engine.streamResponse(["question"]))
+
+
+def test_interruptedAnswerIsResumedFromTheDatabase(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+    database = createConversationHistoryDb(dataBasePath)
+    conversationId = createConversation(database, getOrCreateUserId(database, "user"))
+    # the last session died while streaming the answer
+    savePartialResponse(database, conversationId, HumanMessage("tell me a story"), "Once upon ")
+    database.disconnect(False)
+
+    def saveProgress(humanMessage:HumanMessage, partialText:str|None)->None:
+        database = openConversationHistoryDb(dataBasePath)
+        try:
+            savePartialResponse(database, conversationId, humanMessage, partialText)
+        finally:
+            database.disconnect(False)
+
+    recordedTurns:list[tuple[str,str]] = []
+    outputPieces:list[str] = []
+    model = GenericFakeChatModel(messages=iter([AIMessage("a time.")]))
+    engine = ChatEngine(getModel=lambda: model, buildPromptPrefix=lambda state: ["system"],
+                        buildPromptSuffix=lambda humanMessage: [humanMessage],
+                        updateHistory=lambda state, humanMessage, aiMessage: state,
+                        recordTurn=lambda humanMessage, aiMessage: recordedTurns.append((humanMessage.text, aiMessage.text)),
+                        writeOutput=outputPieces.append, onResponseComplete=lambda response: None,
+                        saveProgress=saveProgress)
+
+    async def resume()->None:
+        database = openConversationHistoryDb(dataBasePath)
+        partialResponse = getPartialResponse(database, conversationId)
+        database.disconnect(False)
+        assert partialResponse is not None
+        await engine.resumeTurn(AgentState(shortConversationHistory=[]), *partialResponse)
+        await engine.flushPendingWrites()
+
+    asyncio.run(resume())
+    assert recordedTurns == [("tell me a story", "Once upon a time.")]
+    assert "".join(outputPieces) == "Once upon a time."
+    database = openConversationHistoryDb(dataBasePath)
+    assert getPartialResponse(database, conversationId) is None
+    database.disconnect(False)
+
+
+def test_partialAnswerIsKeptUntilTheTurnIsFlushed(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+    database = createConversationHistoryDb(dataBasePath)
+    conversationId = createConversation(database, getOrCreateUserId(database, "user"))
+    savePartialResponse(database, conversationId, HumanMessage("tell me a story"), "Once upon ")
+    database.disconnect(False)
+
+    def saveProgress(humanMessage:HumanMessage, partialText:str|None)->None:
+        database = openConversationHistoryDb(dataBasePath)
+        try:
+            savePartialResponse(database, conversationId, humanMessage, partialText)
+        finally:
+            database.disconnect(False)
+
+    def readPartialResponse()->tuple[HumanMessage,str]|None:
+        database = openConversationHistoryDb(dataBasePath)
+        try:
+            return getPartialResponse(database, conversationId)
+        finally:
+            database.disconnect(False)
+
+    writer = WriteBehindQueue(lambda: openConversationHistoryDb(dataBasePath), flushInterval=60).start()
+    model = GenericFakeChatModel(messages=iter([AIMessage("a time.")]))
+    engine = ChatEngine(getModel=lambda: model, buildPromptPrefix=lambda state: ["system"],
+                        buildPromptSuffix=lambda humanMessage: [humanMessage],
+                        updateHistory=lambda state, humanMessage, aiMessage: state,
+                        recordTurn=lambda humanMessage, aiMessage: writer.enqueue(
+                            getMessageRows(conversationId, "user", "model", humanMessage, aiMessage)),
+                        writeOutput=lambda piece: None, onResponseComplete=lambda response: None,
+                        saveProgress=saveProgress)
+
+    async def resume()->None:
+        partialResponse = readPartialResponse()
+        assert partialResponse is not None
+        await engine.resumeTurn(AgentState(shortConversationHistory=[]), *partialResponse)
+        await asyncio.sleep(0.2)
+        # the turn is only queued, a crash now must still find the partial answer
+        assert readPartialResponse() is not None
+        await asyncio.to_thread(writer.flush, 5)
+        await engine.flushPendingWrites()
+
+    asyncio.run(resume())
+    writer.close(timeout=5)
+    assert readPartialResponse() is None
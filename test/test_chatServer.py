@@ -0,0 +1,93 @@
+from chatServer import ChatServer
+from fakeOllamaServer import FakeOllamaServer, FakeOllamaSettings
+from loadTest import runLoadTest, percentile
+from DB import Database
+from constants import MessagesTableInfo, conversationTableInfo, userTableInfo
+from langchain_ollama import ChatOllama
+from pathlib import Path
+import asyncio
+import httpx
+import json
+import pytest
+
+
+@pytest.mark.parametrize(
+    "values,fraction,expectedOutput",
+    [
+        ([3.0, 1.0, 2.0], 0.5, 2.0),
+        ([1.0, 2.0, 3.0, 4.0], 0.99, 4.0),
+        ([5.0], 0.5, 5.0),
+    ]
+)
+def test_percentile(values:list[float], fraction:float, expectedOutput:float)->None:
+    assert percentile(values, fraction) == expectedOutput
+
+
+def test_concurrentSessionsOverFakeOllama(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+
+    async def runServer():
+        fakeOllama = FakeOllamaServer(FakeOllamaSettings(tokensPerSecond=200, firstTokenDelay=0.01, responseTokens=5))
+        ollamaUrl = await fakeOllama.start(port=0)
+        chatServer = ChatServer(ChatOllama(model="fake-model", base_url=ollamaUrl), "fake-model", dataBasePath)
+        serverUrl = await chatServer.start(port=0)
+        try:
+            return await runLoadTest(serverUrl, sessions=5, turnsPerSession=2)
+        finally:
+            await chatServer.stop()
+            await fakeOllama.stop()
+
+    report = asyncio.run(runServer())
+    assert report.completedTurns == 10
+    assert report.failedTurns == 0
+    assert len(report.timeToFirstToken) == 10
+
+    database = Database(dataBasePath)
+    assert len(database.getAllData(userTableInfo.tableName)) == 5
+    assert len(database.getAllData(conversationTableInfo.tableName)) == 5
+    messages = database.getAllData(MessagesTableInfo.tableName)
+    assert len(messages) == 20
+    assert {row[2] for row in messages} == {f"load-test-user-{index}" for index in range(5)} | {"fake-model"}
+    database.disconnect(False)
+
+
+def test_cancelEndpointStopsTheResponse(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+
+    async def cancelTurn()->tuple[list[str], dict[str, object], dict[str, object], object]:
+        fakeOllama = FakeOllamaServer(FakeOllamaSettings(tokensPerSecond=50, firstTokenDelay=0.01, responseTokens=500))
+        ollamaUrl = await fakeOllama.start(port=0)
+        chatServer = ChatServer(ChatOllama(model="fake-model", base_url=ollamaUrl), "fake-model", dataBasePath)
+        serverUrl = await chatServer.start(port=0)
+        try:
+            async with httpx.AsyncClient(base_url=serverUrl, timeout=10) as client:
+                sessionId = (await client.post("/sessions", json={"userName": "user"})).json()["sessionId"]
+                eventNames:list[str] = []
+                doneData:dict[str, object] = {}
+                cancelled:dict[str, object] = {}
+                async with client.stream("POST", f"/sessions/{sessionId}/messages", json={"content": "hi"}) as response:
+                    async for line in response.aiter_lines():
+                        if line.startswith("event: "):
+                            eventNames.append(line.removeprefix("event: "))
+                            if len(eventNames) == 3:
+                                cancelled = (await client.post(f"/sessions/{sessionId}/cancel")).json()
+                        elif line.startswith("data: ") and eventNames[-1] == "done":
+                            doneData = json.loads(line.removeprefix("data: "))
+                notCancelled = (await client.post(f"/sessions/{sessionId}/cancel")).json()
+                await client.delete(f"/sessions/{sessionId}")
+            return eventNames, doneData, cancelled, notCancelled["cancelled"]
+        finally:
+            await chatServer.stop()
+            await fakeOllama.stop()
+
+    eventNames, doneData, cancelled, stillCancelled = asyncio.run(cancelTurn())
+    assert cancelled == {"cancelled": True}
+    assert stillCancelled is False
+    assert eventNames[-1] == "done" and len(eventNames) < 100
+    assert doneData["truncated"] is True
+
+    database = Database(dataBasePath)
+    database.cursor.execute(f"SELECT {MessagesTableInfo.columnTruncated} FROM {MessagesTableInfo.tableName} "
+                            f"ORDER BY {MessagesTableInfo.columnMessageId}")
+    assert database.cursor.fetchall() == [(0,), (1,)]
+    database.disconnect(False)
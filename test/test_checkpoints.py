@@ -0,0 +1,145 @@
+from checkpoints import PruningSqliteSaver, getConversationIdFromThreadId, getThreadId
+from chatEngine import ChatEngine, EXIT_COMMAND
+from chatGraph import buildChatGraph, chatEngineConfig
+from sessionDriver import SessionDriver
+from agentState import AgentState, updateShortConversationHistory
+from metrics import MetricsRegistry
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from pathlib import Path
+import asyncio
+import pytest
+
+
+class SessionCrashed(Exception):
+    pass
+
+
+def createEngine(inputs:list[str], responses:list[str])->ChatEngine:
+    remainingInputs = iter(inputs)
+    model = GenericFakeChatModel(messages=iter([AIMessage(response) for response in responses]))
+
+    async def readInput()->str:
+        userInput = next(remainingInputs, None)
+        if userInput is None:
+            raise SessionCrashed()
+        return userInput
+
+    return ChatEngine(getModel=lambda: model,
+                      buildPromptPrefix=lambda state: ["system", *state["shortConversationHistory"]],
+                      buildPromptSuffix=lambda humanMessage: [humanMessage],
+                      updateHistory=updateShortConversationHistory,
+                      recordTurn=lambda humanMessage, aiMessage: None,
+                      readInput=readInput, writeOutput=lambda piece: None,
+                      onResponseComplete=lambda response: None)
+
+
+async def runSession(path:Path, threadId:str, inputs:list[str], responses:list[str],
+                     initialState:AgentState|None=None, **saverArguments:object)->None:
+    saver = await PruningSqliteSaver.open(str(path), **saverArguments) # pyright: ignore[reportArgumentType]
+    try:
+        await SessionDriver(buildChatGraph(saver), chatEngineConfig(createEngine(inputs, responses), threadId)).run(
+            initialState or AgentState(shortConversationHistory=[]))
+    except SessionCrashed:
+        pass
+    finally:
+        await saver.close()
+
+
+def test_crashedSessionResumesFromItsLastTurn(tmp_path:Path)->None:
+    path = tmp_path / "checkpoints.db"
+    threadId = getThreadId("alice", 7)
+
+    async def crashAndResume()->AgentState|None:
+        # the process dies while waiting for the third input
+        await runSession(path, threadId, ["hi", "how are you"], ["hello", "fine"])
+        saver = await PruningSqliteSaver.open(str(path))
+        try:
+            assert await saver.latestThread("alice") == threadId
+            return await saver.restoreState(threadId)
+        finally:
+            await saver.close()
+
+    restored = asyncio.run(crashAndResume())
+    assert restored is not None
+    assert [message.content for message in restored["shortConversationHistory"]] == ["hi", "hello", "how are you", "fine"]
+    assert getConversationIdFromThreadId(threadId) == 7
+
+
+def test_restoredStateDropsTheExitCommand(tmp_path:Path)->None:
+    path = tmp_path / "checkpoints.db"
+    threadId = getThreadId("bob", 1)
+    # a run that ends with the exit command must not resume into an immediate exit
+
+    async def finishAndRestore()->AgentState|None:
+        await runSession(path, threadId, ["hi", EXIT_COMMAND], ["hello"])
+        saver = await PruningSqliteSaver.open(str(path))
+        try:
+            return await saver.restoreState(threadId)
+        finally:
+            await saver.close()
+
+    restored = asyncio.run(finishAndRestore())
+    assert restored is not None
+    assert [message.content for message in restored["shortConversationHistory"]] == ["hi", "hello"]
+
+
+def test_threadsArePrunedToTheNewestCheckpoints(tmp_path:Path)->None:
+    path = tmp_path / "checkpoints.db"
+    metrics = MetricsRegistry()
+    turns = 12
+
+    async def chatAndCount()->int:
+        await runSession(path, getThreadId("carol", 1), [f"question {turn}" for turn in range(turns)],
+                         [f"answer {turn}" for turn in range(turns)], keepPerThread=2, pruneInterval=5,
+                         metrics=metrics)
+        saver = await PruningSqliteSaver.open(str(path))
+        try:
+            assert await saver.pruneThread(getThreadId("carol", 1)) > 0
+            async with saver.conn.execute("SELECT COUNT(*) FROM checkpoints") as cursor:
+                row = await cursor.fetchone()
+            restored = await saver.restoreState(getThreadId("carol", 1))
+            assert restored is not None and len(restored["shortConversationHistory"]) == 2 * turns
+            return row[0] if row else 0
+        finally:
+            await saver.close()
+
+    assert asyncio.run(chatAndCount()) == 2
+    assert metrics.getCounter("checkpoints_pruned_total") > 0
+
+
+def test_onlyTheNewestThreadsOfAUserAreKept(tmp_path:Path)->None:
+    path = tmp_path / "checkpoints.db"
+
+    async def chatInThreads()->tuple[list[str], list[str], bool]:
+        for conversationId in (1, 2, 3):
+            await runSession(path, getThreadId("dave", conversationId), ["hi " * 2000], ["hello " * 2000])
+        await runSession(path, getThreadId("dave2", 1), ["hi"], ["hello"])
+        saver = await PruningSqliteSaver.open(str(path))
+        try:
+            # prefix matching does not mix up users whose names start alike
+            assert await saver.userThreads("dave2") == [getThreadId("dave2", 1)]
+            threadsBefore = await saver.userThreads("dave")
+            assert await saver.pruneUserThreads("dave", keepThreads=1) == 2
+            return threadsBefore, await saver.userThreads("dave"), await saver.compact(freeRatio=0.0)
+        finally:
+            await saver.close()
+
+    threadsBefore, threadsAfter, vacuumed = asyncio.run(chatInThreads())
+    assert threadsBefore == [getThreadId("dave", 3), getThreadId("dave", 2), getThreadId("dave", 1)]
+    assert threadsAfter == [getThreadId("dave", 3)]
+    assert vacuumed
+
+
+def test_unknownThreadRestoresNothing(tmp_path:Path)->None:
+    async def restore()->AgentState|None:
+        saver = await PruningSqliteSaver.open(str(tmp_path / "checkpoints.db"))
+        try:
+            assert await saver.latestThread("nobody") is None
+            return await saver.restoreState(getThreadId("nobody", 1))
+        finally:
+            await saver.close()
+
+    assert asyncio.run(restore()) is None
+    with pytest.raises(ValueError):
+        getConversationIdFromThreadId("no separator")
@@ -0,0 +1,57 @@
+from contextWindow import (CalibratedTokenEstimator, CharRatioCalibrationStore, ContextWindowManager,
+                           MESSAGE_TOKEN_OVERHEAD, pinMessage)
+from agentState import AgentState
+from metrics import MetricsRegistry
+from langchain_core.messages import AIMessage, HumanMessage
+from pathlib import Path
+
+
+class FixedEstimator:
+    def estimate(self, text:str)->int:
+        return len(text)
+
+
+def buildManager(historyBudget:int, metrics:MetricsRegistry|None=None)->ContextWindowManager:
+    return ContextWindowManager(numCtx=historyBudget + 10, estimator=FixedEstimator(), reservedForResponse=10,
+                                trimTargetRatio=0.75, metrics=metrics or MetricsRegistry())
+
+
+def test_historyStaysWithinTokenBudget()->None:
+    messageTokens = 10 + MESSAGE_TOKEN_OVERHEAD
+    manager = buildManager(historyBudget=messageTokens * 8)
+    state = AgentState(shortConversationHistory=[])
+    for turn in range(50):
+        manager.updateHistory(state, HumanMessage(f"human {turn:>4}"), AIMessage(f"ai    {turn:>4}"))
+        assert manager.countTokens(list(state["shortConversationHistory"])) <= manager.historyBudget
+    history = state["shortConversationHistory"]
+    assert isinstance(history[0], HumanMessage)
+    assert history[-1].content == "ai      49"
+
+
+def test_trimKeepsPinnedAndReturnsEvicted()->None:
+    metrics = MetricsRegistry()
+    messageTokens = 10 + MESSAGE_TOKEN_OVERHEAD
+    manager = buildManager(historyBudget=messageTokens * 4, metrics=metrics)
+    pinnedMessage = pinMessage(HumanMessage("pinned    "))
+    history:list[HumanMessage|AIMessage] = [pinnedMessage]
+    for turn in range(3):
+        history.extend([HumanMessage(f"human {turn:>4}"), AIMessage(f"ai    {turn:>4}")])
+    state = AgentState(shortConversationHistory=list(history))
+
+    evicted = manager.fit(state)
+
+    assert state["shortConversationHistory"] == [pinnedMessage, *history[-2:]]
+    assert evicted == history[1:5]
+    assert metrics.getCounter("context_evicted_messages_total") == 4
+
+
+def test_estimatorCalibratesAndPersistsRatio(tmp_path:Path)->None:
+    calibrationPath = str(tmp_path / "token calibration.json")
+    estimator = CalibratedTokenEstimator("model", CharRatioCalibrationStore(calibrationPath), smoothing=1.0)
+    assert estimator.estimate("x" * 40) == 10
+
+    estimator.calibrate(characterCount=300, tokenCount=100)
+
+    assert estimator.estimate("x" * 30) == 10
+    assert CalibratedTokenEstimator("model", CharRatioCalibrationStore(calibrationPath)).charsPerToken == 3.0
+    assert CalibratedTokenEstimator("other", CharRatioCalibrationStore(calibrationPath)).charsPerToken == 4.0
@@ -0,0 +1,72 @@
+from generationProfiles import GENERATION_PROFILES, Intent, ProfiledChatModel, ProfileSelector, classifyIntent
+from contextWindow import getNumCtx
+from fakeOllamaServer import FakeOllamaServer, FakeOllamaSettings
+from metrics import MetricsRegistry
+from scheduler import RequestScheduler, ScheduledChatModel
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_ollama import ChatOllama
+import asyncio
+import pytest
+
+
+@pytest.mark.parametrize(
+    "question,expectedIntent",
+    [
+        ("What is the capital of France?", Intent.SHORT),
+        ("Explain how a transformer model works", Intent.LONG_FORM),
+        ("Why is the sky blue?", Intent.LONG_FORM),
+        ("Write a python function that reverses a list", Intent.CODE),
+        ("my script fails with this traceback", Intent.CODE),
+        ("hi " * 50, Intent.LONG_FORM),
+    ]
+)
+def test_classifyIntent(question:str, expectedIntent:Intent)->None:
+    assert classifyIntent(question) == expectedIntent
+
+
+def test_contextGrowsWithThePromptAndStays()->None:
+    metrics = MetricsRegistry()
+    selector = ProfileSelector(contextSizes=(2048, 4096, 8192), metrics=metrics)
+
+    shortProfile = selector.select(300, "What is the capital of France?")
+    assert (shortProfile.name, shortProfile.numCtx, shortProfile.numPredict) == (Intent.SHORT, 2048, 256)
+
+    longProfile = selector.select(300, "Explain how a transformer model works")
+    assert (longProfile.numCtx, longProfile.numPredict) == (4096, GENERATION_PROFILES[Intent.LONG_FORM].numPredict)
+
+    # a one-line question after a long answer keeps the loaded context instead of reloading the model
+    assert selector.select(300, "And in one word?").numCtx == 4096
+    assert selector.select(6000, "And in one word?").numCtx == 8192
+
+    overflowingProfile = selector.select(8000, "Explain it again")
+    assert overflowingProfile.numCtx == 8192 and overflowingProfile.numPredict == 128
+    assert metrics.getCounter("generation_profile_requests_total", profile="short") == 3
+    assert metrics.getSummary("generation_profile_num_ctx").count == 5
+
+
+def test_profiledModelSendsProfileOptionsAndReusesModels()->None:
+    fakeOllama = FakeOllamaServer(FakeOllamaSettings(firstTokenDelay=0, tokensPerSecond=1000, responseTokens=3))
+
+    async def askQuestions()->ProfiledChatModel:
+        ollamaUrl = await fakeOllama.start(port=0)
+        model = ProfiledChatModel(innerModel=ChatOllama(model="fake-model", base_url=ollamaUrl, num_predict=1024),
+                                  selector=ProfileSelector(metrics=MetricsRegistry()))
+        try:
+            for question in ["What is 2+2?", "What is 3+3?", "Describe the history of Rome"]:
+                messages:list[BaseMessage] = [SystemMessage("system"), HumanMessage(question)]
+                async for _ in model.astream(messages):
+                    pass
+            scheduled = ScheduledChatModel(innerModel=model, scheduler=RequestScheduler(metrics=MetricsRegistry()),
+                                           userName="user")
+            async for _ in scheduled._modelFor(degraded=True).astream("What is 4+4?"): # pyright: ignore[reportPrivateUsage]
+                pass
+            assert getNumCtx(scheduled) == 8192
+            return model
+        finally:
+            await fakeOllama.stop()
+
+    model = asyncio.run(askQuestions())
+    assert [(options["num_ctx"], options["num_predict"]) for options in fakeOllama.requestOptions] == \
+        [(2048, 256), (2048, 256), (4096, 2048), (4096, 256)]
+    # one model per set of options, the degraded copy adds its capped one to the shared cache
+    assert len(model.profileModels) == 3
@@ -0,0 +1,73 @@
+from globals import (HISTORY_MIGRATIONS, createConversation, getOrCreateUserId, getPastMessages,
+                     openConversationHistoryDb, recordMessagesInDb)
+from constants import MessagesTableInfo, PartialResponsesTableInfo
+from DB import Database
+from langchain_core.messages import AIMessage, HumanMessage
+from pathlib import Path
+import pytest
+import sqlite3
+
+
+def queryPlan(database:Database, statement:str)->list[str]:
+    database.cursor.execute(f"EXPLAIN QUERY PLAN {statement}")
+    return [str(row[3]) for row in database.cursor.fetchall()]
+
+
+def test_databasesFromBeforeSchemaVersionsAreUpgraded(tmp_path:Path)->None:
+    path = str(tmp_path / "conversation history.db")
+    legacy = sqlite3.connect(path)
+    legacy.executescript("""
+        CREATE TABLE users (user_id INTEGER PRIMARY KEY, user_name TEXT);
+        CREATE TABLE conversations (conversation_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+            conversation_description TEXT, time TEXT, day INTEGER, month INTEGER, year INTEGER);
+        CREATE TABLE messages (message_id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL, sender TEXT,
+            content TEXT);
+        INSERT INTO users (user_name) VALUES ('ana'), ('bo'), ('ana');
+        INSERT INTO conversations (user_id) VALUES (1), (3), (2);
+        INSERT INTO messages (conversation_id, sender, content) VALUES (1, 'ana', 'first'), (1, 'model', 'one'),
+            (2, 'ana', 'second'), (2, 'model', 'two'), (3, 'bo', 'other'), (3, 'model', 'three');""")
+    legacy.close()
+
+    database = openConversationHistoryDb(path)
+    assert database.userVersion == len(HISTORY_MIGRATIONS)
+    assert database.isColumnExists(MessagesTableInfo.tableName, MessagesTableInfo.columnTruncated)
+    assert database.isTableExists(PartialResponsesTableInfo.tableName)
+    # the second "ana" is merged into the first, with its conversation
+    assert database.getAllData("users") == [(1, "ana"), (2, "bo")]
+    assert [message.text for message in getPastMessages(database, "ana")] == ["first", "one", "second", "two"]
+    with pytest.raises(sqlite3.IntegrityError):
+        database.insertData("users", {"user_name": "bo"})
+    database.connection.rollback()
+    database.disconnect(False)
+
+    # an upgraded database runs no migration again
+    database = Database(path)
+    assert database.migrate(HISTORY_MIGRATIONS) == 0
+    database.disconnect(False)
+
+
+def test_historyLookupsUseTheIndexes(tmp_path:Path)->None:
+    database = openConversationHistoryDb(str(tmp_path / "conversation history.db"))
+    statements:list[str] = []
+    database.connection.set_trace_callback(statements.append)
+    userId = getOrCreateUserId(database, "ana")
+    for conversation in range(3):
+        conversationId = createConversation(database, userId)
+        for turn in range(2):
+            recordMessagesInDb(database, conversationId, "ana", "model", HumanMessage(f"question {conversation}.{turn}"),
+                               AIMessage(f"answer {conversation}.{turn}"))
+    statements.clear()
+    pastMessages = getPastMessages(database, "ana", 6)
+    database.connection.set_trace_callback(None)
+
+    # the latest messages of the latest conversation, oldest first
+    assert [message.text for message in pastMessages] == ["question 1.1", "answer 1.1", "question 2.0",
+                                                          "answer 2.0", "question 2.1", "answer 2.1"]
+    plan = queryPlan(database, statements[0])
+    assert any("users USING COVERING INDEX users_user_name" in step for step in plan)
+    assert any("conversations USING COVERING INDEX conversations_user_id" in step for step in plan)
+    assert any("messages USING INDEX messages_conversation_id" in step for step in plan)
+    assert not any("TEMP B-TREE" in step or step.startswith("SCAN") for step in plan)
+    assert queryPlan(database, "SELECT user_id FROM users WHERE user_name = 'ana'") == [
+        "SEARCH users USING COVERING INDEX users_user_name (user_name=?)"]
+    database.disconnect(False)
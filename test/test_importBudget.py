@@ -0,0 +1,27 @@
+from importProfile import parseImportTimes, profileImport
+from constants import IMPORT_TIME_BUDGET_SECONDS
+from pathlib import Path
+
+PROJECT_DIRECTORY = str(Path(__file__).resolve().parent.parent)
+DEFERRED_MODULES = ("langchain_ollama", "langchain_google_genai", "langgraph", "langchain.agents")
+
+
+def test_parseImportTimes()->None:
+    profile = parseImportTimes("main", "import time: self [us] | cumulative | imported package\n"
+                                       "import time:       100 |        100 |     json.decoder\n"
+                                       "import time:       300 |        400 |   json\n"
+                                       "import time:       500 |       1000 | main\n")
+    assert profile.totalSeconds == 0.001
+    assert [timing.moduleName for timing in profile.slowest(2)] == ["main", "json"]
+    assert [timing.depth for timing in profile.timings] == [2, 1, 0]
+
+
+def test_mainImportsWithinBudget()->None:
+    profile = profileImport("main", workingDirectory=PROJECT_DIRECTORY)
+    assert profile.totalSeconds < IMPORT_TIME_BUDGET_SECONDS, profile.describe()
+    assert not profile.loadedModules.intersection(DEFERRED_MODULES), profile.describe()
+
+
+def test_chatDefersProviders()->None:
+    profile = profileImport("chat", workingDirectory=PROJECT_DIRECTORY)
+    assert not profile.loadedModules.intersection(("langchain_ollama", "langchain_google_genai", "langchain.agents"))
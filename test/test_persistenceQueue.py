@@ -0,0 +1,91 @@
+from persistenceQueue import PersistenceError, RowWrite, WriteBehindQueue
+from globals import createConversation, createConversationHistoryDb, getMessageRows, getOrCreateUserId, openConversationHistoryDb
+from constants import MessagesTableInfo
+from metrics import MetricsRegistry
+from langchain_core.messages import AIMessage, HumanMessage
+from pathlib import Path
+import pytest
+import time
+
+
+def readContents(dataBasePath:str)->list[str]:
+    database = openConversationHistoryDb(dataBasePath)
+    database.cursor.execute(f"SELECT {MessagesTableInfo.columnContent} FROM {MessagesTableInfo.tableName} "
+                            f"ORDER BY {MessagesTableInfo.columnMessageId}")
+    contents = [str(row[0]) for row in database.cursor.fetchall()]
+    database.disconnect(False)
+    return contents
+
+
+def test_rowsAreBatchedAndFlushedInOrder(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+    database = createConversationHistoryDb(dataBasePath)
+    conversationId = createConversation(database, getOrCreateUserId(database, "user"))
+    database.disconnect(True)
+    metrics = MetricsRegistry()
+    flushedRows:list[list[RowWrite]] = []
+    writer = WriteBehindQueue(lambda: openConversationHistoryDb(dataBasePath), flushInterval=60, flushSize=1000,
+                              onFlushed=flushedRows.append, metrics=metrics).start()
+
+    for turn in range(5):
+        writer.enqueue(getMessageRows(conversationId, "user", "model", HumanMessage(f"q{turn}"), AIMessage(f"a{turn}")))
+    assert readContents(dataBasePath) == []
+
+    writer.flush(timeout=5)
+    assert readContents(dataBasePath) == [text for turn in range(5) for text in (f"q{turn}", f"a{turn}")]
+    assert metrics.getSummary("persistence_flush_rows").total == 10
+    assert [len(rows) for rows in flushedRows] == [10]
+    writer.close(timeout=5)
+
+
+def test_intervalFlushAndFailedRowsSurface(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+    createConversationHistoryDb(dataBasePath).disconnect(True)
+    metrics = MetricsRegistry()
+    writer = WriteBehindQueue(lambda: openConversationHistoryDb(dataBasePath), flushInterval=0.05, metrics=metrics).start()
+
+    writer.enqueue([RowWrite(MessagesTableInfo.tableName, {MessagesTableInfo.columnConversationId: 1,
+                                                           MessagesTableInfo.columnContent: "hello"})])
+    deadline = time.monotonic() + 5
+    while readContents(dataBasePath) == [] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert readContents(dataBasePath) == ["hello"]
+
+    writer.enqueue([RowWrite(MessagesTableInfo.tableName, {"missing_column": 1})])
+    with pytest.raises(PersistenceError):
+        writer.flush(timeout=5)
+    assert metrics.getCounter("persistence_dead_letter_rows_total") == 1
+    # the rejected row is reported once, and doesn't come back with later flushes
+    writer.enqueue([RowWrite(MessagesTableInfo.tableName, {MessagesTableInfo.columnConversationId: 1,
+                                                           MessagesTableInfo.columnContent: "after"})])
+    writer.close(timeout=5)
+    assert readContents(dataBasePath) == ["hello", "after"]
+
+
+def test_rejectedRowsDoNotHoldBackTheOthers(tmp_path:Path)->None:
+    dataBasePath = str(tmp_path / "conversation history.db")
+    createConversationHistoryDb(dataBasePath).disconnect(True)
+    metrics = MetricsRegistry()
+    writer = WriteBehindQueue(lambda: openConversationHistoryDb(dataBasePath), flushInterval=60, metrics=metrics).start()
+
+    badRow = RowWrite(MessagesTableInfo.tableName, {MessagesTableInfo.columnConversationId: None,
+                                                    MessagesTableInfo.columnContent: "bad"})
+    rejected = writer.enqueue([badRow])
+    written = [writer.enqueue([RowWrite(MessagesTableInfo.tableName, {MessagesTableInfo.columnConversationId: 1,
+                                                                      MessagesTableInfo.columnContent: text})])
+               for text in ("one", "two", "three")]
+    assert not rejected.done()
+    with pytest.raises(PersistenceError, match="1 rows were rejected"):
+        writer.flush(timeout=5)
+    assert isinstance(rejected.exception(), PersistenceError)
+    assert [future.result() for future in written] == [None, None, None]
+    assert readContents(dataBasePath) == ["one", "two", "three"]
+    assert list(writer.deadLetters) == [badRow]
+
+    writer.enqueue([RowWrite(MessagesTableInfo.tableName, {MessagesTableInfo.columnConversationId: 1,
+                                                           MessagesTableInfo.columnContent: "four"})])
+    writer.flush(timeout=5)
+    writer.close(timeout=5)
+    assert readContents(dataBasePath) == ["one", "two", "three", "four"]
+    assert metrics.getCounter("persistence_dead_letter_rows_total") == 1
+    assert metrics.getCounter("persistence_failures_total") == 0
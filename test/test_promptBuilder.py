@@ -0,0 +1,50 @@
+from promptBuilder import PrefixStablePromptBuilder, PromptBuilder, PromptReuseTracker, estimateTokens
+from agentState import AgentState
+from metrics import MetricsRegistry
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, BaseMessage
+
+
+def renderedTexts(prompt:list[str|BaseMessage])->list[str]:
+    return [message if isinstance(message, str) else f"{message.type}:{message.content}" for message in prompt]
+
+
+def runTurns(promptBuilder:PromptBuilder, questions:list[str])->list[list[str|BaseMessage]]:
+    state = AgentState(shortConversationHistory=[])
+    prompts:list[list[str|BaseMessage]] = []
+    for question in questions:
+        humanMessage = HumanMessage(question)
+        prompts.append(promptBuilder.build(state, humanMessage))
+        state["shortConversationHistory"].extend([humanMessage, AIMessage(f"answer to {question}")])
+    return prompts
+
+
+def test_prefixStablePromptOnlyAppends()->None:
+    prompts = runTurns(PrefixStablePromptBuilder(SystemMessage("system")), ["first", "second", "third"])
+    for previousPrompt, currentPrompt in zip(prompts, prompts[1:]):
+        previousTexts = renderedTexts(previousPrompt)
+        assert renderedTexts(currentPrompt)[:len(previousTexts)] == previousTexts
+    assert prompts[-1][-1].content.endswith("] third") # pyright: ignore[reportAttributeAccessIssue]
+
+
+def test_legacyPromptChangesBeforeHistoryEnd()->None:
+    prompts = runTurns(PromptBuilder(SystemMessage("system")), ["first", "second"])
+    previousTexts = renderedTexts(prompts[0])
+    assert renderedTexts(prompts[1])[:len(previousTexts)] != previousTexts
+
+
+def test_promptReuseTrackerReportsReusedTokens()->None:
+    metrics = MetricsRegistry()
+    tracker = PromptReuseTracker(metrics)
+    prompts = runTurns(PrefixStablePromptBuilder(SystemMessage("system")), ["first", "second"])
+    estimatedTokens = [sum(estimateTokens(text) for text in renderedTexts(prompt)) for prompt in prompts]
+
+    firstReport = tracker.recordTurn(prompts[0], AIMessage("answer to first",
+                                                           response_metadata={"prompt_eval_count": estimatedTokens[0]}))
+    secondReport = tracker.recordTurn(prompts[1], AIMessage("answer to second",
+                                                            response_metadata={"prompt_eval_count": 3}))
+    thirdReport = tracker.recordTurn(prompts[1], AIMessage("no metadata"))
+
+    assert (firstReport.reusedTokens, firstReport.stablePrefixMessages) == (0, 0)
+    assert (secondReport.reusedTokens, secondReport.stablePrefixMessages) == (estimatedTokens[1] - 3, 3)
+    assert thirdReport.reusedTokens is None
+    assert metrics.getCounter("prompt_tokens_evaluated_total") == estimatedTokens[0] + 3
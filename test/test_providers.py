@@ -0,0 +1,17 @@
+from providers import ProviderNotFoundError, ProviderRegistry, ProviderSpec
+import pytest
+
+
+def test_modelsAreCreatedOnceWithDefaultArguments()->None:
+    registry = ProviderRegistry()
+    registry.register("namespace", ProviderSpec("types", "SimpleNamespace", lambda: {"apiKey": "from environment"}))
+
+    model = registry.getChatModel("namespace", "small", temperature=0)
+
+    assert vars(model) == {"model": "small", "apiKey": "from environment", "temperature": 0}
+    assert registry.getChatModel("namespace", "small", temperature=0) is model
+    assert registry.getChatModel("namespace", "small", temperature=1) is not model
+    assert registry.getChatModel("namespace", "small", apiKey="explicit").apiKey == "explicit"
+    assert registry.isImported("namespace")
+    with pytest.raises(ProviderNotFoundError):
+        registry.getChatModel("missing", "small")
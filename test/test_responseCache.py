@@ -0,0 +1,109 @@
+from responseCache import CACHED_METADATA_KEY, CachedResponse, CachingChatModel, ResponseCache, isStandaloneQuestion
+from generationProfiles import ProfileSelector, ProfiledChatModel
+from metrics import MetricsRegistry
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from pathlib import Path
+import asyncio
+
+
+def streamText(model:CachingChatModel, prompt:list[BaseMessage])->tuple[str, AIMessageChunk]:
+    async def collect()->tuple[str, AIMessageChunk]:
+        pieces:list[str] = []
+        aggregatedChunk:AIMessageChunk|None = None
+        async for chunk in model.astream(prompt):
+            pieces.append(str(chunk.content))
+            aggregatedChunk = chunk if aggregatedChunk is None else aggregatedChunk + chunk
+        await model.flushPendingStores()
+        assert aggregatedChunk is not None
+        return "".join(pieces), aggregatedChunk
+    return asyncio.run(collect())
+
+
+def test_repeatedQuestionIsReplayedFromCache(tmp_path:Path)->None:
+    metrics = MetricsRegistry()
+    innerModel = GenericFakeChatModel(messages=iter([AIMessage("Paris is the capital"), AIMessage("It is noon")]))
+    model = CachingChatModel(innerModel=innerModel, cache=ResponseCache(str(tmp_path / "cache.db"), metrics=metrics))
+    systemPrompt = SystemMessage("system")
+
+    firstText, firstMessage = streamText(model, [systemPrompt, HumanMessage("What is the capital of France?")])
+    # a later turn of another conversation, with a history of its own
+    secondText, secondMessage = streamText(model, [systemPrompt, HumanMessage("hello"), AIMessage("earlier"),
+                                                   HumanMessage("[18/10/2026 07:30] what is the  capital of france")])
+
+    assert firstText == secondText == "Paris is the capital"
+    assert CACHED_METADATA_KEY not in firstMessage.response_metadata
+    assert secondMessage.response_metadata[CACHED_METADATA_KEY] is True
+    assert metrics.getCounter("response_cache_misses_total") == 1
+    assert metrics.getCounter("response_cache_hits_total", match="exact") == 1
+
+    timeText, _ = streamText(model, [systemPrompt, HumanMessage("what time is it now")])
+    assert timeText == "It is noon"
+    assert metrics.getCounter("response_cache_bypassed_total", reason="time") == 1
+
+
+def test_entriesExpireAndLeastRecentlyUsedAreEvicted(tmp_path:Path)->None:
+    metrics = MetricsRegistry()
+    now = [0.0]
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttlSeconds=100, maxEntries=2, metrics=metrics,
+                          clock=lambda: now[0])
+    for question in ["first", "second"]:
+        now[0] += 1
+        cache.store("context", question, CachedResponse(f"{question} answer"))
+    now[0] += 1
+    assert cache.lookup("context", "first") == CachedResponse("first answer")
+    cache.store("context", "third", CachedResponse("third answer"))
+
+    assert cache.lookup("context", "second") is None
+    assert metrics.getCounter("response_cache_evictions_total", reason="lru") == 1
+    now[0] += 100
+    assert cache.lookup("context", "third") == CachedResponse("third answer")
+    now[0] += 10
+    assert cache.lookup("context", "first") is None
+    assert metrics.getCounter("response_cache_evictions_total", reason="ttl") == 2
+
+
+def test_followUpsAndPersonalQuestionsBypassTheCache(tmp_path:Path)->None:
+    metrics = MetricsRegistry()
+    innerModel = GenericFakeChatModel(messages=iter([AIMessage("Because of the river"),
+                                                     AIMessage("Because it is cheaper"), AIMessage("You are Ana")]))
+    model = CachingChatModel(innerModel=innerModel, cache=ResponseCache(str(tmp_path / "cache.db"), metrics=metrics))
+    systemPrompt = SystemMessage("system")
+
+    parisText, _ = streamText(model, [systemPrompt, HumanMessage("why was Paris built on the Seine"),
+                                      AIMessage("It was"), HumanMessage("why?")])
+    trainText, trainMessage = streamText(model, [systemPrompt, HumanMessage("should I take the train"),
+                                                 AIMessage("Yes"), HumanMessage("why?")])
+    nameText, _ = streamText(model, [systemPrompt, HumanMessage("what is my name")])
+
+    assert (parisText, trainText, nameText) == ("Because of the river", "Because it is cheaper", "You are Ana")
+    assert CACHED_METADATA_KEY not in trainMessage.response_metadata
+    assert metrics.getCounter("response_cache_bypassed_total", reason="followUp") == 3
+    assert isStandaloneQuestion("[18/10/2026 07:30] What is the capital of France?")
+    assert isStandaloneQuestion("why is the sky blue")
+    assert not isStandaloneQuestion("continue")
+    assert not isStandaloneQuestion("and what about Spain")
+
+
+def test_answersAreKeyedOnTheQuestionsGenerationProfile(tmp_path:Path)->None:
+    metrics = MetricsRegistry()
+    innerModel = GenericFakeChatModel(messages=iter([AIMessage("Paris"), AIMessage("A long history of Paris")]))
+    profiledModel = ProfiledChatModel(innerModel=innerModel, selector=ProfileSelector(metrics=metrics))
+    # every question is as similar as can be, only the profile tells them apart
+    cache = ResponseCache(str(tmp_path / "cache.db"), embeddings=DeterministicFakeEmbedding(size=8),
+                          similarityThreshold=-1.0, metrics=metrics)
+    model = CachingChatModel(innerModel=profiledModel, cache=cache)
+    systemPrompt = SystemMessage("system")
+
+    shortText, _ = streamText(model, [systemPrompt, HumanMessage("what is the capital of France")])
+    longText, longMessage = streamText(model, [systemPrompt, HumanMessage("describe the capital of France")])
+    # a short question after a long history is sized to another context but keeps its profile
+    history = [HumanMessage("tell me a story " * 200), AIMessage("Once upon a time " * 200)]
+    repeatedText, repeatedMessage = streamText(model, [systemPrompt, *history,
+                                                       HumanMessage("what is the capital of France")])
+
+    assert (shortText, longText) == ("Paris", "A long history of Paris")
+    assert CACHED_METADATA_KEY not in longMessage.response_metadata
+    assert repeatedText == "Paris" and repeatedMessage.response_metadata[CACHED_METADATA_KEY] is True
+    assert metrics.getCounter("response_cache_hits_total", match="exact") == 1
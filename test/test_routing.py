@@ -0,0 +1,100 @@
+from routing import ProviderStatistics, RoutingChatModel
+from metrics import MetricsRegistry
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from typing import Any, AsyncIterator
+import asyncio
+import pytest
+
+
+class TimedStreamingModel(BaseChatModel):
+    firstTokenDelay:float
+    tokenDelay:float = 0.001
+    tokens:list[str] = ["a", "b", "c"]
+    error:Exception|None = None
+    cancelledStreams:list[int] = []
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return "timed-fake"
+
+    def _generate(self, messages:list[BaseMessage], stop:list[str]|None=None, run_manager:Any=None,
+                  **kwargs:Any) -> ChatResult:
+        raise NotImplementedError
+
+    async def _astream(self, messages:list[BaseMessage], stop:list[str]|None=None, run_manager:Any=None,
+                       **kwargs:Any) -> AsyncIterator[ChatGenerationChunk]:
+        try:
+            await asyncio.sleep(self.firstTokenDelay)
+            if self.error is not None:
+                raise self.error
+            for tokenIndex, token in enumerate(self.tokens):
+                if tokenIndex > 0:
+                    await asyncio.sleep(self.tokenDelay)
+                yield ChatGenerationChunk(message=AIMessageChunk(f"{self._llm_type}:{token}" if tokenIndex == 0 else token))
+        except asyncio.CancelledError:
+            self.cancelledStreams.append(1)
+            raise
+
+
+def createRouter(primary:TimedStreamingModel, secondary:TimedStreamingModel, metrics:MetricsRegistry,
+                 hedgeDelay:float=0.05)->RoutingChatModel:
+    return RoutingChatModel(providers={"ollama": primary, "gemini": secondary}, hedgeDelay=hedgeDelay,
+                            statistics=ProviderStatistics(metrics=metrics))
+
+
+async def collect(model:RoutingChatModel)->str:
+    return "".join([str(chunk.content) async for chunk in model.astream("hello")])
+
+
+def test_hedgedRequestWinsAndCancelsSlowPrimary()->None:
+    metrics = MetricsRegistry()
+    slowModel = TimedStreamingModel(firstTokenDelay=1.0, cancelledStreams=[])
+    fastModel = TimedStreamingModel(firstTokenDelay=0.01, tokens=["x", "y"])
+    router = createRouter(slowModel, fastModel, metrics)
+
+    assert asyncio.run(collect(router)) == "timed-fake:xy"
+    assert slowModel.cancelledStreams == [1]
+    assert metrics.getCounter("routing_hedges_total") == 1
+    assert metrics.getCounter("routing_wins_total", provider="gemini") == 1
+    assert metrics.getCounter("routing_cancelled_total", provider="ollama") == 1
+    # the measured secondary is now preferred over the primary that never answered
+    assert router.rankedProviders() == ["gemini", "ollama"]
+
+
+def test_fastPrimaryNeedsNoHedge()->None:
+    metrics = MetricsRegistry()
+    router = createRouter(TimedStreamingModel(firstTokenDelay=0.01), TimedStreamingModel(firstTokenDelay=0.01), metrics)
+
+    asyncio.run(collect(router))
+
+    assert metrics.getCounter("routing_requests_total", provider="gemini") == 0
+    assert metrics.getSummary("routing_time_to_first_token_seconds", provider="ollama").count == 1
+    assert metrics.getSummary("routing_tokens_per_second", provider="ollama").count == 1
+
+
+def test_rankingFollowsRollingLatency()->None:
+    statistics = ProviderStatistics(metrics=MetricsRegistry())
+    assert statistics.rank(["ollama", "gemini"]) == ["ollama", "gemini"]
+    statistics.recordFirstToken("ollama", 0.5)
+    statistics.recordGeneration("ollama", 101, 10.0)
+    statistics.recordFirstToken("gemini", 1.0)
+    statistics.recordGeneration("gemini", 101, 1.0)
+    assert statistics.rank(["ollama", "gemini"]) == ["gemini", "ollama"]
+    assert statistics.rank(["ollama", "gemini"], responseTokens=1) == ["ollama", "gemini"]
+
+
+def test_failingPrimaryFallsBackAndLastErrorSurfaces()->None:
+    metrics = MetricsRegistry()
+    failingModel = TimedStreamingModel(firstTokenDelay=0, error=ConnectionError("ollama is down"))
+    router = createRouter(failingModel, TimedStreamingModel(firstTokenDelay=0.01), metrics, hedgeDelay=10)
+
+    assert asyncio.run(collect(router)) == "timed-fake:abc"
+    assert metrics.getCounter("routing_failures_total", provider="ollama") == 1
+
+    brokenRouter = createRouter(failingModel, failingModel, metrics)
+    with pytest.raises(ConnectionError):
+        asyncio.run(collect(brokenRouter))
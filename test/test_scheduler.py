@@ -0,0 +1,86 @@
+from scheduler import (RequestPriority, RequestScheduler, SchedulerLimits, ScheduledChatModel,
+                       SchedulerOverloadedError, AdmissionTimeoutError)
+from metrics import MetricsRegistry
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+import asyncio
+import pytest
+
+
+def test_grantOrderFollowsPriorityThenUserRotation()->None:
+    scheduler = RequestScheduler(SchedulerLimits(maxConcurrentPerModel=1), MetricsRegistry())
+    grantOrder:list[str] = []
+
+    async def request(name:str, userName:str, priority:RequestPriority)->None:
+        async with scheduler.aslot("model", userName, priority):
+            grantOrder.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run()->None:
+        blocker = asyncio.create_task(request("blocker", "anna", RequestPriority.BATCH))
+        await asyncio.sleep(0)
+        waiting = [("batch", "bob", RequestPriority.BATCH),
+                   ("anna-1", "anna", RequestPriority.INTERACTIVE),
+                   ("anna-2", "anna", RequestPriority.INTERACTIVE),
+                   ("carl-1", "carl", RequestPriority.INTERACTIVE),
+                   ("agent", "bob", RequestPriority.AGENT)]
+        tasks = []
+        for name, userName, priority in waiting:
+            tasks.append(asyncio.create_task(request(name, userName, priority)))
+            await asyncio.sleep(0)
+        await asyncio.gather(blocker, *tasks)
+
+    asyncio.run(run())
+    assert grantOrder == ["blocker", "anna-1", "carl-1", "anna-2", "agent", "batch"]
+
+
+def test_fullQueueShedsRequests()->None:
+    metrics = MetricsRegistry()
+    scheduler = RequestScheduler(SchedulerLimits(maxConcurrentPerModel=1,
+                                                 maxQueueDepth={priority: 1 for priority in RequestPriority}),
+                                 metrics)
+
+    async def run()->None:
+        async with scheduler.aslot("model", "anna", RequestPriority.INTERACTIVE):
+            queued = asyncio.create_task(scheduler.aslot("model", "bob", RequestPriority.BATCH).__aenter__())
+            await asyncio.sleep(0)
+            with pytest.raises(SchedulerOverloadedError):
+                async with scheduler.aslot("model", "carl", RequestPriority.BATCH):
+                    pass
+            assert scheduler.queueDepth("model", RequestPriority.BATCH) == 1
+            queued.cancel()
+        assert scheduler.queueDepth("model") == 0
+
+    asyncio.run(run())
+    assert metrics.getCounter("scheduler_rejected_total", model="model", priority="batch") == 1
+
+
+def test_waitLongerThanLimitTimesOut()->None:
+    scheduler = RequestScheduler(SchedulerLimits(maxConcurrentPerModel=1,
+                                                 maxWaitSeconds={priority: 0.05 for priority in RequestPriority}),
+                                 MetricsRegistry())
+    with scheduler.slot("model", "anna", RequestPriority.INTERACTIVE):
+        with pytest.raises(AdmissionTimeoutError):
+            with scheduler.slot("model", "bob", RequestPriority.AGENT):
+                pass
+    assert scheduler.queueDepth("model") == 0
+    assert scheduler.activeRequests("model") == 0
+
+
+def test_scheduledModelStreamsInsideSlot()->None:
+    metrics = MetricsRegistry()
+    scheduler = RequestScheduler(metrics=metrics)
+    innerModel = GenericFakeChatModel(messages=iter([AIMessage("one two"), AIMessage("three")]))
+    model = ScheduledChatModel(innerModel=innerModel, scheduler=scheduler, userName="anna")
+
+    async def run()->str:
+        pieces:list[str] = []
+        async for chunk in model.astream("hello"):
+            assert scheduler.activeRequests(model.modelName) == 1
+            pieces.append(str(chunk.content))
+        return "".join(pieces)
+
+    assert asyncio.run(run()) == "one two"
+    assert model.invoke("hello").content == "three"
+    assert scheduler.activeRequests(model.modelName) == 0
+    assert metrics.getSummary("scheduler_wait_seconds", model=model.modelName, priority="interactive").count == 2
@@ -0,0 +1,156 @@
+from semanticMemory import MEMORY_HEADER, MemoryIndexer, MemoryRecall, SemanticMemoryIndex
+from globals import (createConversation, createConversationHistoryDb, getOrCreateUserId, openConversationHistoryPool,
+                     recordMessagesInDb)
+from metrics import MetricsRegistry
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, HumanMessage
+from pathlib import Path
+from typing import Callable
+import threading
+import time
+
+VOCABULARY = ["tea", "coffee", "cat", "dog", "python", "rust"]
+
+
+class KeywordEmbeddings(Embeddings):
+    def embed_documents(self, texts:list[str])->list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text:str)->list[float]:
+        return [float(text.lower().count(word)) + 0.01 for word in VOCABULARY]
+
+
+class GatedEmbeddings(KeywordEmbeddings):
+    """Holds every embedding request until the gate opens, then fails while failing is set."""
+    def __init__(self)->None:
+        self.requestSizes:list[int] = []
+        self.gate = threading.Event()
+        self.failing = True
+
+    def embed_documents(self, texts:list[str])->list[list[float]]:
+        self.requestSizes.append(len(texts))
+        self.gate.wait(5)
+        if self.failing:
+            raise ConnectionError("the embedding model is not pulled")
+        return super().embed_documents(texts)
+
+
+def waitFor(condition:Callable[[], bool])->None:
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+class FixedEstimator:
+    def estimate(self, text:str)->int:
+        return len(text)
+
+
+def test_indexFindsRelevantExchangesAndReloads(tmp_path:Path)->None:
+    database = createConversationHistoryDb(str(tmp_path / "conversation history.db"))
+    userId = getOrCreateUserId(database, "user")
+    oldConversationId = createConversation(database, userId)
+    exchanges = [("do you like tea", "tea is great"), ("my dog is called rex", "nice dog"),
+                 ("python or rust", "python for scripts")]
+    for humanText, aiText in exchanges[:2]:
+        recordMessagesInDb(database, oldConversationId, "user", "model", HumanMessage(humanText), AIMessage(aiText))
+    index = SemanticMemoryIndex(KeywordEmbeddings(), "keywords", MetricsRegistry())
+    assert index.backfill(database) == 2
+
+    currentConversationId = createConversation(database, userId)
+    humanMessageId, aiMessageId = recordMessagesInDb(database, currentConversationId, "user", "model",
+                                                     HumanMessage(exchanges[2][0]), AIMessage(exchanges[2][1]))
+    assert humanMessageId is not None and aiMessageId is not None
+    index.addExchanges(database, [(humanMessageId, aiMessageId, currentConversationId, *exchanges[2])])
+    assert index.backfill(database) == 0
+
+    hits = index.search("what was my dog's name", k=2)
+    assert [(hit.humanText, hit.aiText) for hit in hits] == [exchanges[1]]
+    assert index.search("rust", excludeConversationId=currentConversationId) == []
+
+    reloadedIndex = SemanticMemoryIndex(KeywordEmbeddings(), "keywords", MetricsRegistry())
+    reloadedIndex.load(database)
+    assert len(reloadedIndex) == 3
+    assert reloadedIndex.search("tea", k=1)[0].conversationId == oldConversationId
+    database.disconnect(True)
+
+
+def test_recallStaysWithinTokenBudget(tmp_path:Path)->None:
+    database = createConversationHistoryDb(str(tmp_path / "conversation history.db"))
+    userId = getOrCreateUserId(database, "user")
+    conversationId = createConversation(database, userId)
+    for humanText, aiText in [("tea please", "tea " * 40), ("tea or coffee", "tea")]:
+        recordMessagesInDb(database, conversationId, "user", "model", HumanMessage(humanText), AIMessage(aiText))
+    index = SemanticMemoryIndex(KeywordEmbeddings(), "keywords", MetricsRegistry())
+    index.backfill(database)
+    recall = MemoryRecall(lambda: index, FixedEstimator(), lambda: None, lambda: userId, k=2, tokenBudget=100)
+
+    recalledMessages = recall.recall(HumanMessage("tea"))
+
+    assert len(recalledMessages) == 1
+    assert recalledMessages[0].text == f"{MEMORY_HEADER}\n\nUser: tea or coffee\nAssistant: tea"
+    assert MemoryRecall(lambda: index, FixedEstimator(), lambda: conversationId,
+                        lambda: userId).recall(HumanMessage("tea")) == []
+    database.disconnect(True)
+
+
+def test_recallOnlyFindsTheUsersOwnExchanges(tmp_path:Path)->None:
+    database = createConversationHistoryDb(str(tmp_path / "conversation history.db"))
+    anaId, boId = getOrCreateUserId(database, "ana"), getOrCreateUserId(database, "bo")
+    recordMessagesInDb(database, createConversation(database, anaId), "ana", "model",
+                       HumanMessage("my cat needs a vet"), AIMessage("cat vets are on main street"))
+    index = SemanticMemoryIndex(KeywordEmbeddings(), "keywords", MetricsRegistry())
+    index.backfill(database)
+    boConversationId = createConversation(database, boId)
+
+    def recall(userId:int, reloaded:bool=False)->list[str]:
+        recallIndex = index
+        if reloaded:
+            recallIndex = SemanticMemoryIndex(KeywordEmbeddings(), "keywords", MetricsRegistry())
+            recallIndex.load(database)
+        memoryRecall = MemoryRecall(lambda: recallIndex, FixedEstimator(), lambda: boConversationId, lambda: userId,
+                                    tokenBudget=1000)
+        return [message.text for message in memoryRecall.recall(HumanMessage("where do I take my cat"))]
+
+    assert recall(boId) == [] and recall(boId, reloaded=True) == []
+    assert len(recall(anaId)) == 1 and recall(anaId, reloaded=True) == recall(anaId)
+    database.disconnect(True)
+
+
+def test_indexerEmbedsOffTheWriterAndBacksOff(tmp_path:Path)->None:
+    pool = openConversationHistoryPool(str(tmp_path / "conversation history.db"))
+    embeddings = GatedEmbeddings()
+    metrics = MetricsRegistry()
+    index = SemanticMemoryIndex(embeddings, "keywords", metrics)
+    with pool.writer() as database:
+        index.load(database)
+        userId = getOrCreateUserId(database, "user")
+        conversationId = createConversation(database, userId)
+        recordMessagesInDb(database, conversationId, "user", "model", HumanMessage("a cat"), AIMessage("cats purr"))
+    indexer = MemoryIndexer(lambda: index, pool.reader, pool.writer, retryDelay=0.5, maxRetryDelay=1,
+                            metrics=metrics).start()
+
+    indexer.notify()
+    waitFor(lambda: embeddings.requestSizes == [1])
+    # the embedding request in flight holds no database handle
+    startTime = time.perf_counter()
+    with pool.writer() as database:
+        recordMessagesInDb(database, conversationId, "user", "model", HumanMessage("a dog"), AIMessage("dogs bark"))
+    assert time.perf_counter() - startTime < 1
+
+    embeddings.gate.set()
+    waitFor(lambda: metrics.getCounter("memory_index_failures_total") == 1)
+    for _ in range(5):
+        indexer.notify()
+    time.sleep(0.1)
+    # a failed pass waits for its retry delay instead of running again on every flush
+    assert embeddings.requestSizes == [1]
+
+    embeddings.failing = False
+    waitFor(lambda: len(index) == 2)
+    indexer.notify()
+    indexer.close(timeout=5)
+    assert embeddings.requestSizes == [1, 2]
+    assert [hit.humanText for hit in index.search("cat", userId=userId)] == ["a cat"]
+    pool.close()
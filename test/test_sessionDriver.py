@@ -0,0 +1,84 @@
+from sessionDriver import SessionDriver
+from checkpoints import PruningSqliteSaver, getThreadId
+from chatEngine import ChatEngine, EXIT_COMMAND
+from chatGraph import buildChatGraph, chatEngineConfig
+from agentState import AgentState
+from metrics import MetricsRegistry
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from pathlib import Path
+from typing import Callable
+import asyncio
+import gc
+import itertools
+import pytest
+
+SOAK_TURNS = 10_000
+WARM_UP_TURNS = 1_000
+HISTORY_MESSAGES_KEPT = 20
+
+
+def keepRecentHistory(state:AgentState, humanMessage:HumanMessage, aiMessage:AIMessage)->AgentState:
+    # stands in for the context window manager, which evicts the oldest turns
+    history = state["shortConversationHistory"]
+    history.extend((humanMessage, aiMessage))
+    del history[:-HISTORY_MESSAGES_KEPT]
+    return state
+
+
+def createEngine(turns:int, onTurn:Callable[[int], None]=lambda turn: None)->ChatEngine:
+    turnCounter = itertools.count()
+    model = GenericFakeChatModel(messages=itertools.repeat("fine, thanks"))
+
+    async def readInput()->str:
+        turn = next(turnCounter)
+        onTurn(turn)
+        return EXIT_COMMAND if turn == turns else f"question {turn}"
+
+    return ChatEngine(getModel=lambda: model,
+                      buildPromptPrefix=lambda state: ["system", *state["shortConversationHistory"]],
+                      buildPromptSuffix=lambda humanMessage: [humanMessage],
+                      updateHistory=keepRecentHistory,
+                      recordTurn=lambda humanMessage, aiMessage: None,
+                      readInput=readInput, writeOutput=lambda piece: None,
+                      onResponseComplete=lambda response: None)
+
+
+def test_sessionRunsPastTheRecursionLimit(tmp_path:Path)->None:
+    turns = 60
+    metrics = MetricsRegistry()
+
+    async def chat()->tuple[AgentState, AgentState|None]:
+        saver = await PruningSqliteSaver.open(str(tmp_path / "checkpoints.db"))
+        try:
+            driver = SessionDriver(buildChatGraph(saver),
+                                   chatEngineConfig(createEngine(turns), getThreadId("erin", 1)), metrics)
+            finalState = await driver.run(AgentState(shortConversationHistory=[]))
+            assert driver.turns == turns + 1
+            return finalState, await saver.restoreState(getThreadId("erin", 1))
+        finally:
+            await saver.close()
+
+    finalState, restoredState = asyncio.run(chat())
+    assert [message.content for message in finalState["shortConversationHistory"][-2:]] == [f"question {turns - 1}",
+                                                                                           "fine, thanks"]
+    assert restoredState == finalState
+    assert metrics.getSummary("session_turn_seconds").count == turns + 1
+
+
+def test_soakSessionKeepsMemoryFlat()->None:
+    resource = pytest.importorskip("resource")
+    peakKiB:dict[int, int] = {}
+
+    def sampleMemory(turn:int)->None:
+        if turn in (WARM_UP_TURNS, SOAK_TURNS):
+            gc.collect()
+            peakKiB[turn] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    driver = SessionDriver(buildChatGraph(), chatEngineConfig(createEngine(SOAK_TURNS, sampleMemory)), MetricsRegistry())
+    finalState = asyncio.run(driver.run(AgentState(shortConversationHistory=[])))
+
+    assert driver.turns == SOAK_TURNS + 1
+    assert len(finalState["shortConversationHistory"]) == HISTORY_MESSAGES_KEPT
+    # the peak resident size after the warm-up turns does not grow with the session
+    assert peakKiB[SOAK_TURNS] - peakKiB[WARM_UP_TURNS] < 8 * 1024
@@ -0,0 +1,76 @@
+from startup import StartupOrchestrator, preloadModel, preloadOllamaModel
+from fakeOllamaServer import FakeOllamaServer, FakeOllamaSettings
+from metrics import MetricsRegistry
+from langchain_ollama import ChatOllama
+import asyncio
+import pytest
+import time
+
+
+def test_stepsRunConcurrentlyAfterTheirDependencies()->None:
+    finishedSteps:list[str] = []
+
+    async def step(name:str, delay:float)->str:
+        await asyncio.sleep(delay)
+        finishedSteps.append(name)
+        return name
+
+    async def failingStep()->None:
+        raise ConnectionError("model not pulled")
+
+    orchestrator = StartupOrchestrator(MetricsRegistry())
+    orchestrator.addStep("model", lambda: step("model", 0.2))
+    orchestrator.addStep("database", lambda: step("database", 0.1))
+    orchestrator.addStep("history", lambda: step("history", 0.05), after=("database",))
+    orchestrator.addStep("optional", failingStep, required=False)
+
+    report, results = asyncio.run(orchestrator.run())
+
+    assert finishedSteps == ["database", "history", "model"]
+    assert results == {"model": "model", "database": "database", "history": "history"}
+    assert report.wallSeconds < 0.3
+    assert "optional" in report.describe() and "failed" in report.describe()
+
+    orchestrator.addStep("required", failingStep)
+    with pytest.raises(ConnectionError):
+        asyncio.run(orchestrator.run())
+
+
+def test_preloadAbsorbsModelLoadDelay()->None:
+    async def measureFirstToken()->float:
+        fakeOllama = FakeOllamaServer(FakeOllamaSettings(firstTokenDelay=0.01, responseTokens=3, modelLoadDelay=0.5))
+        model = ChatOllama(model="fake-model", base_url=await fakeOllama.start(port=0))
+        try:
+            assert await preloadModel(model)
+            startTime = time.perf_counter()
+            async for _ in model.astream("hello"):
+                return time.perf_counter() - startTime
+            raise AssertionError("no tokens streamed")
+        finally:
+            await fakeOllama.stop()
+
+    assert asyncio.run(measureFirstToken()) < 0.4
+
+
+def test_hungWarmUpFailsItsStepAndStartupCarriesOn()->None:
+    async def run()->tuple[str, float]:
+        async def neverAnswer(reader:asyncio.StreamReader, writer:asyncio.StreamWriter)->None:
+            await reader.read(65536)
+            await asyncio.sleep(60)
+
+        server = await asyncio.start_server(neverAnswer, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            orchestrator = StartupOrchestrator(MetricsRegistry())
+            orchestrator.addStep("model warm-up", lambda: preloadOllamaModel("fake-model", f"127.0.0.1:{port}",
+                                                                            timeout=0.2), required=False)
+            orchestrator.addStep("database", lambda: asyncio.sleep(0))
+            startTime = time.perf_counter()
+            report, _ = await orchestrator.run()
+            return report.describe(), time.perf_counter() - startTime
+        finally:
+            server.close()
+
+    description, seconds = asyncio.run(run())
+    assert "model warm-up" in description and "failed" in description
+    assert seconds < 5
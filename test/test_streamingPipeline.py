@@ -0,0 +1,107 @@
+from streamingPipeline import CallbackSink, StreamSink, StreamingPipeline, TerminalSink
+from chatEngine import STOP_REASON_METADATA_KEY, TRUNCATED_METADATA_KEY
+from metrics import MetricsRegistry
+from langchain_core.messages import AIMessage
+import asyncio
+import io
+import pytest
+
+
+class CountingOutput(io.StringIO):
+    def __init__(self)->None:
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text:str)->int:
+        self.writes += 1
+        return super().write(text)
+
+
+class FailingSink(StreamSink):
+    name = "failing"
+
+    async def write(self, piece:str)->None:
+        raise ConnectionResetError("client went away")
+
+
+def test_slowSinkDoesNotHoldBackTheOthers()->None:
+    metrics = MetricsRegistry()
+    fastPieces:list[str] = []
+    slowPieces:list[str] = []
+    responses:list[AIMessage] = []
+
+    async def slowWrite(piece:str)->None:
+        await asyncio.sleep(0.01)
+        slowPieces.append(piece)
+
+    async def stream()->None:
+        pipeline = StreamingPipeline([CallbackSink("fast", fastPieces.append),
+                                      CallbackSink("slow", slowWrite, responses.append)],
+                                     maxPending=4, metrics=metrics)
+        for token in range(1000):
+            pipeline.write(f"{token} ")
+            # the model reader yields between chunks, the fast sink keeps up
+            await asyncio.sleep(0)
+        pipeline.endResponse(AIMessage("done"))
+        assert len(fastPieces) > 990
+        await pipeline.close()
+
+    asyncio.run(stream())
+    text = "".join(f"{token} " for token in range(1000))
+    assert "".join(fastPieces) == text
+    # the slow sink gets the same text in few, larger pieces, and the end of the response after all of it
+    assert "".join(slowPieces) == text
+    assert len(slowPieces) < 100
+    assert [response.content for response in responses] == ["done"]
+    assert metrics.getCounter("stream_pieces_coalesced_total", sink="slow") > 0
+    assert metrics.getCounter("stream_pieces_coalesced_total", sink="fast") == 0
+
+
+def test_terminalOutputIsCoalesced()->None:
+    output = CountingOutput()
+
+    async def stream()->None:
+        pipeline = StreamingPipeline([TerminalSink(output, flushInterval=0.05, flushBytes=64)])
+        for _ in range(200):
+            pipeline.write("x")
+            await asyncio.sleep(0)
+        pipeline.endResponse(AIMessage("x" * 200))
+        pipeline.write("late")
+        pipeline.endResponse(AIMessage("late", response_metadata={TRUNCATED_METADATA_KEY: True,
+                                                                  STOP_REASON_METADATA_KEY: "cancelled"}))
+        await pipeline.drain()
+
+    asyncio.run(stream())
+    assert output.getvalue() == "x" * 200 + "\nlate [stopped: cancelled]\n"
+    assert output.writes <= 6
+
+
+def test_terminalFlushesAfterTheInterval()->None:
+    output = CountingOutput()
+
+    async def stream()->str:
+        pipeline = StreamingPipeline([TerminalSink(output, flushInterval=0.02, flushBytes=1024)])
+        pipeline.write("partial")
+        await asyncio.sleep(0.1)
+        shown = output.getvalue()
+        await pipeline.close()
+        return shown
+
+    assert asyncio.run(stream()) == "partial"
+
+
+def test_failedSinkIsReportedAndDropped()->None:
+    metrics = MetricsRegistry()
+    pieces:list[str] = []
+
+    async def stream()->None:
+        pipeline = StreamingPipeline([FailingSink(), CallbackSink("working", pieces.append)], metrics=metrics)
+        pipeline.write("hello ")
+        with pytest.raises(ConnectionResetError):
+            await pipeline.drain()
+        pipeline.write("world")
+        await pipeline.close()
+
+    asyncio.run(stream())
+    assert "".join(pieces) == "hello world"
+    assert metrics.getCounter("stream_sink_errors_total", sink="failing") == 1
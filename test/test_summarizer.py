@@ -0,0 +1,88 @@
+import asyncio
+from typing import Any
+from langchain_core.language_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from summarizer import SUMMARY_HEADER, RollingSummarizer
+from promptBuilder import PrefixStablePromptBuilder
+from agentState import AgentState
+from metrics import MetricsRegistry
+
+
+class FailingChatModel(GenericFakeChatModel):
+    async def _agenerate(self, *args:Any, **kwargs:Any) -> Any:
+        raise ConnectionError("summary model unavailable")
+
+
+def test_evictedTurnsFoldIntoPersistedSummary()->None:
+    persistedSummaries:list[str] = []
+    model = GenericFakeChatModel(messages=iter([AIMessage("user likes tea"), AIMessage("user likes tea and cats")]))
+    summarizer = RollingSummarizer(lambda: model, persistedSummaries.append, metrics=MetricsRegistry())
+
+    async def run()->None:
+        summarizer.scheduleFold([HumanMessage("I like tea"), AIMessage("noted")])
+        await summarizer.flush()
+        summarizer.scheduleFold([HumanMessage("I like cats"), AIMessage("noted")])
+        await summarizer.flush()
+
+    asyncio.run(run())
+
+    assert persistedSummaries == ["user likes tea", "user likes tea and cats"]
+    assert summarizer.summaryMessage == SystemMessage(f"{SUMMARY_HEADER}\nuser likes tea and cats")
+    foldPrompt = summarizer.buildFoldPrompt([HumanMessage("hello")])
+    assert "user likes tea and cats" in foldPrompt[-1].text and "User: hello" in foldPrompt[-1].text
+
+
+def test_failedFoldKeepsMessagesForNextFold()->None:
+    metrics = MetricsRegistry()
+    summarizer = RollingSummarizer(lambda: FailingChatModel(messages=iter([])), metrics=metrics)
+    evictedMessages:list[HumanMessage|AIMessage] = [HumanMessage("I like tea"), AIMessage("noted")]
+
+    async def run()->None:
+        summarizer.scheduleFold(evictedMessages)
+        await summarizer.flush()
+
+    asyncio.run(run())
+
+    assert summarizer.summaryMessage is None
+    assert metrics.getCounter("summary_failures_total") == 2
+    recoveredModel = GenericFakeChatModel(messages=iter([AIMessage("user likes tea")]))
+    summarizer.getModel = lambda: recoveredModel
+    asyncio.run(summarizer.flush())
+    assert summarizer.summary == "user likes tea"
+
+
+def test_failingFoldsKeepABoundedBacklogThenStop()->None:
+    metrics = MetricsRegistry()
+    foldAttempts:list[None] = []
+
+    def getModel()->FailingChatModel:
+        foldAttempts.append(None)
+        return FailingChatModel(messages=iter([]))
+
+    summarizer = RollingSummarizer(getModel, maxPendingMessages=4, maxConsecutiveFailures=3, metrics=metrics)
+
+    async def run()->None:
+        for turn in range(5):
+            summarizer.scheduleFold([HumanMessage(f"question {turn}"), AIMessage(f"answer {turn}")])
+            if turn == 1:
+                await asyncio.gather(*summarizer._foldTasks) # pyright: ignore[reportPrivateUsage]
+                assert [message.text for message in summarizer._pendingMessages] == [ # pyright: ignore[reportPrivateUsage]
+                    "question 0", "answer 0", "question 1", "answer 1"]
+        await summarizer.flush()
+
+    asyncio.run(run())
+
+    assert summarizer.isDisabled
+    assert len(foldAttempts) == 3
+    assert summarizer._pendingMessages == [] # pyright: ignore[reportPrivateUsage]
+    assert metrics.getCounter("summary_dropped_messages_total") == 10
+    assert metrics.getCounter("summary_disabled_total") == 1
+
+
+def test_summaryFollowsSystemPrompt()->None:
+    systemPrompt = SystemMessage("system")
+    summaryMessage = SystemMessage("summary")
+    builder = PrefixStablePromptBuilder(systemPrompt, lambda: summaryMessage)
+    history:list[HumanMessage|AIMessage] = [HumanMessage("hi"), AIMessage("hello")]
+    assert builder.buildPrefix(AgentState(shortConversationHistory=history)) == [systemPrompt, summaryMessage, *history]
+    assert PrefixStablePromptBuilder(systemPrompt).buildPrefix(AgentState(shortConversationHistory=[])) == [systemPrompt]
@@ -0,0 +1,127 @@
+from tracing import JsonlSpanExporter, Tracer, TracingCallbackHandler, responseAttributes, startMetricsServer
+from chatEngine import ChatEngine, EXIT_COMMAND
+from chatGraph import buildChatGraph, chatEngineConfig
+from sessionDriver import SessionDriver
+from agentState import AgentState, updateShortConversationHistory
+from metrics import MetricsRegistry
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+from pathlib import Path
+from typing import Any
+import asyncio
+import httpx
+import json
+import pytest
+
+
+def readSpans(path:Path)->list[dict[str, Any]]:
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_spansNestAndRotateIntoJsonl(tmp_path:Path)->None:
+    tracePath = tmp_path / "traces.jsonl"
+    exporter = JsonlSpanExporter(str(tracePath), maxBytes=2000, backupCount=5)
+    metrics = MetricsRegistry()
+    tracer = Tracer(metrics, exporter)
+
+    with tracer.span("turn", turn=1) as turnSpan:
+        with tracer.span("llm.stream"):
+            pass
+    with pytest.raises(ValueError):
+        with tracer.span("db.record"):
+            raise ValueError("disk full")
+    for _ in range(20):
+        with tracer.span("filler"):
+            pass
+    exporter.close()
+
+    rotatedPaths = sorted(tmp_path.glob("traces.jsonl.*"), reverse=True)
+    assert rotatedPaths
+    spans = [span for path in [*rotatedPaths, tracePath] for span in readSpans(path)]
+    assert len(spans) == 23
+    assert [span["name"] for span in spans[:3]] == ["llm.stream", "turn", "db.record"]
+    assert spans[0]["parentSpanId"] == turnSpan.spanId and spans[0]["traceId"] == turnSpan.traceId
+    assert spans[1]["attributes"] == {"turn": 1}
+    assert spans[2]["error"] == "ValueError('disk full')"
+    assert metrics.getSummary("span_seconds", span="turn").count == 1
+    assert metrics.getCounter("span_errors_total", span="db.record") == 1
+
+
+def test_graphTurnIsTraced()->None:
+    metrics = MetricsRegistry()
+    tracer = Tracer(metrics)
+    inputs = iter(["hi", EXIT_COMMAND])
+    model = GenericFakeChatModel(messages=iter([AIMessage("hello there")]))
+
+    async def readInput()->str:
+        return next(inputs)
+
+    engine = ChatEngine(getModel=lambda: model,
+                        buildPromptPrefix=lambda state: ["system", *state["shortConversationHistory"]],
+                        buildPromptSuffix=lambda humanMessage: [humanMessage],
+                        updateHistory=updateShortConversationHistory,
+                        recordTurn=lambda humanMessage, aiMessage: None,
+                        readInput=readInput, writeOutput=lambda piece: None,
+                        onResponseComplete=lambda response: None, tracer=tracer)
+    config = chatEngineConfig(engine, callbacks=[TracingCallbackHandler(tracer)])
+    asyncio.run(SessionDriver(buildChatGraph(), config).run(AgentState(shortConversationHistory=[])))
+
+    for spanName in ("turn", "prompt.prefix", "prompt.suffix", "llm.first_chunk", "llm.stream", "history.update",
+                     "db.record"):
+        assert metrics.getSummary("span_seconds", span=spanName).count == 1, spanName
+    assert metrics.getSummary("span_seconds", span="graph.node.chatToLlm").count == 2
+
+
+def test_toolCallsAndResponseMetadata()->None:
+    metrics = MetricsRegistry()
+
+    @tool
+    def lookUpWeather(city:str)->str:
+        """Returns the weather of a city."""
+        return "sunny"
+
+    lookUpWeather.invoke({"city": "Oslo"}, {"callbacks": [TracingCallbackHandler(Tracer(metrics))]})
+    assert metrics.getSummary("span_seconds", span="tool.lookUpWeather").count == 1
+
+    response = AIMessage("hi", response_metadata={"prompt_eval_count": 12, "eval_count": 3, "model": "gemma"},
+                         usage_metadata={"input_tokens": 12, "output_tokens": 3, "total_tokens": 15})
+    assert responseAttributes(response) == {"prompt_eval_count": 12, "eval_count": 3,
+                                            "input_tokens": 12, "output_tokens": 3}
+
+
+def test_prometheusEndpoint()->None:
+    metrics = MetricsRegistry()
+    metrics.incrementCounter("routing_requests_total", provider="ollama")
+    metrics.observe("span_seconds", 0.25, span="turn")
+
+    async def scrape()->httpx.Response:
+        server = await startMetricsServer("127.0.0.1", 0, metrics)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            async with httpx.AsyncClient() as client:
+                return await client.get(f"http://127.0.0.1:{port}/metrics")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = asyncio.run(scrape())
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'routing_requests_total{provider="ollama"} 1' in response.text
+    assert 'span_seconds_count{span="turn"} 1' in response.text
+
+
+def test_prometheusValuesKeepFullPrecision()->None:
+    metrics = MetricsRegistry()
+    metrics.incrementCounter("tokens_total", 1234567)
+    metrics.incrementCounter("tokens_total", 1)
+    metrics.setGauge("queue_depth", 3)
+    metrics.observe("flush_seconds", 1234567.125)
+    metrics.observe("flush_seconds", 0.1)
+
+    lines = metrics.renderPrometheus().splitlines()
+    assert "tokens_total 1234568" in lines
+    assert "queue_depth 3" in lines
+    assert "flush_seconds_sum 1234567.225" in lines
+    assert 'flush_seconds{quantile="0.99"} 1234567.125' in lines
@@ -81,7 +81,6 @@ def writeFile(filePath:str,content:str)->str:
         validatedFilePath = validateAndNormalizeAiPath(str(filePathObject))
     except PermissionError:
         return f"Error:Permission denined"
-<<<<<<< HEAD
     try:
         with open(validatedFilePath,"w",encoding="utf-8") as file:
             file.write(content)
@@ -90,9 +89,4 @@ def writeFile(filePath:str,content:str)->str:
                 return f"Error:Folder not found {validatedFilePath.parent}"
             return f"Error: File not found exception thrown {e}"
         
-=======
-
-    with open(validatedFilePath,"w",encoding="utf-8") as file:
-        file.write(content)
->>>>>>> 3c1dd19130ae14a18177d80d49e9977de9383a1b
     return "Successfully written to file"
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import queue
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Iterator
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage
+from constants import TRACE_FILE_BACKUP_COUNT, TRACE_FILE_MAX_BYTES
+from httpUtils import HttpError, HttpRequest, startHttpServer, writeResponse
+from metrics import MetricsRegistry, metricsRegistry
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# generation statistics Ollama sends with the last chunk of a response
+OLLAMA_METADATA_KEYS = ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration",
+                        "load_duration", "total_duration", "done_reason")
+
+
+@dataclass
+class Span:
+    name:str
+    traceId:str
+    spanId:str
+    parentSpanId:str|None
+    startedAt:float
+    seconds:float = 0.0
+    attributes:dict[str, Any] = field(default_factory=dict[str, Any])
+    error:str|None = None
+    _startTime:float = field(default_factory=time.perf_counter, repr=False)
+
+
+_currentSpan:ContextVar[Span|None] = ContextVar("currentSpan", default=None)
+
+
+def responseAttributes(response:AIMessage) -> dict[str, Any]:
+    """Token counts and Ollama's prompt evaluation statistics of a finished response."""
+    attributes = {key: response.response_metadata[key] for key in OLLAMA_METADATA_KEYS
+                  if response.response_metadata.get(key) is not None}
+    if response.usage_metadata:
+        attributes["input_tokens"] = response.usage_metadata["input_tokens"]
+        attributes["output_tokens"] = response.usage_metadata["output_tokens"]
+    return attributes
+
+
+class JsonlSpanExporter:
+    """
+    Appends finished spans to a size-rotated JSON lines file.
+    Spans are handed to a queue and written by a listener thread, so exporting
+    never blocks the event loop on file I/O.
+    """
+    def __init__(self, path:str, maxBytes:int=TRACE_FILE_MAX_BYTES, backupCount:int=TRACE_FILE_BACKUP_COUNT) -> None:
+        self.path = path
+        self._records:queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+        fileHandler = logging.handlers.RotatingFileHandler(path, maxBytes=maxBytes, backupCount=backupCount,
+                                                           encoding="utf-8")
+        fileHandler.setFormatter(logging.Formatter("%(message)s"))
+        self._listener = logging.handlers.QueueListener(self._records, fileHandler)
+        self._listener.start()
+        self._queueHandler = logging.handlers.QueueHandler(self._records)
+
+    def export(self, span:Span) -> None:
+        spanFields = {key: value for key, value in asdict(span).items() if not key.startswith("_")}
+        self._queueHandler.handle(logging.makeLogRecord({"msg": json.dumps(spanFields, default=str)}))
+
+    def close(self) -> None:
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+
+
+class Tracer:
+    """
+    Times the stages of a turn as nested spans.
+    Every finished span is observed as span_seconds{span=name}, and written to the
+    exporter when one is set. The current span is kept in a context variable, so spans
+    opened in tasks and to_thread calls nest under the span that started them.
+    """
+    def __init__(self, metrics:MetricsRegistry=metricsRegistry, exporter:JsonlSpanExporter|None=None) -> None:
+        self.metrics = metrics
+        self.exporter = exporter
+
+    @property
+    def currentSpan(self) -> Span|None:
+        return _currentSpan.get()
+
+    def startSpan(self, name:str, parent:Span|None=None, **attributes:Any) -> Span:
+        parent = parent or _currentSpan.get()
+        return Span(name, parent.traceId if parent else uuid.uuid4().hex, uuid.uuid4().hex[:16],
+                    parent.spanId if parent else None, time.time(), attributes=attributes)
+
+    def endSpan(self, span:Span, error:BaseException|None=None) -> None:
+        span.seconds = time.perf_counter() - span._startTime # pyright: ignore[reportPrivateUsage]
+        if error is not None:
+            span.error = repr(error)
+            self.metrics.incrementCounter("span_errors_total", span=span.name)
+        self.metrics.observe("span_seconds", span.seconds, span=span.name)
+        if self.exporter is not None:
+            self.exporter.export(span)
+
+    @contextmanager
+    def span(self, name:str, **attributes:Any) -> Iterator[Span]:
+        span = self.startSpan(name, **attributes)
+        token = _currentSpan.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            self.endSpan(span, error)
+            raise
+        finally:
+            _currentSpan.reset(token)
+        self.endSpan(span)
+
+
+tracer = Tracer()
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Opens a span for every LangGraph node and every tool a graph or agent runs.
+    Pass it in the callbacks of the run config.
+    """
+    run_inline = True
+
+    def __init__(self, tracer:Tracer=tracer) -> None:
+        self.tracer = tracer
+        self._spans:dict[UUID, Span] = {}
+
+    def _start(self, name:str, runId:UUID, parentRunId:UUID|None, **attributes:Any) -> None:
+        parent = self._spans.get(parentRunId) if parentRunId else None
+        self._spans[runId] = self.tracer.startSpan(name, parent, **attributes)
+
+    def _end(self, runId:UUID, error:BaseException|None=None) -> None:
+        span = self._spans.pop(runId, None)
+        if span is not None:
+            self.tracer.endSpan(span, error)
+
+    def on_chain_start(self, serialized:dict[str, Any]|None, inputs:dict[str, Any], *, run_id:UUID,
+                       parent_run_id:UUID|None=None, metadata:dict[str, Any]|None=None, **kwargs:Any) -> None:
+        nodeName = (metadata or {}).get("langgraph_node")
+        # inner runnables of a node carry the same metadata, only the node's own run is traced
+        if nodeName is not None and kwargs.get("name") == nodeName:
+            self._start(f"graph.node.{nodeName}", run_id, parent_run_id, step=(metadata or {}).get("langgraph_step"))
+
+    def on_chain_end(self, outputs:Any, *, run_id:UUID, **kwargs:Any) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error:BaseException, *, run_id:UUID, **kwargs:Any) -> None:
+        self._end(run_id, error)
+
+    def on_tool_start(self, serialized:dict[str, Any]|None, input_str:str, *, run_id:UUID,
+                      parent_run_id:UUID|None=None, **kwargs:Any) -> None:
+        toolName = kwargs.get("name") or (serialized or {}).get("name", "tool")
+        self._start(f"tool.{toolName}", run_id, parent_run_id, inputCharacters=len(input_str))
+
+    def on_tool_end(self, output:Any, *, run_id:UUID, **kwargs:Any) -> None:
+        self._end(run_id)
+
+    def on_tool_error(self, error:BaseException, *, run_id:UUID, **kwargs:Any) -> None:
+        self._end(run_id, error)
+
+
+async def serveMetrics(request:HttpRequest, writer:asyncio.StreamWriter,
+                       metrics:MetricsRegistry=metricsRegistry) -> None:
+    if request.path != "/metrics" or request.method != "GET":
+        raise HttpError(404)
+    await writeResponse(writer, 200, metrics.renderPrometheus(), contentType=PROMETHEUS_CONTENT_TYPE)
+
+
+async def startMetricsServer(host:str, port:int, metrics:MetricsRegistry=metricsRegistry) -> asyncio.Server:
+    """Serves GET /metrics in the Prometheus text format."""
+    return await startHttpServer(lambda request, writer: serveMetrics(request, writer, metrics), host, port)